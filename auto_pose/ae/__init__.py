@@ -1 +1,8 @@
-from . import ae_factory as factory
+try:
+    import tensorflow as _tf
+except ImportError:
+    # TensorFlow-free installs only get the NumPy lookup path (Codebook.load with a NumpyEncoder)
+    _tf = None
+
+if _tf is not None:
+    from . import ae_factory as factory
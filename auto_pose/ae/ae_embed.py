@@ -9,6 +9,7 @@ import tensorflow as tf
 
 from . import ae_factory as factory
 from . import utils as u
+from . import numpy_encoder
 
 def main():
     workspace_path = os.environ.get('AE_WORKSPACE_PATH')
@@ -21,6 +22,7 @@ def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("experiment_name")
     parser.add_argument('--at_step', default=None, required=False)
+    parser.add_argument('--workers', type=int, default=0, help='render the embedding views in parallel processes')
     arguments = parser.parse_args()
     full_name = arguments.experiment_name.split('/')
 
@@ -80,12 +82,19 @@ def main():
         if model=='dsprites':
             codebook.update_embedding_dsprites(sess, args)
         else:
-            codebook.update_embedding(sess, batch_size)
+            codebook.update_embedding(sess, batch_size, workers=arguments.workers)
 
         print('Saving new checkoint ..')
 
         saver.save(sess, checkpoint_file, global_step=ae.global_step)
 
+        if model!='dsprites':
+            codebook_path = u.get_codebook_path(log_dir)
+            print('Exporting codebook to %s ..' % codebook_path)
+            codebook.save(sess, codebook_path, precision=args.get('Embedding', 'PRECISION', fallback='float32'))
+            codebook.save_index(codebook_path, args)
+            numpy_encoder.export_encoder(sess, encoder, codebook_path)
+
         print('done')
 
 if __name__ == '__main__':
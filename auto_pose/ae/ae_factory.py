@@ -2,11 +2,12 @@
 
 
 from .dataset import Dataset
-from .queue import Queue
+from .queue import Queue, ProcessQueue
 from .ae import AE
 from .encoder import Encoder
 from .decoder import Decoder
 from .codebook import Codebook
+from .multi_codebook import MultiCodebook
 
 def build_dataset(dataset_path, args):
     dataset_args = { k:v for k,v in
@@ -20,8 +21,16 @@ def build_dataset(dataset_path, args):
 
 def build_queue(dataset, args):
     NUM_THREADS = args.getint('Queue', 'NUM_THREADS')
+    NUM_PROCESSES = args.getint('Queue', 'NUM_PROCESSES', fallback=0)
     QUEUE_SIZE = args.getint('Queue', 'QUEUE_SIZE')
     BATCH_SIZE = args.getint('Training', 'BATCH_SIZE')
+    if NUM_PROCESSES > 0:
+        return ProcessQueue(
+            dataset,
+            NUM_PROCESSES,
+            QUEUE_SIZE,
+            BATCH_SIZE
+        )
     queue = Queue(
         dataset,
         NUM_THREADS,
@@ -92,6 +101,10 @@ def build_codebook(encoder, dataset, args):
     codebook = Codebook(encoder, dataset, embed_bb)
     return codebook
 
+def build_multi_codebook(codebooks):
+    multi_codebook = MultiCodebook(codebooks)
+    return multi_codebook
+
 def build_codebook_from_name(experiment_name, experiment_group='', return_dataset=False, return_decoder = False):
     import os
     import configparser
@@ -134,6 +147,75 @@ def build_codebook_from_name(experiment_name, experiment_group='', return_datase
     else:
         return codebook
 
+def load_codebook_from_name(experiment_name, experiment_group=''):
+    import os
+    import configparser
+    workspace_path = os.environ.get('AE_WORKSPACE_PATH')
+
+    if workspace_path == None:
+        print('Please define a workspace path:\n')
+        print('export AE_WORKSPACE_PATH=/path/to/workspace\n')
+        exit(-1)
+
+    from . import utils as u
+    import tensorflow as tf
+
+    log_dir = u.get_log_dir(workspace_path, experiment_name, experiment_group)
+    cfg_file_path = u.get_train_config_exp_file_path(log_dir, experiment_name)
+    codebook_path = u.get_codebook_path(log_dir)
+
+    if os.path.exists(cfg_file_path):
+        args = configparser.ConfigParser()
+        args.read(cfg_file_path)
+    else:
+        print('ERROR: Config File not found: ', cfg_file_path)
+        exit()
+
+    if not os.path.exists(os.path.join(codebook_path, 'meta.json')):
+        print('ERROR: No exported codebook found, run ae_embed first: ', codebook_path)
+        exit()
+
+    # only the encoder is built, restoring the checkpoint skips all other variables
+    shape = [args.getint('Dataset','H'), args.getint('Dataset','W'), args.getint('Dataset','C')]
+    with tf.variable_scope(experiment_name):
+        x = tf.placeholder(tf.float32, [None,] + shape)
+        encoder = build_encoder(x, args)
+        codebook = Codebook.load(codebook_path, encoder)
+
+    return codebook
+
+def export_codebook_from_name(experiment_name, experiment_group=''):
+    """Exports the embedding of the latest checkpoint as ae_embed does, for experiments
+    embedded before codebooks were exported. The full codebook graph is built in a
+    graph of its own and discarded afterwards."""
+    import os
+    import configparser
+    workspace_path = os.environ.get('AE_WORKSPACE_PATH')
+
+    if workspace_path == None:
+        print('Please define a workspace path:\n')
+        print('export AE_WORKSPACE_PATH=/path/to/workspace\n')
+        exit(-1)
+
+    from . import utils as u
+    from . import numpy_encoder
+    import tensorflow as tf
+
+    log_dir = u.get_log_dir(workspace_path, experiment_name, experiment_group)
+    cfg_file_path = u.get_train_config_exp_file_path(log_dir, experiment_name)
+    codebook_path = u.get_codebook_path(log_dir)
+    args = configparser.ConfigParser()
+    args.read(cfg_file_path)
+
+    with tf.Graph().as_default():
+        codebook = build_codebook_from_name(experiment_name, experiment_group)
+        with tf.Session() as sess:
+            restore_checkpoint(sess, tf.train.Saver(), u.get_checkpoint_dir(log_dir))
+            print('Exporting codebook to %s ..' % codebook_path)
+            codebook.save(sess, codebook_path, precision=args.get('Embedding', 'PRECISION', fallback='float32'))
+            codebook.save_index(codebook_path, args)
+            numpy_encoder.export_encoder(sess, codebook._encoder, codebook_path)
+
 
 def restore_checkpoint(session, saver, ckpt_dir, at_step=None):
 
@@ -32,7 +32,8 @@ def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("experiment_name")
     parser.add_argument("-d", action='store_true', default=False)
-    parser.add_argument("-gen", action='store_true', default=False)
+    # -gen renders the training set and exits, -gen N with N render processes
+    parser.add_argument("-gen", nargs='?', type=int, const=1, default=0)
     arguments = parser.parse_args()
 
     full_name = arguments.experiment_name.split('/')
@@ -41,7 +42,7 @@ def main():
     experiment_group = full_name.pop() if len(full_name) > 0 else ''
 
     debug_mode = arguments.d
-    generate_data = arguments.gen
+    generate_data = arguments.gen > 0
 
     cfg_file_path = u.get_config_file_path(workspace_path, experiment_name, experiment_group)
     log_dir = u.get_log_dir(workspace_path, experiment_name, experiment_group)
@@ -81,10 +82,17 @@ def main():
     save_interval = args.getint('Training', 'SAVE_INTERVAL')
     model_type = args.get('Dataset', 'MODEL')
 
+    streaming = args.getboolean('Dataset', 'STREAMING', fallback=False)
+
     if model_type=='dsprites':
         dataset.get_sprite_training_images(args)
+    elif streaming and not generate_data:
+        dataset.load_bg_images(dataset_path)
+        dataset.start_streaming(args.getint('Dataset', 'STREAM_RESERVOIR_SIZE'),
+                                workers=args.getint('Dataset', 'STREAM_WORKERS', fallback=2),
+                                render_ratio=args.getfloat('Dataset', 'STREAM_RENDER_RATIO', fallback=0.))
     else:
-        dataset.get_training_images(dataset_path, args)
+        dataset.get_training_images(dataset_path, args, workers=arguments.gen)
         dataset.load_bg_images(dataset_path)
 
     if generate_data:
@@ -147,6 +155,7 @@ def main():
                 break
 
         queue.stop(sess)
+        dataset.stop_streaming()
         if not debug_mode:
             bar.finish()
         if not gentle_stop[0] and not debug_mode:
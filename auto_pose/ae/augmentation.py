@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import cv2
+
+# imgaug augmenter names the [Augmentation] CODE strings may use
+IMGAUG_NAMES = ['Sequential', 'SomeOf', 'OneOf', 'Sometimes', 'WithColorspace', 'WithChannels',
+    'Noop', 'Lambda', 'AssertLambda', 'AssertShape', 'Scale', 'CropAndPad',
+    'Pad', 'Crop', 'Fliplr', 'Flipud', 'Superpixels', 'ChangeColorspace', 'PerspectiveTransform',
+    'Grayscale', 'GaussianBlur', 'AverageBlur', 'MedianBlur', 'Convolve',
+    'Sharpen', 'Emboss', 'EdgeDetect', 'DirectedEdgeDetect', 'Add', 'AddElementwise',
+    'AdditiveGaussianNoise', 'Multiply', 'MultiplyElementwise', 'Dropout',
+    'CoarseDropout', 'Invert', 'ContrastNormalization', 'Affine', 'PiecewiseAffine',
+    'ElasticTransformation']
+
+
+def _sample(value, size, random_state):
+    """Draws imgaug style parameters: a number is constant, an int tuple is a discrete
+    and a float tuple a continuous uniform range, a list is sampled from."""
+    if isinstance(value, tuple):
+        a, b = value
+        if isinstance(a, (int, np.integer)) and isinstance(b, (int, np.integer)):
+            return random_state.randint(a, b + 1, size).astype(np.float32)
+        return random_state.uniform(a, b, size).astype(np.float32)
+    if isinstance(value, list):
+        return np.asarray(value, dtype=np.float32)[random_state.randint(0, len(value), size)]
+    return np.full(size, value, dtype=np.float32)
+
+
+class Augmenter(object):
+
+    def __init__(self):
+        self.random_state = np.random.RandomState(np.random.randint(0, 2**31 - 1))
+
+    def reseed(self, seed):
+        self.random_state = np.random.RandomState(seed)
+
+    def augment_images(self, images):
+        """uint8 batch (N,H,W,C) in, augmented uint8 batch out."""
+        images = np.asarray(images)
+        if len(images) == 0:
+            return images
+        return self._augment(images)
+
+    def _channel_values(self, value, per_channel, images):
+        # (N,1,1,C) parameters, per channel for the per_channel fraction of the images
+        N, C = len(images), images.shape[-1]
+        values = np.repeat(_sample(value, (N, 1), self.random_state), C, axis=1)
+        per_channel = self.random_state.rand(N) < float(per_channel)
+        if per_channel.any():
+            values[per_channel] = _sample(value, (int(per_channel.sum()), C), self.random_state)
+        return values[:,np.newaxis,np.newaxis,:]
+
+
+class Sequential(Augmenter):
+
+    def __init__(self, children, random_order=False):
+        Augmenter.__init__(self)
+        self.children = children if isinstance(children, list) else [children]
+        self.random_order = random_order
+
+    def reseed(self, seed):
+        Augmenter.reseed(self, seed)
+        for child in self.children:
+            child.reseed(self.random_state.randint(0, 2**31 - 1))
+
+    def _augment(self, images):
+        order = self.random_state.permutation(len(self.children)) if self.random_order else range(len(self.children))
+        for i in order:
+            images = self.children[i].augment_images(images)
+        return images
+
+
+class Sometimes(Augmenter):
+
+    def __init__(self, p, then_list=None, else_list=None):
+        Augmenter.__init__(self)
+        self.p = p
+        self.then_list = Sequential(then_list) if then_list is not None and not isinstance(then_list, Augmenter) else then_list
+        self.else_list = Sequential(else_list) if else_list is not None and not isinstance(else_list, Augmenter) else else_list
+
+    def reseed(self, seed):
+        Augmenter.reseed(self, seed)
+        for child in (self.then_list, self.else_list):
+            if child is not None:
+                child.reseed(self.random_state.randint(0, 2**31 - 1))
+
+    def _augment(self, images):
+        selected = self.random_state.rand(len(images)) < self.p
+        images = images.copy()
+        for child, rows in ((self.then_list, selected), (self.else_list, ~selected)):
+            if child is not None and rows.any():
+                images[rows] = child.augment_images(images[rows])
+        return images
+
+
+class Add(Augmenter):
+
+    def __init__(self, value=0, per_channel=False):
+        Augmenter.__init__(self)
+        self.value = value
+        self.per_channel = per_channel
+
+    def _augment(self, images):
+        values = self._channel_values(self.value, self.per_channel, images)
+        return np.clip(images + values, 0, 255).astype(np.uint8)
+
+
+class Multiply(Augmenter):
+
+    def __init__(self, mul=1.0, per_channel=False):
+        Augmenter.__init__(self)
+        self.mul = mul
+        self.per_channel = per_channel
+
+    def _augment(self, images):
+        values = self._channel_values(self.mul, self.per_channel, images)
+        return np.clip(images * values, 0, 255).astype(np.uint8)
+
+
+class ContrastNormalization(Augmenter):
+
+    def __init__(self, alpha=1.0, per_channel=False):
+        Augmenter.__init__(self)
+        self.alpha = alpha
+        self.per_channel = per_channel
+
+    def _augment(self, images):
+        alphas = self._channel_values(self.alpha, self.per_channel, images)
+        return np.clip((images - 128.) * alphas + 128., 0, 255).astype(np.uint8)
+
+
+class Invert(Augmenter):
+
+    def __init__(self, p=0, per_channel=False):
+        Augmenter.__init__(self)
+        self.p = p
+        self.per_channel = per_channel
+
+    def _augment(self, images):
+        N, C = len(images), images.shape[-1]
+        p = _sample(self.p, N, self.random_state)
+        draws = self.random_state.rand(N, C)
+        shared = self.random_state.rand(N) >= float(self.per_channel)
+        draws[shared] = draws[shared][:,:1]
+        invert = (draws < p[:,np.newaxis])[:,np.newaxis,np.newaxis,:]
+        return np.where(invert, 255 - images, images)
+
+
+class GaussianBlur(Augmenter):
+
+    def __init__(self, sigma=0):
+        Augmenter.__init__(self)
+        self.sigma = sigma
+
+    def _augment(self, images):
+        N, H, W, C = images.shape
+        sigmas = _sample(self.sigma, N, self.random_state)
+        images = images.copy()
+        for sigma in np.unique(sigmas):
+            if sigma < 0.01:
+                continue
+            rows = np.where(sigmas == sigma)[0]
+            # one cv2 call per 512 channels, the images stacked along the channel axis
+            for a in range(0, len(rows), max(512 // C, 1)):
+                chunk = rows[a:a + max(512 // C, 1)]
+                stacked = images[chunk].transpose(1, 2, 0, 3).reshape(H, W, len(chunk)*C)
+                blurred = cv2.GaussianBlur(stacked, (0, 0), sigmaX=float(sigma))
+                images[chunk] = blurred.reshape(H, W, len(chunk), C).transpose(2, 0, 1, 3)
+        return images
+
+
+class CoarseDropout(Augmenter):
+
+    def __init__(self, p=0, size_px=None, size_percent=None, per_channel=False, min_size=4):
+        Augmenter.__init__(self)
+        self.p = p
+        self.size_px = size_px
+        self.size_percent = size_percent
+        self.per_channel = per_channel
+        self.min_size = min_size
+
+    def _augment(self, images):
+        N, H, W, C = images.shape
+        images = images.copy()
+        drop_p = _sample(self.p, N, self.random_state)
+        if self.size_px is not None:
+            sizes = np.stack([_sample(self.size_px, N, self.random_state)]*2, axis=1)
+        else:
+            percent = _sample(self.size_percent, N, self.random_state)
+            sizes = np.stack([H*percent, W*percent], axis=1)
+        sizes = np.maximum(sizes.astype(np.int64), self.min_size)
+        per_channel = self.random_state.rand(N) < float(self.per_channel)
+
+        # images sharing a coarse mask resolution are masked together
+        for h, w in np.unique(sizes, axis=0):
+            rows = np.where((sizes[:,0] == h) & (sizes[:,1] == w))[0]
+            coarse = self.random_state.rand(len(rows), h, w, C) < drop_p[rows,np.newaxis,np.newaxis,np.newaxis]
+            shared = ~per_channel[rows]
+            coarse[shared] = coarse[shared][...,:1]
+            # nearest neighbour upsampling as cv2.INTER_NEAREST
+            ys = np.floor(np.arange(H) * h / float(H)).astype(np.int64)
+            xs = np.floor(np.arange(W) * w / float(W)).astype(np.int64)
+            drop = coarse[:, ys[:,np.newaxis], xs[np.newaxis,:]]
+            images[rows] = np.where(drop, 0, images[rows])
+        return images
+
+
+class ImgaugAugmenter(Augmenter):
+    """Runs an imgaug augmenter without a native counterpart on the whole batch."""
+
+    def __init__(self, augmenter):
+        Augmenter.__init__(self)
+        self.augmenter = augmenter
+
+    def reseed(self, seed):
+        Augmenter.reseed(self, seed)
+        self.augmenter.reseed(seed)
+
+    def _augment(self, images):
+        return np.asarray(self.augmenter.augment_images(images), dtype=np.uint8)
+
+
+NATIVE_AUGMENTERS = {
+    'Sequential': Sequential,
+    'Sometimes': Sometimes,
+    'Add': Add,
+    'Multiply': Multiply,
+    'ContrastNormalization': ContrastNormalization,
+    'Invert': Invert,
+    'GaussianBlur': GaussianBlur,
+    'CoarseDropout': CoarseDropout
+}
+
+
+def _imgaug_fallback(name):
+    def build(*args, **kw):
+        import imgaug.augmenters
+        return ImgaugAugmenter(getattr(imgaug.augmenters, name)(*args, **kw))
+    return build
+
+
+def from_code(code):
+    """Builds the native pipeline of an [Augmentation] CODE string, operators without a
+    native implementation are run through imgaug."""
+    namespace = {name: NATIVE_AUGMENTERS.get(name, _imgaug_fallback(name)) for name in IMGAUG_NAMES}
+    namespace['np'] = np
+    return eval(code, namespace)
@@ -1,12 +1,23 @@
 # -*- coding: utf-8 -*-
 
+import os
+import json
 import numpy as np
 
-import tensorflow as tf
+try:
+    import tensorflow as tf
+except ImportError:
+    # codebooks opened with Codebook.load and a NumpyEncoder do not need TensorFlow
+    tf = None
 import progressbar
 
 from .utils import lazy_property
 from . import utils as u
+from . import codebook_index
+from .numpy_encoder import NumpyEncoder
+
+# bump whenever the on-disk layout written by Codebook.save changes
+CODEBOOK_FORMAT_VERSION = 1
 
 
 class Codebook(object):
@@ -17,6 +28,16 @@ class Codebook(object):
         self._dataset = dataset
         self.embed_bb = embed_bb
 
+        # set when the codebook is opened from disk with Codebook.load
+        self.embedding_values = None
+        self._rotations = None
+        self._symmetry_map = None
+        # optional approximate search backend, see codebook_index
+        self.index = None
+        self._num_cyclo = int(self._dataset._kw['num_cyclo'])
+        self.K_train = np.array(eval(self._dataset._kw['k'])).reshape(3,3)
+        self.render_radius = float(self._dataset._kw['radius'])
+
         J = encoder.latent_space_size
         embedding_size = self._dataset.embedding_size
 
@@ -46,7 +67,142 @@ class Codebook(object):
         self.cos_similarity = tf.matmul(self.normalized_embedding_query, self.embedding_normalized,transpose_b=True)
         self.nearest_neighbor_idx = tf.argmax(self.cos_similarity, axis=1)
 
-
+    @property
+    def rotations(self):
+        if self._rotations is None:
+            self._rotations = self._dataset.embedding_rotations
+        return self._rotations
+
+    @property
+    def symmetry_map(self):
+        # codebook row of every entry of the full view sphere grid, None if not compacted
+        if self._dataset is not None:
+            return self._dataset.embedding_symmetry_map
+        return self._symmetry_map
+
+    @lazy_property
+    def upright_rows(self):
+        # rows holding the views without in-plane rotation, or a symmetric equivalent
+        if self.symmetry_map is None:
+            return np.arange(0, len(self.rotations), self._num_cyclo)
+        return np.unique(self.symmetry_map[::self._num_cyclo])
+
+    def save(self, session, path, precision='float32'):
+        """Exports the normalized embedding, view rotations, rendered bounding boxes
+        and the training camera to a directory of .npy files that Codebook.load
+        can memory-map without rebuilding the graph or restoring a checkpoint.
+
+        With precision float16 or int8 a reduced precision copy of the embedding is
+        written as well and used by Codebook.load instead of the float32 one."""
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+        embedding = session.run(self.embedding_normalized).astype(np.float32)
+        np.save(os.path.join(path, 'embedding_normalized.npy'), embedding)
+        if precision != 'float32':
+            quantized = codebook_index.quantize(embedding, precision)
+            np.save(os.path.join(path, 'embedding_{}.npy'.format(precision)), quantized.values)
+            if quantized.scales is not None:
+                np.save(os.path.join(path, 'embedding_scales.npy'), quantized.scales)
+        np.save(os.path.join(path, 'rotations.npy'), np.asarray(self.rotations, dtype=np.float32))
+        if self.embed_bb:
+            np.save(os.path.join(path, 'obj_bbs.npy'), session.run(self.embed_obj_bbs_var).astype(np.int32))
+        if self._dataset is not None:
+            np.save(os.path.join(path, 'view_levels.npy'), self._dataset.viewsphere_levels)
+        if self.symmetry_map is not None:
+            np.save(os.path.join(path, 'symmetry_map.npy'), self.symmetry_map)
+            np.save(os.path.join(path, 'viewsphere.npy'), np.asarray(self._dataset.viewsphere_for_embedding, dtype=np.float32))
+
+        meta = {
+            'version': CODEBOOK_FORMAT_VERSION,
+            'embedding_size': int(embedding.shape[0]),
+            'latent_space_size': int(embedding.shape[1]),
+            'num_cyclo': self._num_cyclo,
+            'embed_bb': bool(self.embed_bb),
+            'precision': precision,
+            'K': self.K_train.flatten().tolist(),
+            'radius': self.render_radius
+        }
+        # written last, an existing meta.json marks a complete export
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump(meta, f, indent=2)
+
+    @classmethod
+    def load(cls, path, encoder=None):
+        """Opens a codebook written by Codebook.save. The arrays are memory-mapped
+        read-only, so several processes share the same physical pages.
+
+        encoder only needs its weights restored, the dataset, decoder and the
+        codebook variables are not part of the graph. With a NumpyEncoder the lookup
+        runs without TensorFlow, pass session=None to the search methods then."""
+        with open(os.path.join(path, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+        if meta['version'] != CODEBOOK_FORMAT_VERSION:
+            raise ValueError('Unsupported codebook format version {} in {} (expected {})'.format(
+                meta['version'], path, CODEBOOK_FORMAT_VERSION))
+
+        codebook = cls.__new__(cls)
+        codebook._encoder = encoder
+        codebook._dataset = None
+        codebook.embed_bb = meta['embed_bb']
+        codebook.embedding_values = Codebook._open_embedding(path, meta)
+        codebook._rotations = np.load(os.path.join(path, 'rotations.npy'), mmap_mode='r')
+        symmetry_file = os.path.join(path, 'symmetry_map.npy')
+        codebook._symmetry_map = np.load(symmetry_file) if os.path.exists(symmetry_file) else None
+        codebook.embed_obj_bbs_values = np.load(os.path.join(path, 'obj_bbs.npy'), mmap_mode='r') if meta['embed_bb'] else None
+        codebook._num_cyclo = meta['num_cyclo']
+        codebook.K_train = np.array(meta['K']).reshape(3,3)
+        codebook.render_radius = meta['radius']
+        codebook.index = None
+        if os.path.exists(os.path.join(path, 'index.npz')):
+            codebook.index = codebook_index.load_index(os.path.join(path, 'index.npz'), codebook.embedding_values)
+        if encoder is not None and not isinstance(encoder, NumpyEncoder):
+            codebook.normalized_embedding_query = tf.nn.l2_normalize(encoder.z, 1)
+        return codebook
+
+    @staticmethod
+    def _open_embedding(path, meta):
+        precision = meta.get('precision', 'float32')
+        if precision == 'float32':
+            return np.load(os.path.join(path, 'embedding_normalized.npy'), mmap_mode='r')
+        values = np.load(os.path.join(path, 'embedding_{}.npy'.format(precision)), mmap_mode='r')
+        scales_file = os.path.join(path, 'embedding_scales.npy')
+        scales = np.load(scales_file, mmap_mode='r') if precision == 'int8' else None
+        return codebook_index.QuantizedEmbedding(values, scales)
+
+    def save_index(self, path, args):
+        """Builds the search backend selected in [Embedding] and stores it next to
+        an exported codebook."""
+        with open(os.path.join(path, 'meta.json'), 'r') as f:
+            embedding = Codebook._open_embedding(path, json.load(f))
+        rotations = np.load(os.path.join(path, 'rotations.npy'), mmap_mode='r')
+        levels_file = os.path.join(path, 'view_levels.npy')
+        view_levels = np.load(levels_file) if os.path.exists(levels_file) else None
+        symmetry_map = None
+        if os.path.exists(os.path.join(path, 'symmetry_map.npy')):
+            # the view sphere walk of the hierarchical index runs on the full grid
+            symmetry_map = np.load(os.path.join(path, 'symmetry_map.npy'))
+            rotations = np.load(os.path.join(path, 'viewsphere.npy'), mmap_mode='r')
+        self.index = codebook_index.build_index(embedding, args, rotations=rotations, view_levels=view_levels,
+                                                symmetry_map=symmetry_map)
+        self.index.save(os.path.join(path, 'index.npz'))
+
+    def _query(self, session, x):
+        if isinstance(self._encoder, NumpyEncoder):
+            return self._encoder.normalized_z(x)
+        return session.run(self.normalized_embedding_query, {self._encoder.x: x})
+
+    def _cos_similarity(self, session, x):
+        if self.embedding_values is None:
+            return session.run(self.cos_similarity, {self._encoder.x: x})
+        return codebook_index.similarity(self.embedding_values, self._query(session, x))
+
+    def _search(self, session, x, top_n, upright=False):
+        if self.index is None or upright:
+            return self._top_n_idcs(self._cos_similarity(session, x), top_n, upright=upright)
+        query = self._query(session, x)
+        _, idcs = self.index.search(query, top_n)
+        return idcs
 
     def nearest_rotation(self, session, x, top_n=1, upright=False, return_idcs=False):
         #R_model2cam
@@ -56,87 +212,128 @@ class Codebook(object):
         if x.ndim == 3:
             x = np.expand_dims(x, 0)
 
-        cosine_similarity = session.run(self.cos_similarity, {self._encoder.x: x})
+        idcs = self._search(session, x, top_n, upright=upright)
         if top_n == 1:
-            if upright:
-                idcs = np.argmax(cosine_similarity[:,::int(self._dataset._kw['num_cyclo'])], axis=1)*int(self._dataset._kw['num_cyclo'])
-            else:
-                idcs = np.argmax(cosine_similarity, axis=1)
+            idcs = idcs[:,0]
         else:
-            unsorted_max_idcs = np.argpartition(-cosine_similarity.squeeze(), top_n)[:top_n]
-            idcs = unsorted_max_idcs[np.argsort(-cosine_similarity.squeeze()[unsorted_max_idcs])]
+            idcs = idcs[0]
         if return_idcs:
             return idcs
         else:
-            return self._dataset.viewsphere_for_embedding[idcs].squeeze()
+            return self.rotations[idcs].squeeze()
 
 
 
     def auto_pose6d(self, session, x, predicted_bb, K_test, top_n, train_args, depth_pred=None, upright=False):
 
-        idcs = self.nearest_rotation(session, x, top_n=top_n, upright=upright,return_idcs=True)
-        Rs_est = self._dataset.viewsphere_for_embedding[idcs]
+        if x.ndim == 3:
+            x = np.expand_dims(x, 0)
+        depth_preds = None if depth_pred is None else [depth_pred]
+        Rs_est, ts_est = self.auto_pose6d_batch(session, x, [predicted_bb], [K_test], top_n, train_args,
+                                                depth_preds=depth_preds, upright=upright)
+        return (Rs_est[0], ts_est[0])
+
+    def _top_n_idcs(self, cosine_similarity, top_n, upright=False):
+        if upright:
+            cosine_similarity = cosine_similarity[:,self.upright_rows]
+        if top_n == 1:
+            idcs = np.argmax(cosine_similarity, axis=1)[:,np.newaxis]
+        else:
+            unsorted_max_idcs = np.argpartition(-cosine_similarity, top_n, axis=1)[:,:top_n]
+            order = np.argsort(-np.take_along_axis(cosine_similarity, unsorted_max_idcs, axis=1), axis=1)
+            idcs = np.take_along_axis(unsorted_max_idcs, order, axis=1)
+        if upright:
+            idcs = self.upright_rows[idcs]
+        return idcs
+
+    def auto_pose6d_batch(self, session, x, predicted_bbs, K_tests, top_n, train_args, depth_preds=None, upright=False):
+        """6D pose of N crops from a single encoder pass and similarity matmul.
+
+        x: (N,H,W,C) crops, predicted_bbs: (N,4) xywh boxes in the test images,
+        K_tests: (N,3,3) or a single (3,3) camera matrix, depth_preds: optional (N,)
+        Returns Rs_est (N,top_n,3,3) and ts_est (N,top_n,3).
+        """
+        x = np.asarray(x)
+        if x.dtype == 'uint8':
+            x = x/255.
 
+        idcs = self._search(session, x, top_n, upright=upright)
+        return self.poses_from_idcs(session, idcs, predicted_bbs, K_tests, train_args, depth_preds=depth_preds)
 
+    def poses_from_idcs(self, session, idcs, predicted_bbs, K_tests, train_args, depth_preds=None):
+        """Translation and corrected rotation for (N,top_n) codebook indices, see auto_pose6d_batch."""
+        N, top_n = idcs.shape
+        Rs_est = self.rotations[idcs]
 
         # test_depth = f_test / f_train * render_radius * diag_bb_ratio
-        K_train = np.array(eval(train_args.get('Dataset','K'))).reshape(3,3)
-        render_radius = train_args.getfloat('Dataset','RADIUS')
+        if train_args is None:
+            K_train, render_radius = self.K_train, self.render_radius
+        else:
+            K_train = np.array(eval(train_args.get('Dataset','K'))).reshape(3,3)
+            render_radius = train_args.getfloat('Dataset','RADIUS')
 
-        K00_ratio = K_test[0,0] / K_train[0,0]
-        K11_ratio = K_test[1,1] / K_train[1,1]
+        K_tests = np.asarray(K_tests, dtype=np.float64).reshape(-1,3,3)
+        if len(K_tests) == 1:
+            K_tests = np.repeat(K_tests, N, axis=0)
+        predicted_bbs = np.asarray(predicted_bbs, dtype=np.float64).reshape(N,4)
 
-        mean_K_ratio = np.mean([K00_ratio,K11_ratio])
+        mean_K_ratio = (K_tests[:,0,0] / K_train[0,0] + K_tests[:,1,1] / K_train[1,1]) / 2.
 
         if self.embed_obj_bbs_values is None:
             self.embed_obj_bbs_values = session.run(self.embed_obj_bbs_var)
+        rendered_bbs = np.asarray(self.embed_obj_bbs_values[idcs], dtype=np.float64)
 
-        ts_est = np.empty((top_n,3))
-        for i,idx in enumerate(idcs):
-
-            rendered_bb = self.embed_obj_bbs_values[idx].squeeze()
-            if depth_pred is None:
-                diag_bb_ratio = np.linalg.norm(np.float32(rendered_bb[2:])) / np.linalg.norm(np.float32(predicted_bb[2:]))
-                z = diag_bb_ratio * mean_K_ratio * render_radius
-            else:
-                z = depth_pred
-
-
-            # object center in image plane (bb center =/= object center)
-            center_obj_x_train = rendered_bb[0] + rendered_bb[2]/2. - K_train[0,2]
-            center_obj_y_train = rendered_bb[1] + rendered_bb[3]/2. - K_train[1,2]
-
-            center_obj_x_test = predicted_bb[0] + predicted_bb[2]/2 - K_test[0,2]
-            center_obj_y_test = predicted_bb[1] + predicted_bb[3]/2 - K_test[1,2]
-
-            center_obj_mm_x = center_obj_x_test * z / K_test[0,0] - center_obj_x_train * render_radius / K_train[0,0]
-            center_obj_mm_y = center_obj_y_test * z / K_test[1,1] - center_obj_y_train * render_radius / K_train[1,1]
-
-
-            t_est = np.array([center_obj_mm_x, center_obj_mm_y, z])
-            ts_est[i] = t_est
-
-            # correcting the rotation matrix
-            # the codebook consists of centered object views, but the test image crop is not centered
-            # we determine the rotation that preserves appearance when translating the object
-            d_alpha_x = - np.arctan(t_est[0]/t_est[2])
-            d_alpha_y = - np.arctan(t_est[1]/t_est[2])
-            R_corr_x = np.array([[1,0,0],
-                                [0,np.cos(d_alpha_y),-np.sin(d_alpha_y)],
-                                [0,np.sin(d_alpha_y),np.cos(d_alpha_y)]])
-            R_corr_y = np.array([[np.cos(d_alpha_x),0,-np.sin(d_alpha_x)],
-                                [0,1,0],
-                                [np.sin(d_alpha_x),0,np.cos(d_alpha_x)]])
-            R_corrected = np.dot(R_corr_y,np.dot(R_corr_x,Rs_est[i]))
-            Rs_est[i] = R_corrected
+        if depth_preds is None:
+            diag_bb_ratio = np.linalg.norm(np.float32(rendered_bbs[...,2:]), axis=-1) / np.linalg.norm(np.float32(predicted_bbs[:,np.newaxis,2:]), axis=-1)
+            z = diag_bb_ratio * mean_K_ratio[:,np.newaxis] * render_radius
+        else:
+            z = np.repeat(np.asarray(depth_preds, dtype=np.float64).reshape(N,1), top_n, axis=1)
+
+        # object center in image plane (bb center =/= object center)
+        center_obj_x_train = rendered_bbs[...,0] + rendered_bbs[...,2]/2. - K_train[0,2]
+        center_obj_y_train = rendered_bbs[...,1] + rendered_bbs[...,3]/2. - K_train[1,2]
+
+        center_obj_x_test = predicted_bbs[:,0] + predicted_bbs[:,2]/2 - K_tests[:,0,2]
+        center_obj_y_test = predicted_bbs[:,1] + predicted_bbs[:,3]/2 - K_tests[:,1,2]
+
+        center_obj_mm_x = (center_obj_x_test / K_tests[:,0,0])[:,np.newaxis] * z - center_obj_x_train * render_radius / K_train[0,0]
+        center_obj_mm_y = (center_obj_y_test / K_tests[:,1,1])[:,np.newaxis] * z - center_obj_y_train * render_radius / K_train[1,1]
+
+        ts_est = np.stack((center_obj_mm_x, center_obj_mm_y, z), axis=-1)
+
+        # correcting the rotation matrix
+        # the codebook consists of centered object views, but the test image crop is not centered
+        # we determine the rotation that preserves appearance when translating the object
+        d_alpha_x = - np.arctan(ts_est[...,0]/ts_est[...,2])
+        d_alpha_y = - np.arctan(ts_est[...,1]/ts_est[...,2])
+        cos_x, sin_x = np.cos(d_alpha_x), np.sin(d_alpha_x)
+        cos_y, sin_y = np.cos(d_alpha_y), np.sin(d_alpha_y)
+
+        R_corr_x = np.zeros(d_alpha_y.shape + (3,3))
+        R_corr_x[...,0,0] = 1
+        R_corr_x[...,1,1] = cos_y
+        R_corr_x[...,1,2] = -sin_y
+        R_corr_x[...,2,1] = sin_y
+        R_corr_x[...,2,2] = cos_y
+
+        R_corr_y = np.zeros(d_alpha_x.shape + (3,3))
+        R_corr_y[...,0,0] = cos_x
+        R_corr_y[...,0,2] = -sin_x
+        R_corr_y[...,1,1] = 1
+        R_corr_y[...,2,0] = sin_x
+        R_corr_y[...,2,2] = cos_x
+
+        Rs_est = np.matmul(R_corr_y, np.matmul(R_corr_x, Rs_est))
         return (Rs_est, ts_est)
 
-
-
-
     def nearest_rotation_batch(self, session, x):
-        idcs = session.run(self.nearest_neighbor_idx, {self._encoder.x: x})
-        return self._dataset.viewsphere_for_embedding[idcs]
+        if self.index is not None:
+            idcs = self._search(session, x, 1)[:,0]
+        elif self.embedding_values is None:
+            idcs = session.run(self.nearest_neighbor_idx, {self._encoder.x: x})
+        else:
+            idcs = np.argmax(self._cos_similarity(session, x), axis=1)
+        return self.rotations[idcs]
 
     def test_embedding(self, sess, x, normalized=True):
 
@@ -193,10 +390,10 @@ class Codebook(object):
 
 
 
-    def update_embedding(self, session, batch_size):
+    def update_embedding(self, session, batch_size, workers=0):
         embedding_size = self._dataset.embedding_size
         J = self._encoder.latent_space_size
-        embedding_z = np.empty( (embedding_size, J) )
+        embedding_z = np.empty( (embedding_size, J), dtype=np.float32 )
         obj_bbs = np.empty( (embedding_size, 4) )
 
         widgets = ['Creating embedding ..: ', progressbar.Percentage(),
@@ -206,9 +403,7 @@ class Codebook(object):
         bar = progressbar.ProgressBar(maxval=embedding_size,widgets=widgets)
 
         bar.start()
-        for a, e in u.batch_iteration_indices(embedding_size, batch_size):
-
-            batch, obj_bbs_batch = self._dataset.render_embedding_image_batch(a, e)
+        for a, e, batch, obj_bbs_batch in self._dataset.get_embedding_images(batch_size, workers=workers):
             embedding_z[a:e] = session.run(self._encoder.z, feed_dict={self._encoder.x: batch})
 
             if self.embed_bb:
@@ -0,0 +1,423 @@
+# -*- coding: utf-8 -*-
+
+import time
+import numpy as np
+
+
+class QuantizedEmbedding(object):
+    """Normalized codebook stored as float16, or as symmetric int8 with one float32
+    scale per row. Rows are dequantized to float32 chunk by chunk when scored, so a
+    full float32 copy of the codebook never exists in memory."""
+
+    def __init__(self, values, scales=None):
+        self.values = values
+        self.scales = scales
+
+    @property
+    def precision(self):
+        return str(self.values.dtype)
+
+    @property
+    def shape(self):
+        return self.values.shape
+
+    @property
+    def nbytes(self):
+        return self.values.nbytes + (0 if self.scales is None else self.scales.nbytes)
+
+    def __len__(self):
+        return len(self.values)
+
+    def __getitem__(self, idcs):
+        rows = np.asarray(self.values[idcs], dtype=np.float32)
+        if self.scales is not None:
+            rows *= np.asarray(self.scales[idcs], dtype=np.float32)[...,np.newaxis]
+        return rows
+
+def quantize(embedding, precision):
+    """Returns a QuantizedEmbedding of a float32 embedding for precision float16 or int8."""
+    if precision == 'float16':
+        return QuantizedEmbedding(np.asarray(embedding, dtype=np.float16))
+    elif precision == 'int8':
+        values = np.empty(embedding.shape, dtype=np.int8)
+        scales = np.empty(len(embedding), dtype=np.float32)
+        for a in range(0, len(embedding), 65536):
+            rows = np.asarray(embedding[a:a+65536], dtype=np.float32)
+            scale = np.maximum(np.abs(rows).max(axis=1), 1e-12) / 127.
+            values[a:a+65536] = np.clip(np.round(rows / scale[:,np.newaxis]), -127, 127)
+            scales[a:a+65536] = scale
+        return QuantizedEmbedding(values, scales)
+    else:
+        raise ValueError('Unknown codebook precision: {}'.format(precision))
+
+def similarity(embedding, query, chunk=65536):
+    """Cosine similarity (N,E) of normalized queries against a float32 or quantized embedding."""
+    query = np.atleast_2d(query).astype(np.float32)
+    if not isinstance(embedding, QuantizedEmbedding):
+        return np.dot(query, embedding.T)
+    sims = np.empty((len(query), len(embedding)), dtype=np.float32)
+    for a in range(0, len(embedding), chunk):
+        sims[:,a:a+chunk] = np.dot(query, embedding[a:a+chunk].T)
+    return sims
+
+def as_float32(embedding):
+    if isinstance(embedding, QuantizedEmbedding):
+        return embedding[:]
+    return np.asarray(embedding, dtype=np.float32)
+
+
+def _batched_argmax_dot(x, centroids, bias=None, chunk=65536):
+    assign = np.empty(len(x), dtype=np.int64)
+    for a in range(0, len(x), chunk):
+        scores = np.dot(x[a:a+chunk], centroids.T)
+        if bias is not None:
+            scores += bias
+        assign[a:a+chunk] = np.argmax(scores, axis=1)
+    return assign
+
+def kmeans(x, k, n_iter=20, spherical=False, max_train=100000, seed=0):
+    """Lloyd's k-means on the rows of x. With spherical=True centroids are kept on the
+    unit sphere and points are assigned by inner product (cosine similarity)."""
+    rng = np.random.RandomState(seed)
+    x = np.asarray(x, dtype=np.float32)
+    train = x if len(x) <= max_train else x[rng.choice(len(x), max_train, replace=False)]
+    k = min(k, len(train))
+    centroids = train[rng.choice(len(train), k, replace=False)].copy()
+
+    for _ in range(n_iter):
+        # argmin ||x-c||^2 == argmax x.c - ||c||^2/2
+        bias = None if spherical else -0.5*np.sum(centroids**2, axis=1)
+        assign = _batched_argmax_dot(train, centroids, bias)
+        counts = np.bincount(assign, minlength=k)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, train)
+
+        empty = counts == 0
+        if np.any(empty):
+            sums[empty] = train[rng.choice(len(train), np.count_nonzero(empty), replace=False)]
+            counts[empty] = 1
+        if spherical:
+            centroids = sums / np.maximum(np.linalg.norm(sums, axis=1, keepdims=True), 1e-12)
+        else:
+            centroids = sums / counts[:,np.newaxis].astype(np.float32)
+    return centroids.astype(np.float32)
+
+def _top_k(scores, k):
+    k = min(k, scores.shape[1])
+    if k == scores.shape[1]:
+        unsorted = np.tile(np.arange(k), (len(scores),1))
+    else:
+        unsorted = np.argpartition(-scores, k-1, axis=1)[:,:k]
+    order = np.argsort(-np.take_along_axis(scores, unsorted, axis=1), axis=1)
+    idcs = np.take_along_axis(unsorted, order, axis=1)
+    return np.take_along_axis(scores, idcs, axis=1), idcs
+
+
+class BruteForceIndex(object):
+    """Exact search, a dense matmul against all normalized codebook entries."""
+
+    kind = 'brute'
+
+    def __init__(self, embedding):
+        self._embedding = embedding
+
+    def search(self, query, k):
+        query = np.atleast_2d(query).astype(np.float32)
+        return _top_k(similarity(self._embedding, query), k)
+
+    def save(self, path):
+        np.savez(path, kind=self.kind)
+
+
+class IVFIndex(object):
+    """Inverted lists over a spherical k-means coarse quantizer.
+
+    n_probe lists closest to the query are scanned. With pq_m > 0 the residuals to the
+    list centroids are product quantized into pq_m uint8 codes per entry, candidates are
+    scored with per-query lookup tables and the best `rerank` of them are re-scored
+    exactly against the full embedding. n_probe and rerank trade recall for speed.
+    """
+
+    kind = 'ivf'
+
+    def __init__(self, embedding, n_lists=None, n_probe=8, pq_m=0, rerank=100, n_iter=20, seed=0):
+        self._embedding = embedding
+        self.n_probe = n_probe
+        self.rerank = rerank
+        if n_lists is None:
+            n_lists = int(4*np.sqrt(len(embedding)))
+
+        x = as_float32(embedding)
+        self.centroids = kmeans(x, n_lists, n_iter=n_iter, spherical=True, seed=seed)
+        self.assign = _batched_argmax_dot(x, self.centroids)
+        self._build_lists()
+
+        self.pq_centroids = None
+        self.pq_codes = None
+        if pq_m > 0:
+            J = x.shape[1]
+            if J % pq_m != 0:
+                raise ValueError('latent space size {} is not divisible by pq_m={}'.format(J, pq_m))
+            residuals = (x - self.centroids[self.assign]).reshape(len(x), pq_m, J//pq_m)
+            self.pq_centroids = np.stack([kmeans(residuals[:,j], 256, n_iter=n_iter, seed=seed+j)
+                                          for j in range(pq_m)])
+            self.pq_codes = np.stack([_batched_argmax_dot(residuals[:,j], self.pq_centroids[j], -0.5*np.sum(self.pq_centroids[j]**2, axis=1))
+                                      for j in range(pq_m)], axis=1).astype(np.uint8)
+
+    def _build_lists(self):
+        n_lists = len(self.centroids)
+        self.ids = np.argsort(self.assign, kind='stable')
+        self.offsets = np.concatenate(([0], np.cumsum(np.bincount(self.assign, minlength=n_lists))))
+
+    def _candidates(self, lists):
+        return np.concatenate([self.ids[self.offsets[l]:self.offsets[l+1]] for l in lists])
+
+    def search(self, query, k):
+        query = np.atleast_2d(query).astype(np.float32)
+        coarse = np.dot(query, self.centroids.T)
+        _, probes = _top_k(coarse, self.n_probe)
+
+        scores = np.empty((len(query), k), dtype=np.float32)
+        idcs = np.empty((len(query), k), dtype=np.int64)
+        for i, q in enumerate(query):
+            cand = self._candidates(probes[i])
+            if len(cand) < k:
+                cand = np.arange(len(self._embedding))
+
+            if self.pq_codes is not None:
+                m = self.pq_centroids.shape[0]
+                lut = np.einsum('mj,mcj->mc', q.reshape(m,-1), self.pq_centroids)
+                approx = coarse[i, self.assign[cand]] + lut[np.arange(m), self.pq_codes[cand]].sum(axis=1)
+                if self.rerank <= 0:
+                    scores[i], top = _top_k(approx[np.newaxis], k)
+                    idcs[i] = cand[top[0]]
+                    continue
+                _, keep = _top_k(approx[np.newaxis], max(k, self.rerank))
+                cand = cand[keep[0]]
+
+            # sorted row access keeps reads from a memory-mapped embedding sequential
+            cand = np.sort(cand)
+            exact = np.dot(self._embedding[cand], q)
+            s, top = _top_k(exact[np.newaxis], k)
+            scores[i], idcs[i] = s[0], cand[top[0]]
+        return scores, idcs
+
+    def save(self, path):
+        arrays = dict(kind=self.kind, centroids=self.centroids, assign=self.assign,
+                      n_probe=self.n_probe, rerank=self.rerank)
+        if self.pq_codes is not None:
+            arrays.update(pq_centroids=self.pq_centroids, pq_codes=self.pq_codes)
+        np.savez(path, **arrays)
+
+    @classmethod
+    def from_arrays(cls, embedding, data):
+        index = cls.__new__(cls)
+        index._embedding = embedding
+        index.centroids = data['centroids']
+        index.assign = data['assign']
+        index.n_probe = int(data['n_probe'])
+        index.rerank = int(data['rerank'])
+        index.pq_centroids = data['pq_centroids'] if 'pq_centroids' in data.files else None
+        index.pq_codes = data['pq_codes'] if 'pq_codes' in data.files else None
+        index._build_lists()
+        return index
+
+
+class HierarchicalIndex(object):
+    """Coarse-to-fine search over the refined icosahedron of the view sphere.
+
+    Views created up to coarse_level are scored against every cyclo_stride-th in-plane
+    rotation first. The beam best (view, in-plane rotation) entries are then expanded
+    level by level: the view to its neighbours on the next refinement level and the
+    in-plane rotation to all rotations within one cyclo_stride of it.
+
+    view_levels holds the refinement level of every view (Dataset.viewsphere_levels),
+    rotations the codebook rotations, num_cyclo consecutive entries per view. For
+    symmetry compacted codebooks rotations is the full view sphere grid and
+    symmetry_map the embedding row of each of its entries.
+    """
+
+    kind = 'hierarchical'
+
+    def __init__(self, embedding, rotations, view_levels, num_cyclo, coarse_level=1, beam=8, cyclo_stride=4, symmetry_map=None):
+        self._embedding = embedding
+        self.symmetry_map = symmetry_map
+        self.num_cyclo = int(num_cyclo)
+        self.view_levels = np.asarray(view_levels, dtype=np.int32)
+        # the first in-plane rotation of every view is the plain view, its
+        # third row is the viewing direction up to sign
+        self.view_dirs = np.asarray(rotations[::self.num_cyclo,2,:], dtype=np.float32)
+        self.coarse_level = min(coarse_level, self.view_levels.max())
+        self.beam = beam
+        self.cyclo_stride = cyclo_stride
+        self._build_neighbours()
+
+    def _build_neighbours(self):
+        self._cyclos_coarse = np.arange(0, self.num_cyclo, self.cyclo_stride)
+        self._cyclo_window = np.arange(-self.cyclo_stride+1, self.cyclo_stride)
+        self._levels = list(range(self.coarse_level, self.view_levels.max()+1))
+        self._level_views = {l: np.where(self.view_levels <= l)[0] for l in self._levels}
+
+        # neighbours[l][v]: views up to level l within one coarse grid spacing of a view v
+        # of level l-1, this covers the new edge midpoints and the adjacent coarse views
+        self._neighbours = {}
+        for prev, l in zip(self._levels[:-1], self._levels[1:]):
+            coarse, fine = self._level_views[prev], self._level_views[l]
+            cos_coarse = np.dot(self.view_dirs[coarse], self.view_dirs[coarse].T)
+            np.fill_diagonal(cos_coarse, -1.)
+            spacing = np.median(np.arccos(np.clip(cos_coarse.max(axis=1), -1., 1.)))
+            min_cos = np.cos(1.05*spacing)
+            self._neighbours[l] = {}
+            for a in range(0, len(coarse), 1024):
+                close = np.dot(self.view_dirs[coarse[a:a+1024]], self.view_dirs[fine].T) >= min_cos
+                for v, row in zip(coarse[a:a+1024], close):
+                    self._neighbours[l][v] = fine[row]
+
+    def _rows(self, entries):
+        return entries if self.symmetry_map is None else self.symmetry_map[entries]
+
+    def _score(self, q, entries):
+        entries = np.unique(entries)
+        return entries, np.dot(self._embedding[self._rows(entries)], q)
+
+    def _expand(self, entries, level):
+        views, cyclos = entries // self.num_cyclo, entries % self.num_cyclo
+        expanded = []
+        for v, c in zip(views, cyclos):
+            window = (c + self._cyclo_window) % self.num_cyclo
+            expanded.append((self._neighbours[level][v][:,np.newaxis]*self.num_cyclo + window[np.newaxis]).ravel())
+        return np.concatenate(expanded)
+
+    def search(self, query, k):
+        query = np.atleast_2d(query).astype(np.float32)
+        coarse_views = self._level_views[self.coarse_level]
+        coarse_entries = (coarse_views[:,np.newaxis]*self.num_cyclo + self._cyclos_coarse[np.newaxis]).ravel()
+
+        scores = np.empty((len(query), k), dtype=np.float32)
+        idcs = np.empty((len(query), k), dtype=np.int64)
+        for i, q in enumerate(query):
+            entries, sims = self._score(q, coarse_entries)
+            for l in self._levels[1:]:
+                _, top = _top_k(sims[np.newaxis], self.beam)
+                entries, sims = self._score(q, self._expand(entries[top[0]], l))
+            if len(self._levels) == 1:
+                # nothing to refine, score all in-plane rotations around the beam
+                _, top = _top_k(sims[np.newaxis], self.beam)
+                best = entries[top[0]]
+                window = (best[:,np.newaxis] % self.num_cyclo + self._cyclo_window) % self.num_cyclo
+                entries, sims = self._score(q, ((best // self.num_cyclo)[:,np.newaxis]*self.num_cyclo + window).ravel())
+            rows, first = np.unique(self._rows(entries), return_index=True)
+            sims = sims[first]
+            if len(rows) < k:
+                rows = np.arange(len(self._embedding))
+                sims = similarity(self._embedding, q)[0]
+            s, top = _top_k(sims[np.newaxis], k)
+            scores[i], idcs[i] = s[0], rows[top[0]]
+        return scores, idcs
+
+    def entries_scanned(self):
+        """Upper bound of codebook entries scored per query, exhaustive search scores all."""
+        n_entries = len(self._level_views[self.coarse_level])*len(self._cyclos_coarse)
+        for l in self._levels[1:]:
+            n_neighbours = np.mean([len(n) for n in self._neighbours[l].values()])
+            n_entries += self.beam*n_neighbours*len(self._cyclo_window)
+        if len(self._levels) == 1:
+            n_entries += self.beam*len(self._cyclo_window)
+        return n_entries
+
+    def save(self, path):
+        extra = {} if self.symmetry_map is None else {'symmetry_map': self.symmetry_map}
+        np.savez(path, kind=self.kind, view_levels=self.view_levels, view_dirs=self.view_dirs,
+                 num_cyclo=self.num_cyclo, coarse_level=self.coarse_level, beam=self.beam,
+                 cyclo_stride=self.cyclo_stride, **extra)
+
+    @classmethod
+    def from_arrays(cls, embedding, data):
+        index = cls.__new__(cls)
+        index._embedding = embedding
+        index.view_levels = data['view_levels']
+        index.view_dirs = data['view_dirs']
+        index.num_cyclo = int(data['num_cyclo'])
+        index.coarse_level = int(data['coarse_level'])
+        index.beam = int(data['beam'])
+        index.cyclo_stride = int(data['cyclo_stride'])
+        index.symmetry_map = data['symmetry_map'] if 'symmetry_map' in data else None
+        index._build_neighbours()
+        return index
+
+
+def build_index(embedding, args, rotations=None, view_levels=None, symmetry_map=None):
+    """Builds the search backend selected by [Embedding] INDEX (brute, ivf, ivfpq or
+    hierarchical, the latter needs the codebook rotations and view levels)."""
+    kind = args.get('Embedding', 'INDEX', fallback='brute')
+    if kind == 'brute':
+        return BruteForceIndex(embedding)
+    elif kind == 'hierarchical':
+        if view_levels is None:
+            raise ValueError('hierarchical codebook index needs the view sphere refinement levels')
+        return HierarchicalIndex(
+            embedding,
+            rotations,
+            view_levels,
+            args.getint('Embedding', 'NUM_CYCLO'),
+            coarse_level=args.getint('Embedding', 'INDEX_COARSE_LEVEL', fallback=1),
+            beam=args.getint('Embedding', 'INDEX_BEAM', fallback=8),
+            cyclo_stride=args.getint('Embedding', 'INDEX_CYCLO_STRIDE', fallback=4),
+            symmetry_map=symmetry_map
+        )
+    elif kind in ('ivf', 'ivfpq'):
+        n_lists = args.getint('Embedding', 'INDEX_N_LISTS', fallback=0)
+        return IVFIndex(
+            embedding,
+            n_lists=n_lists if n_lists > 0 else None,
+            n_probe=args.getint('Embedding', 'INDEX_N_PROBE', fallback=8),
+            pq_m=args.getint('Embedding', 'INDEX_PQ_M', fallback=8) if kind == 'ivfpq' else 0,
+            rerank=args.getint('Embedding', 'INDEX_RERANK', fallback=100)
+        )
+    else:
+        raise ValueError('Unknown codebook index: {}'.format(kind))
+
+def load_index(path, embedding):
+    data = np.load(path)
+    kind = str(data['kind'])
+    if kind == 'brute':
+        return BruteForceIndex(embedding)
+    elif kind == 'ivf':
+        return IVFIndex.from_arrays(embedding, data)
+    elif kind == 'hierarchical':
+        return HierarchicalIndex.from_arrays(embedding, data)
+    else:
+        raise ValueError('Unknown codebook index in {}: {}'.format(path, kind))
+
+
+def precision_report(embedding, queries, precision, top_n=10):
+    """Agreement of a float16/int8 codebook with the float32 one: top-1 agreement,
+    mean overlap of the top_n sets and the memory footprint of both."""
+    quantized = quantize(embedding, precision)
+    _, gt = BruteForceIndex(embedding).search(queries, top_n)
+    _, idcs = BruteForceIndex(quantized).search(queries, top_n)
+    return {
+        'top1': np.mean(idcs[:,0] == gt[:,0]),
+        'top%s' % top_n: np.mean([len(np.intersect1d(a, b)) / float(top_n) for a, b in zip(idcs, gt)]),
+        'float32_mb': np.asarray(embedding).nbytes / 2.**20,
+        '%s_mb' % precision: quantized.nbytes / 2.**20
+    }
+
+def benchmark(index, embedding, queries, k=10, repeats=3):
+    """Recall@k of index against exact search and mean latency per query in ms
+    for both."""
+    exact = BruteForceIndex(embedding)
+
+    start = time.time()
+    for _ in range(repeats):
+        _, gt = exact.search(queries, k)
+    brute_ms = (time.time() - start) / (repeats*len(queries)) * 1000.
+
+    start = time.time()
+    for _ in range(repeats):
+        _, idcs = index.search(queries, k)
+    index_ms = (time.time() - start) / (repeats*len(queries)) * 1000.
+
+    recall_1 = np.mean(idcs[:,0] == gt[:,0])
+    recall_k = np.mean([len(np.intersect1d(a, b)) / float(k) for a, b in zip(idcs, gt)])
+    return {'recall@1': recall_1, 'recall@%s' % k: recall_k, 'brute_ms': brute_ms, 'index_ms': index_ms}
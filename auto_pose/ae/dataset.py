@@ -11,6 +11,68 @@ import cv2
 from .pysixd_stuff import transform
 from .pysixd_stuff import view_sampler
 from .utils import lazy_property
+from . import utils as u
+from . import augmentation
+
+# views per resumable unit of embedding rendering, see Dataset.get_embedding_images
+EMBEDDING_SHARD_SIZE = 1024
+TRAINING_SHARD_SIZE = 1000
+# render_async readbacks in flight in render_training_images: the x/y pair being cropped
+# and the next pair
+ASYNC_READBACKS = 4
+# [Dataset] keys that do not change the rendered training set, left out of its cache key
+TRAINING_CACHE_IGNORED_KEYS = ('render_threads', 'streaming', 'stream_reservoir_size', 'stream_workers',
+                               'stream_render_ratio')
+
+
+def _decode_bg_shard(args):
+    file_list, shape, crop, seed = args
+    random_state = np.random.RandomState(seed)
+    images = []
+    for fname in file_list:
+        bgr = cv2.imread(fname)
+        if bgr is None or bgr.shape[0] < shape[0] or bgr.shape[1] < shape[1]:
+            images.append(None)
+            continue
+        if crop:
+            H,W = bgr.shape[:2]
+            y_anchor = random_state.randint(0, H-shape[0]+1)
+            x_anchor = random_state.randint(0, W-shape[1]+1)
+            bgr = bgr[y_anchor:y_anchor+shape[0],x_anchor:x_anchor+shape[1],:]
+        if shape[2] == 1:
+            bgr = cv2.cvtColor(np.uint8(bgr), cv2.COLOR_BGR2GRAY)[:,:,np.newaxis]
+        images.append(bgr)
+    return images
+
+
+def decode_bg_images(file_list, noof_imgs, shape, crop=True, workers=0, shard_size=64):
+    """Yields up to noof_imgs decoded background images (random crops of shape with crop),
+    decoding shards of file_list in a pool of worker processes. Files that cannot be read
+    or are smaller than shape are skipped and replaced by the next files of the list."""
+    pool = None
+    if workers > 1:
+        import multiprocessing
+        pool = multiprocessing.get_context('fork').Pool(workers)
+    noof_decoded = 0
+    pos = 0
+    try:
+        while noof_decoded < noof_imgs and pos < len(file_list):
+            todo = file_list[pos:pos + noof_imgs - noof_decoded]
+            pos += len(todo)
+            shards = [(todo[a:a+shard_size], shape, crop, np.random.randint(0, 2**31 - 1))
+                      for a in range(0, len(todo), shard_size)]
+            results = pool.imap(_decode_bg_shard, shards) if pool is not None else map(_decode_bg_shard, shards)
+            for images in results:
+                for bgr in images:
+                    if bgr is not None:
+                        noof_decoded += 1
+                        yield bgr
+                print('loaded %s/%s bg images' % (noof_decoded, noof_imgs))
+    finally:
+        if pool is not None:
+            pool.terminate()
+    if noof_decoded < noof_imgs:
+        print('Warning: only %s of %s background images could be loaded' % (noof_decoded, noof_imgs))
 
 
 class Dataset(object):
@@ -26,9 +88,12 @@ class Dataset(object):
 
         self._kw = kw
         # self._aug = eval(self._kw['code'])
+        self._stream = None
+        self._bg_full = None
 
         self.train_x = np.empty( (self.noof_training_imgs,) + self.shape, dtype=np.uint8 )
-        self.mask_x = np.empty( (self.noof_training_imgs,) + self.shape[:2], dtype= bool)
+        # bit-packed along the width, see unpack_masks
+        self.mask_x = np.empty( (self.noof_training_imgs, self.shape[0], (self.shape[1]+7)//8), dtype=np.uint8)
         self.noof_obj_pixels = np.empty( (self.noof_training_imgs,), dtype= bool)
         self.train_y = np.empty( (self.noof_training_imgs,) + self.shape, dtype=np.uint8 )
         self.bg_imgs = np.empty( (self.noof_bg_imgs,) + self.shape, dtype=np.uint8 )
@@ -37,17 +102,27 @@ class Dataset(object):
 
 
     @lazy_property
-    def viewsphere_for_embedding(self):
+    def _views_for_embedding(self):
         kw = self._kw
-        num_cyclo = int(kw['num_cyclo'])
         azimuth_range = (0, 2 * np.pi)
         elev_range = (-0.5 * np.pi, 0.5 * np.pi)
-        views, _ = view_sampler.sample_views(
+        return view_sampler.sample_views(
             int(kw['min_n_views']),
             float(kw['radius']),
             azimuth_range,
             elev_range
         )
+
+    @property
+    def viewsphere_levels(self):
+        # icosphere refinement level of every view, each view spans num_cyclo codebook entries
+        return np.array(self._views_for_embedding[1], dtype=np.int32)
+
+    @lazy_property
+    def viewsphere_for_embedding(self):
+        kw = self._kw
+        num_cyclo = int(kw['num_cyclo'])
+        views, _ = self._views_for_embedding
         Rs = np.empty( (len(views)*num_cyclo, 3, 3) )
         i = 0
         for view in views:
@@ -57,42 +132,297 @@ class Dataset(object):
                 i += 1
         return Rs
 
+    @lazy_property
+    def embedding_symmetry_map(self):
+        """Codebook row of every viewsphere_for_embedding entry, None without symmetry compaction.
+
+        Entries whose rotation maps onto an earlier entry under one of the object symmetries
+        (models_info.json, continuous ones discretized to the in-plane step) share the row of
+        that entry. Rotations returned for a row are symmetric equivalents of all its entries.
+        """
+        kw = self._kw
+        if not eval(kw.get('symmetry_compaction', 'False')):
+            return None
+        from bop_toolkit_lib import inout, misc
+        models_info = inout.load_json(kw['models_info_path'], keys_to_int=True)
+        num_cyclo = int(kw['num_cyclo'])
+        symmetries = misc.get_symmetry_transformations(models_info[int(kw['obj_id'])], np.pi / (num_cyclo-1))
+        symmetries = [sym['R'] for sym in symmetries if not np.allclose(sym['R'], np.eye(3))]
+
+        Rs = self.viewsphere_for_embedding
+        view_Rs = Rs[::num_cyclo]
+        view_dirs = view_Rs[:,2,:]
+        cyclo_step = 2.*np.pi / (num_cyclo-1)
+        cos_views = np.dot(view_dirs, view_dirs.T)
+        np.fill_diagonal(cos_views, -1.)
+        view_step = np.median(np.arccos(np.clip(cos_views.max(axis=1), -1., 1.)))
+        max_angle = float(kw.get('symmetry_max_angle', 0.5*max(view_step, cyclo_step)))
+
+        # entry (w, j) holds rot_z(-c_j).R_w, so rot_z(-c_i).R_v.S lands on view w with
+        # in-plane rotation c_i - phi where rot_z(phi) ~ R_v.S.R_w^T
+        cyclos = np.linspace(0, 2.*np.pi, num_cyclo)
+        entry_view = np.arange(len(Rs)) // num_cyclo
+        entry_cyclo = cyclos[np.arange(len(Rs)) % num_cyclo]
+        targets = []
+        for S in symmetries:
+            w = np.argmax(np.dot(np.dot(view_dirs, S), view_dirs.T), axis=1)
+            M = np.einsum('vij,jk,vlk->vil', view_Rs, S, view_Rs[w])
+            phi = np.arctan2(M[:,1,0], M[:,0,0])
+            j = np.round(np.mod(entry_cyclo - phi[entry_view], 2.*np.pi) / cyclo_step).astype(np.int64) % (num_cyclo-1)
+            target = w[entry_view]*num_cyclo + j
+            cos_angle = (np.einsum('nij,jk,nik->n', Rs, S, Rs[target]) - 1.) / 2.
+            targets.append(np.where(np.arccos(np.clip(cos_angle, -1., 1.)) <= max_angle, target, -1))
+
+        # greedy cover in entry order, the first entry of every class is its representative
+        representative = -np.ones(len(Rs), dtype=np.int64)
+        for i in range(len(Rs)):
+            if representative[i] < 0:
+                representative[i] = i
+                for target in targets:
+                    if target[i] >= 0 and representative[target[i]] < 0:
+                        representative[target[i]] = i
+        canonical, symmetry_map = np.unique(representative, return_inverse=True)
+        print('symmetry compaction: %s of %s codebook entries kept' % (len(canonical), len(Rs)))
+        return symmetry_map.astype(np.int32)
+
+    @lazy_property
+    def embedding_rotations(self):
+        # rotations of the codebook rows, the symmetry representatives if compacted
+        if self.embedding_symmetry_map is None:
+            return self.viewsphere_for_embedding
+        _, first = np.unique(self.embedding_symmetry_map, return_index=True)
+        return self.viewsphere_for_embedding[first]
+
     @lazy_property
     def renderer(self):
+        if self._kw.get('renderer', 'gl') == 'numpy':
+            # CPU rasterizer, no OpenGL context needed
+            from auto_pose.meshrenderer import meshrenderer_numpy
+            assert self._kw['model'] in ('cad', 'reconst'), 'Error: neither cad nor reconst in model path!'
+            return meshrenderer_numpy.Renderer(
+               [self._kw['model_path']],
+               int(self._kw['antialiasing']),
+               self.dataset_path,
+               float(self._kw['vertex_scale']),
+               shader='cad' if self._kw['model'] == 'cad' else 'phong',
+               threads=int(self._kw.get('render_threads', 1))
+            )
         from auto_pose.meshrenderer import meshrenderer, meshrenderer_phong
         if self._kw['model'] == 'cad':
             renderer = meshrenderer.Renderer(
                [self._kw['model_path']],
                int(self._kw['antialiasing']),
                self.dataset_path,
-               float(self._kw['vertex_scale'])
+               float(self._kw['vertex_scale']),
+               async_buffers=ASYNC_READBACKS
             )
         elif self._kw['model'] == 'reconst':
             renderer = meshrenderer_phong.Renderer(
                [self._kw['model_path']],
                int(self._kw['antialiasing']),
                self.dataset_path,
-               float(self._kw['vertex_scale'])
+               float(self._kw['vertex_scale']),
+               async_buffers=ASYNC_READBACKS
             )
         else:
             'Error: neither cad nor reconst in model path!'
             exit()
         return renderer
 
-    def get_training_images(self, dataset_path, args):
-        current_config_hash = hashlib.md5((str(args.items('Dataset')+args.items('Paths'))).encode('utf-8')).hexdigest()
+    def get_training_images(self, dataset_path, args, workers=0):
+        """Opens the rendered training set read-only memory-mapped, rendering it first if needed.
+
+        train_x, mask_x (bit-packed) and train_y live in separate raw .npy files, so
+        batches gather rows from the page cache and training processes on one node
+        share the pages. Training sets cached in the former single .npz are converted once.
+        Rendering goes in shards of TRAINING_SHARD_SIZE images that are marked done on
+        disk, an interrupted run only renders the missing shards. With workers > 1 the
+        shards are split over forked processes, each with its own renderer.
+        """
+        current_config_hash = self.training_cache_hash(args)
         current_file_name = os.path.join(dataset_path, current_config_hash + '.npz')
+        names = ['train_x', 'mask_x', 'train_y']
+        array_files = [os.path.join(dataset_path, '{}_{}.npy'.format(current_config_hash, name))
+                       for name in ['train_x', 'mask_x_packed', 'train_y']]
+
+        if not all(os.path.exists(f) for f in array_files):
+            if os.path.exists(current_file_name):
+                training_data = np.load(current_file_name)
+                for name, array_file in zip(names, array_files):
+                    array = training_data[name]
+                    if name == 'mask_x':
+                        array = np.packbits(array, axis=-1)
+                    with open(array_file + '.part', 'wb') as f:
+                        np.save(f, array.astype(getattr(self, name).dtype))
+                    os.rename(array_file + '.part', array_file)
+            else:
+                self._render_training_shards(current_config_hash, names, array_files, workers)
+
+        self.train_x, self.mask_x, self.train_y = [np.load(f, mmap_mode='r') for f in array_files]
+        self.noof_obj_pixels = np.concatenate([np.count_nonzero(self.unpack_masks(self.mask_x[a:e])==0,axis=(1,2))
+                                               for a, e in u.batch_iteration_indices(len(self.mask_x), 4096)])
+        print('loaded %s training images' % len(self.train_x))
 
-        if os.path.exists(current_file_name):
-            training_data = np.load(current_file_name)
-            self.train_x = training_data['train_x'].astype(np.uint8)
-            self.mask_x = training_data['mask_x']
-            self.train_y = training_data['train_y'].astype(np.uint8)
+    def _render_training_shards(self, config_hash, names, array_files, workers):
+        # render straight into the files, the arrays never need to fit into RAM
+        parts = [f + '.part' for f in array_files]
+        shards_part = os.path.join(os.path.dirname(array_files[0]), config_hash + '_train_shards.npy.part')
+        noof_shards = -(-self.noof_training_imgs // TRAINING_SHARD_SIZE)
+        seed = int(config_hash[:8], 16)
+        resume = all(os.path.exists(f) for f in parts + [shards_part])
+        mode = 'r+' if resume else 'w+'
+        for name, part in zip(names, parts):
+            array = getattr(self, name)
+            setattr(self, name, np.lib.format.open_memmap(part, mode=mode, dtype=array.dtype, shape=array.shape))
+        done = np.lib.format.open_memmap(shards_part, mode=mode, dtype=np.uint8, shape=(noof_shards,))
+        pending = [i for i in range(noof_shards) if not done[i]]
+        if resume:
+            print('resuming training image rendering, %s of %s shards done' % (noof_shards - len(pending), noof_shards))
+
+        if workers > 1 and len(pending) > 0:
+            import multiprocessing
+            # fork, the dataset is not pickled and every child creates its own GL context
+            context = multiprocessing.get_context('fork')
+            processes = []
+            for w in range(workers):
+                process = context.Process(target=self._render_training_shard_list,
+                                          args=(pending[w::workers], seed, names, parts, shards_part))
+                process.daemon = True
+                process.start()
+                processes.append(process)
+            try:
+                while not done.all():
+                    if not any(process.is_alive() for process in processes) and not done.all():
+                        raise RuntimeError('training render workers exited with {} of {} shards done'.format(
+                            int(np.count_nonzero(done)), noof_shards))
+                    print('rendered %s/%s training shards' % (np.count_nonzero(done), noof_shards))
+                    time.sleep(5.)
+            finally:
+                for process in processes:
+                    process.terminate()
+                    process.join()
         else:
-            self.render_training_images()
-            np.savez(current_file_name, train_x = self.train_x, mask_x = self.mask_x, train_y = self.train_y)
-        self.noof_obj_pixels = np.count_nonzero(self.mask_x==0,axis=(1,2))
-        print('loaded %s training images' % len(self.train_x))
+            for shard in pending:
+                self._render_training_shard(shard, seed, done)
+                print('rendered %s/%s training shards' % (np.count_nonzero(done), noof_shards))
+            if not done.all():
+                raise RuntimeError('training rendering stopped with {} of {} shards done'.format(
+                    int(np.count_nonzero(done)), noof_shards))
+
+        for name, part, array_file in zip(names, parts, array_files):
+            getattr(self, name).flush()
+            setattr(self, name, None)
+            os.rename(part, array_file)
+        del done
+        os.remove(shards_part)
+
+    def _render_training_shard(self, shard, seed, done):
+        a, e = shard*TRAINING_SHARD_SIZE, min((shard+1)*TRAINING_SHARD_SIZE, self.noof_training_imgs)
+        # per shard seed, a resumed or parallel run draws the same poses as a serial one.
+        # The global stream of the caller is left as it was
+        state = np.random.get_state()
+        np.random.seed((seed + shard) % 2**32)
+        try:
+            rendered = self.render_training_images(a, e, progress=False)
+        finally:
+            np.random.set_state(state)
+        for name in ['train_x', 'mask_x', 'train_y']:
+            getattr(self, name).flush()
+        if rendered == e:
+            done[shard] = 1
+            done.flush()
+
+    def _render_training_shard_list(self, shards, seed, names, parts, shards_part):
+        for name, part in zip(names, parts):
+            setattr(self, name, np.load(part, mmap_mode='r+'))
+        done = np.load(shards_part, mmap_mode='r+')
+        for shard in shards:
+            self._render_training_shard(shard, seed, done)
+
+    def start_streaming(self, reservoir_size, workers=2, render_ratio=0., chunk_size=8):
+        """Replaces the prerendered training set by a rolling reservoir of reservoir_size
+        pairs in shared memory, continuously refilled by forked render processes.
+
+        batch samples from the filled part of the reservoir, the oldest pairs are
+        overwritten first. With render_ratio > 0 at least render_ratio fresh pairs are
+        rendered per consumed sample: batch waits for the renderers, and renderers pause
+        once they are a full reservoir ahead. Call before the renderer is used in this
+        process and before forking batch producers.
+        """
+        import multiprocessing
+        context = multiprocessing.get_context('fork')
+        arrays = {}
+        for name in ['train_x', 'mask_x', 'train_y']:
+            shape = (reservoir_size,) + getattr(self, name).shape[1:]
+            arrays[name] = np.frombuffer(context.RawArray('B', int(np.prod(shape))), dtype=np.uint8).reshape(shape)
+        arrays['noof_obj_pixels'] = np.frombuffer(context.RawArray('q', reservoir_size), dtype=np.int64)
+        self.train_x, self.mask_x, self.train_y, self.noof_obj_pixels = [
+            arrays[name] for name in ['train_x', 'mask_x', 'train_y', 'noof_obj_pixels']]
+        self.noof_training_imgs = reservoir_size
+
+        self._stream = {
+            'arrays': arrays,
+            'size': reservoir_size,
+            'ratio': float(render_ratio),
+            'lock': context.Lock(),
+            'rendered': context.RawValue('q', 0),
+            'consumed': context.RawValue('q', 0),
+            'stop': context.Event(),
+            'processes': []
+        }
+        # fork, the dataset is not pickled and every child creates its own GL context
+        for seed in np.random.randint(0, 2**31 - 1, workers):
+            process = context.Process(target=self._stream_renderer, args=(seed, chunk_size))
+            process.daemon = True
+            process.start()
+            self._stream['processes'].append(process)
+
+    def stop_streaming(self):
+        if self._stream is None:
+            return
+        self._stream['stop'].set()
+        for process in self._stream['processes']:
+            process.join(5.)
+            if process.is_alive():
+                process.terminate()
+                process.join()
+        self._stream['processes'] = []
+
+    def _stream_renderer(self, seed, chunk_size):
+        stream = self._stream
+        arrays, size, ratio = stream['arrays'], stream['size'], stream['ratio']
+        np.random.seed(seed)
+        # render_training_images writes into private chunk buffers of this process
+        self.train_x, self.mask_x, self.train_y = [np.empty((chunk_size,) + arrays[name].shape[1:], dtype=np.uint8)
+                                                   for name in ['train_x', 'mask_x', 'train_y']]
+        while not stream['stop'].is_set():
+            if ratio > 0 and stream['rendered'].value >= ratio*stream['consumed'].value + size:
+                time.sleep(0.01)
+                continue
+            self.render_training_images(0, chunk_size, progress=False)
+            noof_obj_pixels = np.count_nonzero(self.unpack_masks(self.mask_x)==0, axis=(1,2))
+            with stream['lock']:
+                slots = (stream['rendered'].value + np.arange(chunk_size)) % size
+                arrays['train_x'][slots] = self.train_x
+                arrays['mask_x'][slots] = self.mask_x
+                arrays['train_y'][slots] = self.train_y
+                arrays['noof_obj_pixels'][slots] = noof_obj_pixels
+                stream['rendered'].value += chunk_size
+
+    def _stream_batch(self, batch_size):
+        stream = self._stream
+        while (stream['rendered'].value < batch_size or
+               stream['rendered'].value < stream['ratio']*stream['consumed'].value):
+            if stream['stop'].is_set():
+                raise RuntimeError('training pair streaming was stopped')
+            time.sleep(0.005)
+        with stream['lock']:
+            rand_idcs = np.random.choice(min(stream['rendered'].value, stream['size']), batch_size, replace=False)
+            # pixel counts copied with their pairs, workers overwrite the slots under the lock
+            batch = (self.train_x[rand_idcs], self.mask_x[rand_idcs], self.train_y[rand_idcs],
+                     self.noof_obj_pixels[rand_idcs])
+            stream['consumed'].value += batch_size
+        return batch
 
     def get_sprite_training_images(self, train_args):
 
@@ -130,49 +460,183 @@ class Dataset(object):
         self.train_y = np.expand_dims(imgs_sampled_rot, 3)*255
 
 
-    # def get_embedding_images(self, dataset_path, args):
-
-    #     current_config_hash = hashlib.md5(str(args.items('Embedding') + args.items('Dataset')+args.items('Paths'))).hexdigest()
-    #     current_file_name = os.path.join(dataset_path, current_config_hash + '.npz')
+    @staticmethod
+    def training_cache_hash(args):
+        # [Dataset] and [Paths] without the throughput knobs, configs without them keep their caches
+        dataset_items = [(k, v) for k, v in args.items('Dataset') if k not in TRAINING_CACHE_IGNORED_KEYS]
+        return hashlib.md5((str(dataset_items+args.items('Paths'))).encode('utf-8')).hexdigest()
 
-    #     if os.path.exists(current_file_name):
-    #         embedding_data = np.load(current_file_name)
-    #         self.embedding_data = embedding_data.astype(np.uint8)
-    #     else:
-    #         self.render_embedding_images()
-    #         np.savez(current_file_name, train_x = self.train_x, mask_x = self.mask_x, train_y = self.train_y)
-    #     print 'loaded %s training images' % len(self.train_x)
+    @property
+    def embedding_cache_hash(self):
+        # embedding crops depend on the rendering and view sphere settings and the model, not on the weights
+        keys = ['model', 'model_path', 'h', 'w', 'c', 'radius', 'render_dims', 'k', 'vertex_scale', 'antialiasing',
+                'pad_factor', 'clip_near', 'clip_far', 'min_n_views', 'num_cyclo', 'symmetry_compaction',
+                'models_info_path', 'obj_id', 'symmetry_max_angle', 'crop_rendering', 'crop_supersampling',
+                'renderer']
+        config_hash = hashlib.md5(str([(k, self._kw.get(k)) for k in keys]).encode('utf-8'))
+        with open(self._kw['model_path'], 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                config_hash.update(chunk)
+        return config_hash.hexdigest()
+
+    def get_embedding_images(self, batch_size, workers=0):
+        """Yields (start, end, batch, obj_bbs) over all embedding views.
+
+        The uint8 crops and bounding boxes are rendered in shards of EMBEDDING_SHARD_SIZE
+        views into memory-mapped files in dataset_path, keyed by embedding_cache_hash.
+        Finished shards are marked on disk, so an interrupted run resumes with the
+        missing ones and a complete cache is only read. With workers > 0 forked
+        processes, each with its own renderer, render the shards while the caller
+        consumes the finished ones in order.
+        """
+        current_config_hash = self.embedding_cache_hash
+        crops_file = os.path.join(self.dataset_path, current_config_hash + '_embedding.npy')
+        bbs_file = os.path.join(self.dataset_path, current_config_hash + '_embedding_bbs.npy')
+        n = self.embedding_size
+
+        if os.path.exists(crops_file):
+            crops = np.load(crops_file, mmap_mode='r')
+            obj_bbs = np.load(bbs_file)
+            for a in range(0, n, batch_size):
+                e = min(a + batch_size, n)
+                yield (a, e, crops[a:e] / 255., obj_bbs[a:e])
+            return
+
+        # the crops file only gets its final name once every shard is done
+        crops_part, bbs_part, shards_part = [f + '.part' for f in (crops_file, bbs_file, crops_file[:-4] + '_shards.npy')]
+        noof_shards = -(-n // EMBEDDING_SHARD_SIZE)
+        resume = all(os.path.exists(f) for f in (crops_part, bbs_part, shards_part))
+        mode = 'r+' if resume else 'w+'
+        crops = np.lib.format.open_memmap(crops_part, mode=mode, dtype=np.uint8, shape=(n,) + self.shape)
+        obj_bbs = np.lib.format.open_memmap(bbs_part, mode=mode, dtype=np.float64, shape=(n, 4))
+        done = np.lib.format.open_memmap(shards_part, mode=mode, dtype=np.uint8, shape=(noof_shards,))
+        pending = [i for i in range(noof_shards) if not done[i]]
+        if resume:
+            print('resuming embedding rendering, %s of %s shards done' % (noof_shards - len(pending), noof_shards))
+
+        processes = []
+        if workers > 0 and len(pending) > 0:
+            import multiprocessing
+            # fork, the dataset is not pickled and every child creates its own GL context
+            context = multiprocessing.get_context('fork')
+            for w in range(workers):
+                process = context.Process(target=self._render_embedding_shards,
+                                          args=(pending[w::workers], crops_part, bbs_part, shards_part))
+                process.daemon = True
+                process.start()
+                processes.append(process)
+
+        try:
+            for shard in range(noof_shards):
+                if not done[shard]:
+                    if workers > 0:
+                        while not done[shard]:
+                            if not any(process.is_alive() for process in processes) and not done[shard]:
+                                raise RuntimeError('embedding render workers exited before shard {} was done'.format(shard))
+                            time.sleep(0.01)
+                    else:
+                        self._render_embedding_shard(shard, crops, obj_bbs, done)
+                a, e = shard*EMBEDDING_SHARD_SIZE, min((shard+1)*EMBEDDING_SHARD_SIZE, n)
+                for start in range(a, e, batch_size):
+                    end = min(start + batch_size, e)
+                    yield (start, end, crops[start:end] / 255., obj_bbs[start:end])
+        finally:
+            for process in processes:
+                process.terminate()
+                process.join()
+
+        crops.flush()
+        del crops, done
+        np.save(bbs_file, np.array(obj_bbs))
+        del obj_bbs
+        os.rename(crops_part, crops_file)
+        os.remove(bbs_part)
+        os.remove(shards_part)
+
+    def _render_embedding_shard(self, shard, crops, obj_bbs, done):
+        a, e = shard*EMBEDDING_SHARD_SIZE, min((shard+1)*EMBEDDING_SHARD_SIZE, len(crops))
+        batch, obj_bbs[a:e] = self.render_embedding_image_batch(a, e)
+        crops[a:e] = np.round(batch*255.).astype(np.uint8)
+        crops.flush()
+        obj_bbs.flush()
+        done[shard] = 1
+        done.flush()
+
+    def _render_embedding_shards(self, shards, crops_part, bbs_part, shards_part):
+        crops = np.load(crops_part, mmap_mode='r+')
+        obj_bbs = np.load(bbs_part, mmap_mode='r+')
+        done = np.load(shards_part, mmap_mode='r+')
+        for shard in shards:
+            self._render_embedding_shard(shard, crops, obj_bbs, done)
 
     def load_bg_images(self, dataset_path):
-        current_config_hash = hashlib.md5((str(self.shape) + str(self.noof_bg_imgs) + str(self._kw['background_images_glob'])).encode('utf-8')).hexdigest()
-        current_file_name = os.path.join(dataset_path, current_config_hash +'.npy')
-        if os.path.exists(current_file_name):
-            self.bg_imgs = np.load(current_file_name)
-        else:
-            file_list = self.bg_img_paths[:self.noof_bg_imgs]
-            from random import shuffle
-            shuffle(file_list)
-
-
-            for j,fname in enumerate(file_list):
-                print('loading bg img %s/%s' % (j,self.noof_bg_imgs))
-                bgr = cv2.imread(fname)
-                H,W = bgr.shape[:2]
-                y_anchor = int(np.random.rand() * (H-self.shape[0]))
-                x_anchor = int(np.random.rand() * (W-self.shape[1]))
-                # bgr = cv2.resize(bgr, self.shape[:2])
-                bgr = bgr[y_anchor:y_anchor+self.shape[0],x_anchor:x_anchor+self.shape[1],:]
-                if bgr.shape[0]!=self.shape[0] or bgr.shape[1]!=self.shape[1]:
-                    continue
-                if self.shape[2] == 1:
-                    bgr = cv2.cvtColor(np.uint8(bgr), cv2.COLOR_BGR2GRAY)[:,:,np.newaxis]
-                self.bg_imgs[j] = bgr
-            np.save(current_file_name,self.bg_imgs)
-
-
+        """Opens the background crop cache memory-mapped, decoding the images first if needed.
 
+        Images are decoded by a pool of bg_workers processes, files that fail to decode or
+        are smaller than the crop are replaced by further files of background_images_glob.
+        With bg_recrop the decoded full-resolution images are cached instead and every
+        batch draws fresh random crops from them.
+        """
+        kw = self._kw
+        workers = int(kw.get('bg_workers', os.cpu_count()))
+        # the first noof_bg_imgs files as before, the others replace failures
+        file_list = self.bg_img_paths[:self.noof_bg_imgs]
+        spare_files = self.bg_img_paths[self.noof_bg_imgs:]
+        from random import shuffle
+        shuffle(file_list)
+        shuffle(spare_files)
+        file_list += spare_files
+
+        if eval(kw.get('bg_recrop', 'False')):
+            current_config_hash = hashlib.md5((str(self.shape[2]) + str(self.noof_bg_imgs) + str(kw['background_images_glob'])).encode('utf-8')).hexdigest()
+            data_file = os.path.join(dataset_path, current_config_hash + '_bg_full.bin')
+            index_file = os.path.join(dataset_path, current_config_hash + '_bg_full_index.npy')
+            if not os.path.exists(index_file):
+                index = []
+                with open(data_file + '.part', 'wb') as f:
+                    for bgr in decode_bg_images(file_list, self.noof_bg_imgs, self.shape, crop=False, workers=workers):
+                        index.append((f.tell(),) + bgr.shape[:2])
+                        f.write(np.ascontiguousarray(bgr).tobytes())
+                os.rename(data_file + '.part', data_file)
+                np.save(index_file, np.array(index, dtype=np.int64).reshape(-1, 3))
+            self._bg_full = (np.memmap(data_file, dtype=np.uint8, mode='r'), np.load(index_file))
+            self.noof_bg_imgs = len(self._bg_full[1])
+            self.bg_imgs = None
+        else:
+            current_config_hash = hashlib.md5((str(self.shape) + str(self.noof_bg_imgs) + str(kw['background_images_glob'])).encode('utf-8')).hexdigest()
+            current_file_name = os.path.join(dataset_path, current_config_hash +'.npy')
+            if not os.path.exists(current_file_name):
+                bg_imgs = np.lib.format.open_memmap(current_file_name + '.part', mode='w+', dtype=np.uint8,
+                                                    shape=(self.noof_bg_imgs,) + self.shape)
+                n = 0
+                for bgr in decode_bg_images(file_list, self.noof_bg_imgs, self.shape, crop=True, workers=workers):
+                    bg_imgs[n] = bgr
+                    n += 1
+                bg_imgs.flush()
+                if n < self.noof_bg_imgs:
+                    bg_imgs = np.array(bg_imgs[:n])
+                    with open(current_file_name + '.part', 'wb') as f:
+                        np.save(f, bg_imgs)
+                del bg_imgs
+                os.rename(current_file_name + '.part', current_file_name)
+            self._bg_full = None
+            self.bg_imgs = np.load(current_file_name, mmap_mode='r')
+            self.noof_bg_imgs = len(self.bg_imgs)
         print('loaded %s bg images' % self.noof_bg_imgs)
 
+    def bg_crops(self, idcs):
+        """Background crops of the images idcs, freshly cropped from the full-resolution cache with bg_recrop."""
+        if self._bg_full is None:
+            return self.bg_imgs[idcs]
+        data, index = self._bg_full
+        H, W, C = self.shape
+        crops = np.empty((len(idcs),) + self.shape, dtype=np.uint8)
+        for k, (offset, h, w) in enumerate(index[idcs]):
+            y_anchor, x_anchor = np.random.randint(0, h-H+1), np.random.randint(0, w-W+1)
+            image = data[offset:offset+h*w*C].reshape(h, w, C)
+            crops[k] = image[y_anchor:y_anchor+H, x_anchor:x_anchor+W]
+        return crops
+
 
     def render_rot(self, R, t=None ,downSample = 1):
         kw = self._kw
@@ -216,7 +680,13 @@ class Dataset(object):
         return cv2.resize(bgr_y, self.shape[:2])
 
 
-    def render_training_images(self):
+    def render_training_images(self, start=0, end=None, progress=True):
+        """Renders the training pairs start:end into train_x, mask_x and train_y.
+
+        Returns the index after the last rendered pair, end unless an invisible object
+        stopped the rendering early.
+        """
+        end = self.noof_training_imgs if end is None else end
         kw = self._kw
         H, W = int(kw['h']), int(kw['w'])
         render_dims = eval(kw['render_dims'])
@@ -230,92 +700,211 @@ class Dataset(object):
 
         widgets = ['Training: ', progressbar.Percentage(),
              ' ', progressbar.Bar(),
-             ' ', progressbar.Counter(), ' / %s' % self.noof_training_imgs,
+             ' ', progressbar.Counter(), ' / %s' % (end - start),
              ' ', progressbar.ETA(), ' ']
-        bar = progressbar.ProgressBar(maxval=self.noof_training_imgs,widgets=widgets)
-        bar.start()
-
-        for i in np.arange(self.noof_training_imgs):
-            bar.update(i)
-
-            # print '%s/%s' % (i,self.noof_training_imgs)
-            # start_time = time.time()
-            R = transform.random_rotation_matrix()[:3,:3]
-            bgr_x, depth_x = self.renderer.render(
-                obj_id=0,
-                W=render_dims[0],
-                H=render_dims[1],
-                K=K.copy(),
-                R=R,
-                t=t,
-                near=clip_near,
-                far=clip_far,
-                random_light=True
-            )
-            bgr_y, depth_y = self.renderer.render(
+        bar = progressbar.ProgressBar(maxval=end - start,widgets=widgets)
+        if progress:
+            bar.start()
+
+        # with render_async the next pose is rendered on the GPU while this one is cropped
+        render_async = getattr(self.renderer, 'render_async', None)
+        crop_rendering, ss = self.crop_rendering, self.crop_supersampling
+        def render_pair(R):
+            render = render_async if render_async is not None else self.renderer.render
+            if not crop_rendering:
+                return [render(
+                    obj_id=0,
+                    W=render_dims[0],
+                    H=render_dims[1],
+                    K=K.copy(),
+                    R=R,
+                    t=t,
+                    near=clip_near,
+                    far=clip_far,
+                    random_light=random_light
+                ) for random_light in (True, False)]
+            # x and y rendered straight into the crop windows of extract_square_patch
+            obj_bb = self.predicted_bbox(R, t, K, render_dims)
+            x, y, w, h = obj_bb
+            rand_trans_x = np.random.uniform(-max_rel_offset, max_rel_offset) * w
+            rand_trans_y = np.random.uniform(-max_rel_offset, max_rel_offset) * h
+            obj_bb_off = obj_bb + np.array([rand_trans_x,rand_trans_y,0,0])
+            return [render(
                 obj_id=0,
-                W=render_dims[0],
-                H=render_dims[1],
-                K=K.copy(),
+                W=W*ss,
+                H=H*ss,
+                K=self.crop_intrinsics(K, bb, pad_factor, (W*ss, H*ss), render_dims),
                 R=R,
                 t=t,
                 near=clip_near,
                 far=clip_far,
-                random_light=False
-            )
+                random_light=random_light
+            ) for bb, random_light in ((obj_bb_off, True), (obj_bb, False))]
+
+        pending = render_pair(transform.random_rotation_matrix()[:3,:3]) if start < end else None
+        for i in np.arange(start, end):
+            if progress:
+                bar.update(i - start)
+
+            # print '%s/%s' % (i,self.noof_training_imgs)
+            # start_time = time.time()
+            current = pending
+            if i + 1 < end:
+                pending = render_pair(transform.random_rotation_matrix()[:3,:3])
+            if render_async is not None:
+                current = [handle.result() for handle in current]
+            (bgr_x, depth_x), (bgr_y, depth_y) = current
             # render_time = time.time() - start_time
             # cv2.imshow('bgr_x',bgr_x)
             # cv2.imshow('bgr_y',bgr_y)
             # cv2.waitKey(0)
 
-            ys, xs = np.nonzero(depth_x > 0)
-
-            try:
-                obj_bb = view_sampler.calc_2d_bbox(xs, ys, render_dims)
-            except ValueError as e:
-                print('Object in Rendering not visible. Have you scaled the vertices to mm?')
-                break
+            if crop_rendering:
+                bgr_x, bgr_y = np.ascontiguousarray(bgr_x[::ss, ::ss]), np.ascontiguousarray(bgr_y[::ss, ::ss])
+                mask_x = depth_x[::ss, ::ss] == 0.
+                if mask_x.all():
+                    print('Object in Rendering not visible. Have you scaled the vertices to mm?')
+                    end = i
+                    break
+            else:
+                ys, xs = np.nonzero(depth_x > 0)
+
+                try:
+                    obj_bb = view_sampler.calc_2d_bbox(xs, ys, render_dims)
+                except ValueError as e:
+                    print('Object in Rendering not visible. Have you scaled the vertices to mm?')
+                    end = i
+                    break
 
-            # # Augment with random scaling
-            # random_scale = np.random.uniform(0.5, 1.5)
-            # obj_bb = np.array([obj_bb[0]-(random_scale*obj_bb[2]-obj_bb[2])*0.5,
-            #                    obj_bb[1]-(random_scale*obj_bb[3]-obj_bb[3])*0.5,
-            #                    obj_bb[2]*random_scale,
-            #                    obj_bb[3]*random_scale])
+                # # Augment with random scaling
+                # random_scale = np.random.uniform(0.5, 1.5)
+                # obj_bb = np.array([obj_bb[0]-(random_scale*obj_bb[2]-obj_bb[2])*0.5,
+                #                    obj_bb[1]-(random_scale*obj_bb[3]-obj_bb[3])*0.5,
+                #                    obj_bb[2]*random_scale,
+                #                    obj_bb[3]*random_scale])
 
-            x, y, w, h = obj_bb
+                x, y, w, h = obj_bb
 
-            rand_trans_x = np.random.uniform(-max_rel_offset, max_rel_offset) * w
-            rand_trans_y = np.random.uniform(-max_rel_offset, max_rel_offset) * h
+                rand_trans_x = np.random.uniform(-max_rel_offset, max_rel_offset) * w
+                rand_trans_y = np.random.uniform(-max_rel_offset, max_rel_offset) * h
 
-            obj_bb_off = obj_bb + np.array([rand_trans_x,rand_trans_y,0,0])
+                obj_bb_off = obj_bb + np.array([rand_trans_x,rand_trans_y,0,0])
 
-            bgr_x = self.extract_square_patch(bgr_x, obj_bb_off, pad_factor,resize=(W,H),interpolation = cv2.INTER_NEAREST)
-            depth_x = self.extract_square_patch(depth_x, obj_bb_off, pad_factor,resize=(W,H),interpolation = cv2.INTER_NEAREST)
-            mask_x = depth_x == 0.
+                bgr_x = self.extract_square_patch(bgr_x, obj_bb_off, pad_factor,resize=(W,H),interpolation = cv2.INTER_NEAREST)
+                depth_x = self.extract_square_patch(depth_x, obj_bb_off, pad_factor,resize=(W,H),interpolation = cv2.INTER_NEAREST)
+                mask_x = depth_x == 0.
 
 
-            ys, xs = np.nonzero(depth_y > 0)
-            obj_bb = view_sampler.calc_2d_bbox(xs, ys, render_dims)
+                ys, xs = np.nonzero(depth_y > 0)
+                obj_bb = view_sampler.calc_2d_bbox(xs, ys, render_dims)
 
-            # # Augment with random scaling
-            # obj_bb = np.array([obj_bb[0]-(random_scale*obj_bb[2]-obj_bb[2])*0.5,
-            #                    obj_bb[1]-(random_scale*obj_bb[3]-obj_bb[3])*0.5,
-            #                    obj_bb[2]*random_scale,
-            #                    obj_bb[3]*random_scale])
+                # # Augment with random scaling
+                # obj_bb = np.array([obj_bb[0]-(random_scale*obj_bb[2]-obj_bb[2])*0.5,
+                #                    obj_bb[1]-(random_scale*obj_bb[3]-obj_bb[3])*0.5,
+                #                    obj_bb[2]*random_scale,
+                #                    obj_bb[3]*random_scale])
 
-            bgr_y = self.extract_square_patch(bgr_y, obj_bb, pad_factor,resize=(W,H),interpolation = cv2.INTER_NEAREST)
+                bgr_y = self.extract_square_patch(bgr_y, obj_bb, pad_factor,resize=(W,H),interpolation = cv2.INTER_NEAREST)
 
             if self.shape[2] == 1:
                 bgr_x = cv2.cvtColor(np.uint8(bgr_x), cv2.COLOR_BGR2GRAY)[:,:,np.newaxis]
                 bgr_y = cv2.cvtColor(np.uint8(bgr_y), cv2.COLOR_BGR2GRAY)[:,:,np.newaxis]
 
             self.train_x[i] = bgr_x.astype(np.uint8)
-            self.mask_x[i] = mask_x
+            self.mask_x[i] = np.packbits(mask_x, axis=-1)
             self.train_y[i] = bgr_y.astype(np.uint8)
 
             #print 'rendertime ', render_time, 'processing ', time.time() - start_time
-        bar.finish()
+        if render_async is not None and pending is not None:
+            # the lookahead pair of an early break still holds readback buffers, result() releases them
+            for handle in pending:
+                handle.result()
+        if progress:
+            bar.finish()
+        return end
+
+    @property
+    def crop_rendering(self):
+        return eval(self._kw.get('crop_rendering', 'False'))
+
+    @property
+    def crop_supersampling(self):
+        return int(self._kw.get('crop_supersampling', 1))
+
+    @lazy_property
+    def model_vertices(self):
+        # the mesh vertices, loaded without OpenGL so crop rendering also runs with the numpy renderer
+        from auto_pose.meshrenderer.meshrenderer_numpy import load_mesh
+        vertices = load_mesh(self._kw['model_path'])[0]
+        return np.unique(vertices, axis=0) * float(self._kw['vertex_scale'])
+
+    def predicted_bbox(self, R, t, K, render_dims):
+        """2D box of the rendered object from the projected model vertices, as calc_2d_bbox
+        on the rendered depth would return it."""
+        P = np.dot(K, np.dot(R, self.model_vertices.T) + np.asarray(t).reshape(3,1))
+        u_, v_ = P[0] / P[2], P[1] / P[2]
+        # pixels whose centers are covered
+        xs = np.clip([np.ceil(u_.min() - 0.5), np.floor(u_.max() - 0.5)], 0, render_dims[0] - 1).astype(np.int64)
+        ys = np.clip([np.ceil(v_.min() - 0.5), np.floor(v_.max() - 0.5)], 0, render_dims[1] - 1).astype(np.int64)
+        return np.array(view_sampler.calc_2d_bbox(xs, ys, render_dims), dtype=np.float64)
+
+    def rendered_bbox(self, R, t, K, render_dims, clip_near, clip_far):
+        """2D box of the rendered object in the view_sampler.calc_2d_bbox convention of the full
+        path, from the renderer's bbox query (a GPU reduction with GL) instead of rendering and
+        reading back the full image. predicted_bbox without the query or a visible object."""
+        obj_bb = None
+        if hasattr(self.renderer, 'render_bbox'):
+            obj_bb = self.renderer.render_bbox(0, render_dims[0], render_dims[1], K, R, t, clip_near, clip_far)
+        if obj_bb is None:
+            return self.predicted_bbox(R, t, K, render_dims)
+        x, y, w, h = obj_bb
+        return np.array(view_sampler.calc_2d_bbox(np.array([x, x + w]), np.array([y, y + h]), render_dims), dtype=np.float64)
+
+    def crop_intrinsics(self, K, obj_bb, pad_factor, out_dims, render_dims):
+        """Intrinsics rendering the extract_square_patch window of obj_bb straight into
+        out_dims (W, H) pixels."""
+        x, y, w, h = np.array(obj_bb).astype(np.int32)
+        size = int(np.maximum(h, w) * pad_factor)
+        left = int(np.maximum(x+w/2-size/2, 0))
+        right = int(np.minimum(x+w/2+size/2, render_dims[0]))
+        top = int(np.maximum(y+h/2-size/2, 0))
+        bottom = int(np.minimum(y+h/2+size/2, render_dims[1]))
+        s_x, s_y = out_dims[0] / float(right - left), out_dims[1] / float(bottom - top)
+        return np.array([[K[0,0]*s_x, K[0,1]*s_x, (K[0,2] - left)*s_x],
+                         [0, K[1,1]*s_y, (K[1,2] - top)*s_y],
+                         [0, 0, 1]])
+
+    def _render_views(self, Rs, render_dims, Ks, t, clip_near, clip_far):
+        # yields (bgr, depth) per rotation and (N,3,3) intrinsics, batched into framebuffer
+        # atlases or pipelined where the renderer supports it
+        W, H = render_dims
+        if hasattr(self.renderer, 'render_batch'):
+            tiles = (self.renderer.MAX_FBO_WIDTH // W) * (self.renderer.MAX_FBO_HEIGHT // H)
+            for a, e in u.batch_iteration_indices(len(Rs), tiles):
+                bgrs, depths = self.renderer.render_batch([0]*(e-a), W, H, Ks[a:e], Rs[a:e], [t]*(e-a), clip_near, clip_far)
+                for view in zip(bgrs, depths):
+                    yield view
+        else:
+            # with render_async the next view is rendered while the caller crops this one
+            render = getattr(self.renderer, 'render_async', self.renderer.render)
+            pending = None
+            for R, K in zip(Rs, Ks):
+                view = render(
+                    obj_id=0,
+                    W=W,
+                    H=H,
+                    K=K.copy(),
+                    R=R,
+                    t=t,
+                    near=clip_near,
+                    far=clip_far,
+                    random_light=False
+                )
+                if pending is not None:
+                    yield pending.result() if hasattr(pending, 'result') else pending
+                pending = view
+            if pending is not None:
+                yield pending.result() if hasattr(pending, 'result') else pending
 
     def render_embedding_image_batch(self, start, end):
         kw = self._kw
@@ -335,18 +924,20 @@ class Dataset(object):
         batch = np.empty( (end-start,)+ self.shape)
         obj_bbs = np.empty( (end-start,)+ (4,))
 
-        for i, R in enumerate(self.viewsphere_for_embedding[start:end]):
-            bgr_y, depth_y = self.renderer.render(
-                obj_id=0,
-                W=render_dims[0],
-                H=render_dims[1],
-                K=K.copy(),
-                R=R,
-                t=t,
-                near=clip_near,
-                far=clip_far,
-                random_light=False
-            )
+        Rs = self.embedding_rotations[start:end]
+        if self.crop_rendering:
+            ss = self.crop_supersampling
+            obj_bbs[:] = [self.rendered_bbox(R, t, K, render_dims, clip_near, clip_far) for R in Rs]
+            Ks = [self.crop_intrinsics(K, obj_bb, pad_factor, (w*ss, h*ss), render_dims) for obj_bb in obj_bbs]
+            for i, (bgr_y, _) in enumerate(self._render_views(Rs, (w*ss, h*ss), Ks, t, clip_near, clip_far)):
+                bgr_y = np.ascontiguousarray(bgr_y[::ss, ::ss])
+                if self.shape[2] == 1:
+                    bgr_y = cv2.cvtColor(bgr_y, cv2.COLOR_BGR2GRAY)[:,:,np.newaxis]
+                batch[i] = bgr_y / 255.
+            return (batch, obj_bbs)
+
+        views = self._render_views(Rs, render_dims, [K]*len(Rs), t, clip_near, clip_far)
+        for i, (bgr_y, depth_y) in enumerate(views):
             # cv2.imshow('depth',depth_y)
             # cv2.imshow('bgr',bgr_y)
             # print depth_y.max()
@@ -386,11 +977,15 @@ class Dataset(object):
 
     @property
     def embedding_size(self):
-        return len(self.viewsphere_for_embedding)
+        return len(self.embedding_rotations)
 
 
     @lazy_property
     def _aug(self):
+        # [Augmentation] AUGMENTATION_ENGINE native runs the CODE string on the batched engine in
+        # augmentation.py, operators it lacks fall back to imgaug. Configs without it keep imgaug
+        if self._kw.get('augmentation_engine', 'imgaug') == 'native':
+            return augmentation.from_code(self._kw['code'])
         from imgaug.augmenters import Sequential,SomeOf,OneOf,Sometimes,WithColorspace,WithChannels, \
             Noop,Lambda,AssertLambda,AssertShape,Scale,CropAndPad, \
             Pad,Crop,Fliplr,Flipud,Superpixels,ChangeColorspace, PerspectiveTransform, \
@@ -401,89 +996,152 @@ class Dataset(object):
             ElasticTransformation
         return eval(self._kw['code'])
 
-    @lazy_property
-    def _aug_occl(self):
-        from imgaug.augmenters import Sequential,SomeOf,OneOf,Sometimes,WithColorspace,WithChannels, \
-            Noop,Lambda,AssertLambda,AssertShape,Scale,CropAndPad, \
-            Pad,Crop,Fliplr,Flipud,Superpixels,ChangeColorspace, PerspectiveTransform, \
-            Grayscale,GaussianBlur,AverageBlur,MedianBlur,Convolve, \
-            Sharpen,Emboss,EdgeDetect,DirectedEdgeDetect,Add,AddElementwise, \
-            AdditiveGaussianNoise,Multiply,MultiplyElementwise,Dropout, \
-            CoarseDropout,Invert,ContrastNormalization,Affine,PiecewiseAffine, \
-            ElasticTransformation
-        return Sequential([Sometimes(0.7, CoarseDropout( p=0.4, size_percent=0.01) )])
-
+    def unpack_masks(self, packed_masks):
+        # (N, H, ceil(W/8)) uint8 -> (N, H, W) bool
+        return np.unpackbits(packed_masks, axis=-1, count=self.shape[1]).view(bool)
 
     @lazy_property
     def random_syn_masks(self):
-        import bitarray
+        """Synthetic occlusion masks at the training resolution, bit-packed like mask_x.
+
+        The 224x224 source masks are resized once (nearest neighbour) and cached in
+        dataset_path.
+        """
         workspace_path = os.environ.get('AE_WORKSPACE_PATH')
+        masks_path = os.path.join(workspace_path,'random_tless_masks/arbitrary_syn_masks_1000.bin')
+        current_config_hash = hashlib.md5((masks_path + str(self.shape[:2])).encode('utf-8')).hexdigest()
+        current_file_name = os.path.join(self.dataset_path, current_config_hash + '_syn_masks.npy')
+        if os.path.exists(current_file_name):
+            return np.load(current_file_name)
+        if not os.path.exists(self.dataset_path):
+            os.makedirs(self.dataset_path)
 
-        random_syn_masks = bitarray.bitarray()
-        with open(os.path.join(workspace_path,'random_tless_masks/arbitrary_syn_masks_1000.bin'), 'r') as fh:
-            random_syn_masks.fromfile(fh)
-        occlusion_masks = np.fromstring(random_syn_masks.unpack(), dtype=np.bool)
-        occlusion_masks = occlusion_masks.reshape(-1,224,224,1).astype(np.float32)
+        # raw bits of a bitarray, big endian like np.unpackbits
+        bits = np.unpackbits(np.fromfile(masks_path, dtype=np.uint8))
+        occlusion_masks = bits[:len(bits) // (224*224) * 224*224].reshape(-1,224,224)
         print(occlusion_masks.shape)
 
-        occlusion_masks = np.array([cv2.resize(mask,(self.shape[0],self.shape[1]), interpolation = cv2.INTER_NEAREST) for mask in occlusion_masks])
+        # nearest neighbour sampling as cv2.INTER_NEAREST
+        h, w = self.shape[:2]
+        rows = np.floor(np.arange(h) * 224. / h).astype(np.int64)
+        cols = np.floor(np.arange(w) * 224. / w).astype(np.int64)
+        occlusion_masks = np.packbits(occlusion_masks[:, rows[:,np.newaxis], cols[np.newaxis,:]], axis=-1)
+        np.save(current_file_name, occlusion_masks)
         return occlusion_masks
 
 
-    def augment_occlusion_mask(self, masks, verbose=False, min_trans = 0.2, max_trans=0.7, max_occl = 0.25,min_occl = 0.0):
-
-
-        new_masks = np.zeros_like(masks,dtype=np.bool)
-        occl_masks_batch = self.random_syn_masks[np.random.choice(len(self.random_syn_masks),len(masks))]
-        for idx,mask in enumerate(masks):
-            occl_mask = occl_masks_batch[idx]
-            while True:
-                trans_x = int(np.random.choice([-1,1])*(np.random.rand()*(max_trans-min_trans) + min_trans)*occl_mask.shape[0])
-                trans_y = int(np.random.choice([-1,1])*(np.random.rand()*(max_trans-min_trans) + min_trans)*occl_mask.shape[1])
-                M = np.float32([[1,0,trans_x],[0,1,trans_y]])
+    def augment_occlusion_mask(self, masks, verbose=False, min_trans = 0.2, max_trans=0.7, max_occl = 0.25,min_occl = 0.0, candidates=8, max_rounds=8):
+        """Adds a randomly shifted synthetic occluder to every background mask.
+
+        For each mask `candidates` integer shifts are scored at once and the first
+        one occluding between min_occl and max_occl of the object is kept, which is
+        the rejection sampling of a single shift at a time. Masks without a valid
+        shift after max_rounds stay unoccluded.
+        """
+        N, h, w = masks.shape
+        new_masks = masks.copy()
+        obj_pixels = np.invert(masks)
+        noof_obj_pixels = np.count_nonzero(obj_pixels, axis=(1,2)).astype(np.float32)
+        occl_masks_batch = self.unpack_masks(self.random_syn_masks[np.random.choice(len(self.random_syn_masks),N)])
+
+        # windows[n, h-ty, w-tx] is occluder n shifted by (tx, ty), zero padded
+        padded = np.pad(occl_masks_batch, ((0,0),(h,h),(w,w)))
+        sN, sH, sW = padded.strides
+        windows = np.lib.stride_tricks.as_strided(padded, shape=(N, 2*h+1, 2*w+1, h, w),
+                                                  strides=(sN, sH, sW, sH, sW), writeable=False)
+
+        todo = np.where(noof_obj_pixels > 0)[0]
+        for _ in range(max_rounds):
+            if len(todo) == 0:
+                break
+            shape = (len(todo), candidates)
+            trans_x = np.trunc(np.random.choice([-1,1], shape)*(np.random.rand(*shape)*(max_trans-min_trans) + min_trans)*w).astype(np.int64)
+            trans_y = np.trunc(np.random.choice([-1,1], shape)*(np.random.rand(*shape)*(max_trans-min_trans) + min_trans)*h).astype(np.int64)
+
+            shifted = windows[todo[:,np.newaxis], h - trans_y, w - trans_x]
+            overlap_matrix = shifted & obj_pixels[todo][:,np.newaxis]
+            overlap = np.count_nonzero(overlap_matrix, axis=(2,3)) / noof_obj_pixels[todo][:,np.newaxis]
+
+            accepted = (overlap < max_occl) & (overlap > min_occl)
+            found = accepted.any(axis=1)
+            first = np.argmax(accepted, axis=1)
+            idcs = np.where(found)[0]
+            new_masks[todo[idcs]] |= overlap_matrix[idcs, first[idcs]]
+            if verbose:
+                print('overlap is ', overlap[idcs, first[idcs]])
+            todo = todo[~found]
 
-                transl_occl_mask = cv2.warpAffine(occl_mask,M,(occl_mask.shape[0],occl_mask.shape[1]))
+        return new_masks
 
-                overlap_matrix = np.invert(mask.astype(np.bool)) * transl_occl_mask.astype(np.bool)
-                overlap = len(overlap_matrix[overlap_matrix==True])/float(len(mask[mask==0]))
+    def augment_squares(self, masks, noof_obj_pixels, max_occl=0.25, p=0.4, grid=4, apply_prob=0.7, candidates=16):
+        """Coarse square dropout of the objects, Sometimes(0.7, CoarseDropout(p=0.4, size_percent=0.01)).
+
+        The object pixels are split into grid x grid cells (imgaug's minimum coarse mask
+        size), every candidate drops each cell with probability p. The first candidate
+        keeping at least 1-max_occl of noof_obj_pixels, the object pixels of the
+        unoccluded masks, is applied, masks without one
+        keep their object.
+        """
+        N, h, w = masks.shape
+        rows = np.floor(np.arange(h) * grid / float(h)).astype(np.int64)
+        cols = np.floor(np.arange(w) * grid / float(w)).astype(np.int64)
+        cell_idcs = (rows[:,np.newaxis]*grid + cols[np.newaxis,:]).ravel()
+
+        obj_pixels = np.invert(masks).reshape(N, -1)
+        # object pixels per cell, (N, grid*grid)
+        cell_counts = np.bincount((np.arange(N)[:,np.newaxis]*grid*grid + cell_idcs).ravel(),
+                                  weights=obj_pixels.ravel(), minlength=N*grid*grid).reshape(N, grid*grid)
+
+        drop = np.random.rand(N, candidates, grid*grid) < p
+        drop &= (np.random.rand(N, candidates) < apply_prob)[...,np.newaxis]
+        kept = cell_counts.sum(axis=1)[:,np.newaxis] - np.einsum('nkc,nc->nk', drop, cell_counts)
+        accepted = kept / noof_obj_pixels[:,np.newaxis].astype(np.float32) >= 1-max_occl
+
+        found = accepted.any(axis=1)
+        choice = drop[np.arange(N), np.argmax(accepted, axis=1)] & found[:,np.newaxis]
+        return masks | choice[:, cell_idcs].reshape(N, h, w)
+
+    def reseed(self, seed):
+        # fresh random streams for forked batch producers, they inherit the parent state
+        np.random.seed(seed)
+        if self._kw.get('augmentation_engine', 'imgaug') != 'native':
+            import imgaug
+            imgaug.seed(seed)
+        self._aug.reseed(seed)
 
-                if overlap < max_occl and overlap > min_occl:
-                    new_masks[idx,...] = np.logical_xor(mask.astype(np.bool), overlap_matrix)
-                    if verbose:
-                        print('overlap is ', overlap)
-                    break
+    def batch(self, batch_size):
+        batch_x, batch_y = self.batch_uint8(batch_size)
 
-        return new_masks
-    def augment_squares(self,masks,rand_idcs,max_occl=0.25):
-        new_masks = np.invert(masks)
+        #slow...
+        batch_x = batch_x / 255.
+        batch_y = batch_y / 255.
 
-        idcs = np.arange(len(masks))
-        while len(idcs) > 0:
-            new_masks[idcs] = self._aug_occl.augment_images(np.invert(masks[idcs]))
-            new_noof_obj_pixels = np.count_nonzero(new_masks,axis=(1,2))
-            idcs = np.where(new_noof_obj_pixels/self.noof_obj_pixels[rand_idcs].astype(np.float32) < 1-max_occl)[0]
-            print(idcs)
-        return np.invert(new_masks)
+        return (batch_x, batch_y)
 
-    def batch(self, batch_size):
+    def batch_uint8(self, batch_size):
 
         # batch_x = np.empty( (batch_size,) + self.shape, dtype=np.uint8 )
         # batch_y = np.empty( (batch_size,) + self.shape, dtype=np.uint8 )
 
-        rand_idcs = np.random.choice(self.noof_training_imgs, batch_size, replace=False)
+        if self._stream is not None:
+            batch_x, masks, batch_y, noof_obj_pixels = self._stream_batch(batch_size)
+        else:
+            rand_idcs = np.random.choice(self.noof_training_imgs, batch_size, replace=False)
+            batch_x, masks, batch_y = self.train_x[rand_idcs], self.mask_x[rand_idcs], self.train_y[rand_idcs]
+            noof_obj_pixels = self.noof_obj_pixels[rand_idcs]
+        masks = self.unpack_masks(masks)
 
         assert self.noof_bg_imgs > 0
 
         rand_idcs_bg = np.random.choice(self.noof_bg_imgs, batch_size, replace=False)
 
-        batch_x, masks, batch_y = self.train_x[rand_idcs], self.mask_x[rand_idcs], self.train_y[rand_idcs]
-        rand_vocs = self.bg_imgs[rand_idcs_bg]
+        rand_vocs = self.bg_crops(rand_idcs_bg)
 
         if eval(self._kw['realistic_occlusion']):
             masks = self.augment_occlusion_mask(masks.copy(),max_occl=np.float(self._kw['realistic_occlusion']))
 
         if eval(self._kw['square_occlusion']):
-            masks = self.augment_squares(masks.copy(),rand_idcs,max_occl=np.float(self._kw['square_occlusion']))
+            masks = self.augment_squares(masks.copy(),noof_obj_pixels,max_occl=np.float(self._kw['square_occlusion']))
 
         batch_x[masks] = rand_vocs[masks]
 
@@ -499,9 +1157,4 @@ class Dataset(object):
         #needs uint8
         batch_x = self._aug.augment_images(batch_x)
 
-        #slow...
-        batch_x = batch_x / 255.
-        batch_y = batch_y / 255.
-
-
         return (batch_x, batch_y)
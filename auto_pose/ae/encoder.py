@@ -15,8 +15,11 @@ class Encoder(object):
         self._strides = strides
         self._batch_normalization = batch_norm
         self._is_training = is_training
+        n_variables = len(tf.global_variables())
         self.encoder_out
         self.z
+        # conv stack and z weights in creation order, see numpy_encoder.export_encoder
+        self.variables = tf.global_variables()[n_variables:]
         # self.q_sigma
         # self.sampled_z
         # self.reg_loss
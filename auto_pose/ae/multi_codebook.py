@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+import tensorflow as tf
+
+from . import codebook_index
+
+TF_PRECISIONS = {'float32': tf.float32, 'float16': tf.float16, 'int8': tf.int8}
+
+
+def _precision(embedding):
+    if isinstance(embedding, codebook_index.QuantizedEmbedding):
+        return embedding.precision
+    return 'float32'
+
+
+class MultiCodebook(object):
+    """Codebooks of several objects fused into one block-indexed embedding matrix.
+
+    Only codebooks opened with Codebook.load (factory.load_codebook_from_name) are
+    fused, their embeddings are not graph variables already. The fused matrix keeps
+    their stored precision, float32 if they differ, and is dequantized in the graph.
+    Entries of the i-th fused codebook live in rows offsets[i]:offsets[i+1]. The crops
+    of a frame are encoded by the encoders of their objects and matched in one
+    session.run with a single similarity matmul, entries of other objects are masked
+    before the top_n selection. Codebooks with a search index are not fused, their
+    queries are computed in the same session.run and searched with the index.
+    """
+
+    def __init__(self, codebooks):
+        for codebook in codebooks:
+            assert codebook.embedding_values is not None, \
+                'MultiCodebook fuses exported codebooks, open them with factory.load_codebook_from_name'
+        self._codebooks = codebooks
+        self._fused = [i for i, codebook in enumerate(codebooks) if codebook.index is None]
+        # block of every codebook in the fused matrix, -1 if searched with its index
+        self._blocks = -np.ones(len(codebooks), dtype=np.int32)
+        self._blocks[self._fused] = np.arange(len(self._fused))
+        if len(self._fused) == 0:
+            return
+
+        fused = [codebooks[i] for i in self._fused]
+        sizes = [len(codebook.embedding_values) for codebook in fused]
+        self.offsets = np.cumsum([0] + sizes)
+        total = int(self.offsets[-1])
+        J = fused[0]._encoder.latent_space_size
+
+        precisions = set(_precision(codebook.embedding_values) for codebook in fused)
+        self.precision = precisions.pop() if len(precisions) == 1 else 'float32'
+        dtype = TF_PRECISIONS[self.precision]
+        self.embedding_values = tf.Variable(
+            tf.zeros([total, J], dtype=dtype),
+            trainable=False,
+            name='multi_embedding_values'
+        )
+        self.embedding = tf.placeholder(dtype, shape=[total, J])
+        assign_ops = [tf.assign(self.embedding_values, self.embedding)]
+        embedding_normalized = tf.cast(self.embedding_values, tf.float32)
+
+        self.class_idcs = tf.placeholder(tf.int32, shape=[None])
+        self.top_n = tf.placeholder(tf.int32, shape=[])
+        self.upright = tf.placeholder_with_default(False, shape=[])
+
+        # queries are fed grouped by object, in the order of class_idcs
+        query = tf.concat([codebook.normalized_embedding_query for codebook in fused], axis=0)
+        self.cos_similarity = tf.matmul(query, embedding_normalized, transpose_b=True)
+        if self.precision == 'int8':
+            # one scale per row, applied to the similarity columns
+            self.embedding_scales = tf.Variable(tf.ones([total]), trainable=False, name='multi_embedding_scales')
+            self.scales = tf.placeholder(tf.float32, shape=[total])
+            assign_ops.append(tf.assign(self.embedding_scales, self.scales))
+            self.cos_similarity = self.cos_similarity * self.embedding_scales[tf.newaxis,:]
+        self.embedding_assign_op = tf.group(*assign_ops)
+
+        starts = tf.gather(tf.constant(self.offsets[:-1], dtype=tf.int32), self.class_idcs)
+        block_sizes = tf.gather(tf.constant(sizes, dtype=tf.int32), self.class_idcs)
+
+        local_idcs = tf.range(total)[tf.newaxis,:] - starts[:,tf.newaxis]
+        valid = tf.logical_and(local_idcs >= 0, local_idcs < block_sizes[:,tf.newaxis])
+        upright_rows = np.zeros(total, dtype=bool)
+        for offset, codebook in zip(self.offsets, fused):
+            upright_rows[offset + codebook.upright_rows] = True
+        in_plane_zero = tf.constant(upright_rows)[tf.newaxis,:]
+        valid = tf.logical_and(valid, tf.logical_or(tf.logical_not(self.upright), in_plane_zero))
+
+        masked_similarity = tf.where(valid, self.cos_similarity, tf.fill(tf.shape(self.cos_similarity), -np.inf))
+        _, self.nearest_neighbor_idcs = tf.nn.top_k(masked_similarity, k=self.top_n)
+
+    def initialize(self, session):
+        """Copies the object codebooks into the fused matrix, call after restoring the checkpoints."""
+        if len(self._fused) == 0:
+            return
+        embeddings = [self._codebooks[i].embedding_values for i in self._fused]
+        if self.precision == 'float32':
+            feed_dict = {self.embedding: np.concatenate([codebook_index.as_float32(e) for e in embeddings])}
+        else:
+            # the stored values, no float32 copy of the codebooks
+            feed_dict = {self.embedding: np.concatenate([e.values for e in embeddings])}
+            if self.precision == 'int8':
+                feed_dict[self.scales] = np.concatenate([e.scales for e in embeddings])
+        session.run(self.embedding_assign_op, feed_dict)
+
+    def nearest_idcs(self, session, x, class_idcs, top_n, upright=False):
+        """(N,top_n) indices of the nearest entries in the codebook of every crop, see
+        auto_pose6d_batch for the arguments."""
+        N = len(x)
+        class_idcs = np.asarray(class_idcs, dtype=np.int32)
+        order = np.argsort(class_idcs, kind='stable')
+
+        def crops(i):
+            rows = order[class_idcs[order] == i]
+            if len(rows) == 0:
+                return np.empty([0] + self._codebooks[i]._encoder.x.get_shape().as_list()[1:])
+            crops = np.array([x[j] for j in rows])
+            return crops/255. if crops.dtype == 'uint8' else crops
+
+        fetches, feed_dict = {}, {}
+        fused_order = order[self._blocks[class_idcs[order]] >= 0]
+        if len(fused_order) > 0:
+            fetches['fused'] = self.nearest_neighbor_idcs
+            feed_dict.update({self.class_idcs: self._blocks[class_idcs[fused_order]], self.top_n: top_n, self.upright: upright})
+            for i in self._fused:
+                feed_dict[self._codebooks[i]._encoder.x] = crops(i)
+        indexed = [i for i in np.unique(class_idcs) if self._blocks[i] < 0]
+        for i in indexed:
+            fetches[i] = self._codebooks[i].normalized_embedding_query
+            feed_dict[self._codebooks[i]._encoder.x] = crops(i)
+        results = session.run(fetches, feed_dict)
+
+        idcs = np.empty((N, top_n), dtype=np.int64)
+        if len(fused_order) > 0:
+            idcs[fused_order] = results['fused'] - self.offsets[self._blocks[class_idcs[fused_order]]][:,np.newaxis]
+        for i in indexed:
+            codebook = self._codebooks[i]
+            if upright:
+                local_idcs = codebook._top_n_idcs(codebook_index.similarity(codebook.embedding_values, results[i]), top_n, upright=True)
+            else:
+                _, local_idcs = codebook.index.search(results[i], top_n)
+            idcs[order[class_idcs[order] == i]] = local_idcs
+        return idcs
+
+    def auto_pose6d_batch(self, session, x, class_idcs, predicted_bbs, K_test, top_n, all_train_args, upright=False):
+        """6D poses of the crops of all objects in one session.run.
+
+        x: list of N crops, each sized for the encoder of its object
+        class_idcs: (N,) index of the codebook each crop is matched against
+        predicted_bbs: (N,4) xywh boxes, K_test: (N,3,3) or a single (3,3) camera matrix
+        all_train_args: training configs of the codebooks, entries may be None for
+        codebooks opened with Codebook.load
+        Returns Rs_est (N,top_n,3,3) and ts_est (N,top_n,3).
+        """
+        N = len(x)
+        class_idcs = np.asarray(class_idcs, dtype=np.int32)
+        idcs = self.nearest_idcs(session, x, class_idcs, top_n, upright=upright)
+
+        K_tests = np.asarray(K_test, dtype=np.float64).reshape(-1,3,3)
+        if len(K_tests) == 1:
+            K_tests = np.repeat(K_tests, N, axis=0)
+        predicted_bbs = np.asarray(predicted_bbs, dtype=np.float64).reshape(N,4)
+
+        Rs_est = np.empty((N, top_n, 3, 3))
+        ts_est = np.empty((N, top_n, 3))
+        for i in np.unique(class_idcs):
+            rows = np.where(class_idcs == i)[0]
+            Rs_est[rows], ts_est[rows] = self._codebooks[i].poses_from_idcs(
+                session, idcs[rows], predicted_bbs[rows], K_tests[rows], all_train_args[i])
+        return (Rs_est, ts_est)
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import numpy as np
+
+ENCODER_FORMAT_VERSION = 1
+
+
+def export_encoder(session, encoder, path):
+    """Dumps the encoder weights (conv stack, batch norm statistics and the dense z
+    layer) to one flat float32 array encoder_weights.npy plus the layout in
+    encoder.json, which NumpyEncoder.load reads without TensorFlow."""
+    if not os.path.exists(path):
+        os.makedirs(path)
+
+    values = session.run(encoder.variables)
+    layout = []
+    offset = 0
+    for variable, value in zip(encoder.variables, values):
+        # strip the experiment scope and the :0 suffix, e.g. conv2d_1/kernel
+        name = '/'.join(variable.name.split(':')[0].split('/')[-2:])
+        layout.append({'name': name, 'shape': list(value.shape), 'offset': offset})
+        offset += value.size
+    flat = np.concatenate([np.asarray(value, dtype=np.float32).ravel() for value in values])
+    np.save(os.path.join(path, 'encoder_weights.npy'), flat)
+
+    meta = {
+        'version': ENCODER_FORMAT_VERSION,
+        'input_shape': encoder.x.get_shape().as_list()[1:],
+        'latent_space_size': encoder.latent_space_size,
+        'strides': list(encoder._strides),
+        'batch_norm': bool(encoder._batch_normalization),
+        'variables': layout
+    }
+    with open(os.path.join(path, 'encoder.json'), 'w') as f:
+        json.dump(meta, f, indent=2)
+
+
+def same_padding(size, kernel_size, stride):
+    # TensorFlow 'same' padding, the odd pixel goes to the end
+    out_size = -(-size // stride)
+    total = max((out_size - 1)*stride + kernel_size - size, 0)
+    return total // 2, total - total // 2
+
+
+def conv2d_same(x, kernel, bias, stride):
+    """NHWC convolution with TensorFlow 'same' padding as one im2col matmul.
+
+    kernel: (kh, kw, c_in, c_out) as stored by tf.layers.conv2d
+    """
+    N, H, W, C = x.shape
+    kh, kw, _, c_out = kernel.shape
+    pad_h, pad_w = same_padding(H, kh, stride), same_padding(W, kw, stride)
+    x = np.pad(x, ((0, 0), pad_h, pad_w, (0, 0)))
+    out_h, out_w = (x.shape[1] - kh) // stride + 1, (x.shape[2] - kw) // stride + 1
+
+    sN, sH, sW, sC = x.strides
+    patches = np.lib.stride_tricks.as_strided(
+        x,
+        shape=(N, out_h, out_w, kh, kw, C),
+        strides=(sN, stride*sH, stride*sW, sH, sW, sC),
+        writeable=False
+    )
+    cols = patches.reshape(N*out_h*out_w, kh*kw*C)
+    out = np.dot(cols, kernel.reshape(kh*kw*C, c_out))
+    out += bias
+    return out.reshape(N, out_h, out_w, c_out)
+
+
+class NumpyEncoder(object):
+    """Inference-only AAE encoder on NumPy/BLAS, weights from export_encoder.
+
+    max_batch bounds the number of crops per im2col buffer, the second layer of a
+    128x128 encoder alone needs about 13MB of columns per crop.
+    """
+
+    def __init__(self, weights, meta, max_batch=8):
+        self.input_shape = tuple(meta['input_shape'])
+        self.latent_space_size = meta['latent_space_size']
+        self.max_batch = max_batch
+
+        # variables in creation order: kernel, bias [, gamma, beta, moving_mean, moving_variance]
+        # per conv layer, then kernel and bias of the dense z layer
+        params = []
+        for variable in meta['variables']:
+            size = int(np.prod(variable['shape']))
+            value = weights[variable['offset']:variable['offset']+size].reshape(variable['shape'])
+            params.append(np.asarray(value, dtype=np.float32))
+
+        self.layers = []
+        i = 0
+        for stride in meta['strides']:
+            layer = {'kernel': params[i], 'bias': params[i+1], 'stride': stride}
+            i += 2
+            if meta['batch_norm']:
+                gamma, beta, mean, variance = [params[i+j] for j in range(4)]
+                # inference batch norm of tf.layers.batch_normalization, epsilon 1e-3
+                layer['bn_scale'] = gamma / np.sqrt(variance + 1e-3)
+                layer['bn_shift'] = beta - mean*layer['bn_scale']
+                i += 4
+            self.layers.append(layer)
+        self.dense_kernel = params[i]
+        self.dense_bias = params[i+1]
+
+    @classmethod
+    def load(cls, path, max_batch=8):
+        with open(os.path.join(path, 'encoder.json'), 'r') as f:
+            meta = json.load(f)
+        if meta['version'] != ENCODER_FORMAT_VERSION:
+            raise ValueError('Unsupported encoder format version {} in {} (expected {})'.format(
+                meta['version'], path, ENCODER_FORMAT_VERSION))
+        weights = np.load(os.path.join(path, 'encoder_weights.npy'), mmap_mode='r')
+        return cls(weights, meta, max_batch=max_batch)
+
+    def _z(self, x):
+        for layer in self.layers:
+            x = conv2d_same(x, layer['kernel'], layer['bias'], layer['stride'])
+            np.maximum(x, 0., out=x)
+            if 'bn_scale' in layer:
+                x = x*layer['bn_scale'] + layer['bn_shift']
+        return np.dot(x.reshape(len(x), -1), self.dense_kernel) + self.dense_bias
+
+    def z(self, x):
+        """Latent codes of crops (N,H,W,C), uint8 or floats in [0,1]."""
+        x = np.asarray(x)
+        if x.dtype == 'uint8':
+            x = x/255.
+        x = x.astype(np.float32).reshape((-1,) + self.input_shape)
+        return np.concatenate([self._z(x[a:a+self.max_batch]) for a in range(0, len(x), self.max_batch)])
+
+    def normalized_z(self, x):
+        z = self.z(x)
+        return z / np.linalg.norm(z, axis=1, keepdims=True)
@@ -1,7 +1,12 @@
 # -*- coding: utf-8 -*-
 
 import threading
+import multiprocessing
+import ctypes
+import signal
+from queue import Empty
 
+import numpy as np
 import tensorflow as tf
 
 from .utils import lazy_property
@@ -15,18 +20,21 @@ class Queue(object):
         self._queue_size = queue_size
         self._batch_size = batch_size
 
-        datatypes = 2*['float32']
+        datatypes = 2*['uint8']
         shapes = 2*[self._dataset.shape]
 
         batch_shape = [None]+list(self._dataset.shape)
 
         self._placeholders = 2*[
-            tf.placeholder(dtype=tf.float32, shape=batch_shape),
-            tf.placeholder(dtype=tf.float32, shape=batch_shape)
+            tf.placeholder(dtype=tf.uint8, shape=batch_shape),
+            tf.placeholder(dtype=tf.uint8, shape=batch_shape)
         ]
 
+        # batches travel as uint8, scaled to [0,1] on the device
         self._queue = tf.FIFOQueue(self._queue_size, datatypes, shapes=shapes)
-        self.x, self.y = self._queue.dequeue_up_to(self._batch_size)
+        x, y = self._queue.dequeue_up_to(self._batch_size)
+        self.x = tf.cast(x, tf.float32) / 255.
+        self.y = tf.cast(y, tf.float32) / 255.
         self.enqueue_op = self._queue.enqueue_many(self._placeholders)
 
         self._coordinator = tf.train.Coordinator()
@@ -58,7 +66,7 @@ class Queue(object):
         while not self._coordinator.should_stop():
             # a= time.time()
             # print 'batching...'
-            batch = self._dataset.batch(self._batch_size)
+            batch = self._dataset.batch_uint8(self._batch_size)
             # print 'batch creation time ', time.time()-a
 
             feed_dict = { k:v for k,v in zip( self._placeholders, batch ) }
@@ -68,3 +76,87 @@ class Queue(object):
             except tf.errors.CancelledError as e:
                 print('worker was cancelled')
                 pass
+
+
+class ProcessQueue(Queue):
+    """Queue fed by forked worker processes instead of threads.
+
+    Workers write uint8 batches into the slots of one shared memory buffer and only
+    pass slot indices through multiprocessing queues. A feeder thread enqueues the
+    filled slots into the graph and hands the slots back.
+    """
+
+    def __init__(self, dataset, num_processes, queue_size, batch_size, num_slots=None):
+        Queue.__init__(self, dataset, 1, queue_size, batch_size)
+        self._num_processes = num_processes
+        self._num_slots = num_slots if num_slots is not None else 2*num_processes
+        self._slots_shape = (self._num_slots, 2, batch_size) + tuple(dataset.shape)
+        self._context = multiprocessing.get_context('fork')
+        self._buffer = self._context.RawArray(ctypes.c_uint8, int(np.prod(self._slots_shape)))
+        self._stop_event = self._context.Event()
+        self._processes = []
+
+    @property
+    def _slots(self):
+        return np.frombuffer(self._buffer, dtype=np.uint8).reshape(self._slots_shape)
+
+    def start(self, session):
+        assert len(self._threads) == 0 and len(self._processes) == 0
+        self._stop_event.clear()
+        self._free = self._context.Queue()
+        self._full = self._context.Queue()
+        for slot in range(self._num_slots):
+            self._free.put(slot)
+
+        for seed in np.random.randint(0, 2**31 - 1, size=self._num_processes):
+            process = self._context.Process(target=ProcessQueue.__produce__, args=(self, int(seed)))
+            process.daemon = True
+            process.start()
+            self._processes.append(process)
+
+        tf.train.start_queue_runners(session, self._coordinator)
+        thread = threading.Thread(target=ProcessQueue.__run__, args=(self, session))
+        thread.daemon = True
+        thread.start()
+        self._threads.append(thread)
+
+    def stop(self, session):
+        self._stop_event.set()
+        Queue.stop(self, session)
+        for process in self._processes:
+            process.join(timeout=5.)
+            if process.is_alive():
+                process.terminate()
+        self._processes[:] = []
+
+    def __produce__(self, seed):
+        import cv2
+        # Ctrl-C is handled by the training process, OpenCV threads do not survive fork
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        cv2.setNumThreads(0)
+        self._full.cancel_join_thread()
+        self._dataset.reseed(seed)
+        slots = self._slots
+        while not self._stop_event.is_set():
+            try:
+                slot = self._free.get(timeout=0.1)
+            except Empty:
+                continue
+            slots[slot,0], slots[slot,1] = self._dataset.batch_uint8(self._batch_size)
+            self._full.put(slot)
+
+    def __run__(self, session):
+        slots = self._slots
+        while not self._coordinator.should_stop():
+            try:
+                slot = self._full.get(timeout=0.1)
+            except Empty:
+                continue
+            feed_dict = {self._placeholders[0]: slots[slot,0], self._placeholders[1]: slots[slot,1]}
+            try:
+                session.run(self.enqueue_op, feed_dict)
+            except tf.errors.CancelledError as e:
+                print('worker was cancelled')
+                pass
+            # the slot is fed without a copy, reuse it only after the enqueue
+            self._free.put(slot)
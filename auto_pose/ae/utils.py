@@ -64,6 +64,12 @@ def get_checkpoint_basefilename(log_dir):
         'chkpt'
     )
 
+def get_codebook_path(log_dir):
+    return os.path.join(
+        log_dir,
+        'codebook'
+    )
+
 def get_config_file_path(workspace_path, experiment_name, experiment_group=''):
     return os.path.join(
         workspace_path,
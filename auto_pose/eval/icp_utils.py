@@ -196,7 +196,8 @@ class SynRenderer(object):
         # renderer = meshrenderer.Renderer(['/net/rmc-lx0050/home_local/sund_ma/data/SLC_precise_blue.ply'],1,'.',1)
         # R = transform.random_rotation_matrix()[:3,:3]
         W_test,H_test = test_shape[:2]
-        _, depth_x = self.renderer.render(
+        # depth-only pass, the shading is not needed for the point cloud
+        depth_x = self.renderer.render_depth(
                         obj_id=0,
                         W=W_test,
                         H=H_test,
@@ -204,8 +205,7 @@ class SynRenderer(object):
                         R=R_est,
                         t=np.array([0,0,t_est[2]]),
                         near=10,
-                        far=10000,
-                        random_light=False
+                        far=10000
                     )
         # import cv2
         # cv2.imshow('bgr_x',bgr_x)
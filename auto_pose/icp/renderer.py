@@ -36,7 +36,8 @@ class SynRenderer(object):
         # R = transform.random_rotation_matrix()[:3,:3]
         W_test, H_test = test_shape[:2]
 
-        _, depth_x = self.renderer.render(
+        # depth-only pass, the shading is not needed for the point cloud
+        depth_x = self.renderer.render_depth(
                         obj_id=clas_idx,
                         W=W_test,
                         H=H_test,
@@ -44,8 +45,7 @@ class SynRenderer(object):
                         R=R_est,
                         t=np.array([0,0,t_est[2]]), #TODO use t_est because R is corrected now!!!
                         near=10,
-                        far=10000,
-                        random_light=False
+                        far=10000
                     )
 
         pts = misc.rgbd_to_point_cloud(K_test,depth_x)[0]
@@ -17,6 +17,8 @@ from .vao import VAO
 from .ibo import IBO
 from .ebo import EBO
 from .camera import Camera
+from .pbo import PixelPackBuffer, AsyncReadback
+from .depth_pass import DepthPass
 from .window import Window
 from .material import Material
 from . import geometry as geo
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+
+from OpenGL.GL import *
+
+from .fbo import Framebuffer
+from .renderbuffer import Renderbuffer
+from .texture import Texture
+from .shader import Shader
+from .shader_storage_buffer import ShaderStorage
+
+class DepthPass(object):
+    """Depth-only and bounding box passes over the positions (attribute 0) of the bound
+    VAO, with the camera of the bound scene buffer (binding 0).
+
+    render_depth draws with a shader that only writes the view depth into one R32F
+    attachment. render_bbox draws without depth test or color writes, the fragment shader
+    reduces the covered pixels to their min/max with atomics, only 16 bytes are read back.
+    draw() issues the draw call of the object, both passes restore the framebuffer and
+    shader bound before.
+    """
+
+    def __init__(self, max_W, max_H, bbox_binding=1):
+        self._fbo = Framebuffer( { GL_COLOR_ATTACHMENT0: Texture(GL_TEXTURE_2D, 1, GL_R32F, max_W, max_H),
+                                   GL_DEPTH_ATTACHMENT: Renderbuffer(GL_DEPTH_COMPONENT32F, max_W, max_H) } )
+        self._depth_shader = Shader('depth_only.vs', 'depth_only.frag')
+        self._depth_shader.compile()
+        self._bbox_shader = Shader('depth_only.vs', 'bbox.frag')
+        self._bbox_shader.compile()
+        self._bbox_reset = np.array([np.iinfo(np.int32).max, np.iinfo(np.int32).max, -1, -1], dtype=np.int32)
+        self._bbox_buffer = ShaderStorage(bbox_binding, self._bbox_reset, True)
+
+    def _bind(self, shader):
+        previous = (glGetIntegerv(GL_DRAW_FRAMEBUFFER_BINDING), glGetIntegerv(GL_CURRENT_PROGRAM))
+        self._fbo.bind()
+        glUseProgram(shader.id)
+        return previous
+
+    def _restore(self, previous):
+        fbo, program = previous
+        glBindFramebuffer(GL_FRAMEBUFFER, fbo)
+        glUseProgram(program)
+
+    def render_depth(self, draw, W, H):
+        previous = self._bind(self._depth_shader)
+        glViewport(0, 0, W, H)
+        glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
+        draw()
+        glNamedFramebufferReadBuffer(self._fbo.id, GL_COLOR_ATTACHMENT0)
+        depth = np.flipud(glReadPixels(0, 0, W, H, GL_RED, GL_FLOAT).reshape(H,W)).copy()
+        self._restore(previous)
+        return depth
+
+    def render_bbox(self, draw, W, H):
+        """[x, y, w, h] of the covered pixels as misc.calc_2d_bbox of depth > 0, None if nothing is covered."""
+        previous = self._bind(self._bbox_shader)
+        self._bbox_buffer.update(self._bbox_reset)
+        self._bbox_buffer.bind()
+        glViewport(0, 0, W, H)
+        glDisable(GL_DEPTH_TEST)
+        glColorMask(GL_FALSE, GL_FALSE, GL_FALSE, GL_FALSE)
+        draw()
+        glColorMask(GL_TRUE, GL_TRUE, GL_TRUE, GL_TRUE)
+        glEnable(GL_DEPTH_TEST)
+        glMemoryBarrier(GL_BUFFER_UPDATE_BARRIER_BIT)
+        x_min, y_min, x_max, y_max = self._bbox_buffer.get(np.empty(4, dtype=np.int32))
+        self._restore(previous)
+        if x_max < 0:
+            return None
+        # GL rows count from the bottom
+        return [int(x_min), int(H - 1 - y_max), int(x_max - x_min), int(y_max - y_min)]
+
+    def delete(self):
+        self._fbo.delete()
+        self._depth_shader.delete()
+        self._bbox_shader.delete()
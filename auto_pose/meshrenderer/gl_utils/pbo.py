@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+import collections
+import numpy as np
+
+from OpenGL.GL import *
+# the raw entry point takes a byte offset into the bound pixel pack buffer
+from OpenGL.raw.GL.VERSION.GL_1_0 import glReadPixels as glReadPixelsOffset
+
+class PixelPackBuffer(object):
+
+    def __init__(self, nbytes):
+        self.__id = np.empty(1, dtype=np.uint32)
+        glCreateBuffers(len(self.__id), self.__id)
+        glNamedBufferStorage(self.__id[0], nbytes, None, GL_DYNAMIC_STORAGE_BIT | GL_MAP_READ_BIT | GL_CLIENT_STORAGE_BIT)
+
+    def read_pixels(self, W, H, format, type):
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, self.__id[0])
+        # rows tightly packed as get() reads them back, e.g. odd widths of RGB8
+        glPixelStorei(GL_PACK_ALIGNMENT, 1)
+        glReadPixelsOffset(0, 0, W, H, format, type, ctypes.c_void_p(0))
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+
+    def get(self, out):
+        glGetNamedBufferSubData(self.__id[0], 0, out.nbytes, out)
+        return out
+
+    def delete(self):
+        glDeleteBuffers(1, self.__id)
+
+    @property
+    def id(self):
+        return self.__id[0]
+
+
+class ReadbackHandle(object):
+
+    def __init__(self, readback, slot, W, H, fence):
+        self._readback = readback
+        self._slot = slot
+        self._W, self._H = W, H
+        self._fence = fence
+        self._result = None
+
+    def done(self):
+        return self._result is not None
+
+    def result(self):
+        """The read attachments as flipped (H,W[,C]) arrays, waits for the GPU if needed."""
+        if self._result is None:
+            self._readback._fetch(self)
+        return self._result
+
+
+class AsyncReadback(object):
+    """Ring of pixel pack buffers for non-blocking framebuffer readback.
+
+    reads: (attachment, format, type, channels, dtype) per read attachment
+    read() queues copies of the attachments into the next free buffer and returns a
+    handle, the data is only copied to the CPU by handle.result(). When all
+    num_buffers are in use the oldest pending handle is resolved first.
+    """
+
+    def __init__(self, fbo, reads, max_W, max_H, num_buffers=4):
+        self._fbo = fbo
+        self._reads = reads
+        self._buffers = [[PixelPackBuffer(max_W*max_H*channels*np.dtype(dtype).itemsize)
+                          for _, _, _, channels, dtype in reads] for _ in range(num_buffers)]
+        self._pending = collections.deque()
+        self._next = 0
+
+    def read(self, W, H):
+        if len(self._pending) == len(self._buffers):
+            self._pending[0].result()
+        slot = self._next
+        self._next = (self._next + 1) % len(self._buffers)
+        for buffer, (attachment, format, type, _, _) in zip(self._buffers[slot], self._reads):
+            glNamedFramebufferReadBuffer(self._fbo.id, attachment)
+            buffer.read_pixels(W, H, format, type)
+        handle = ReadbackHandle(self, slot, W, H, glFenceSync(GL_SYNC_GPU_COMMANDS_COMPLETE, 0))
+        self._pending.append(handle)
+        return handle
+
+    def _fetch(self, handle):
+        # handles are resolved in order, their buffers get reused in ring order
+        while self._pending[0] is not handle:
+            self._pending[0].result()
+        glClientWaitSync(handle._fence, GL_SYNC_FLUSH_COMMANDS_BIT, GL_TIMEOUT_IGNORED)
+        glDeleteSync(handle._fence)
+        W, H = handle._W, handle._H
+        result = []
+        for buffer, (_, _, _, channels, dtype) in zip(self._buffers[handle._slot], self._reads):
+            shape = (H, W, channels) if channels > 1 else (H, W)
+            result.append(np.flipud(buffer.get(np.empty(shape, dtype=dtype))).copy())
+        handle._result = tuple(result)
+        self._pending.popleft()
+
+    def delete(self):
+        for buffers in self._buffers:
+            for buffer in buffers:
+                buffer.delete()
@@ -21,4 +21,8 @@ class ShaderStorage(object):
 		nbytes = data.nbytes if nbytes == None else nbytes
 		assert self.__dynamic == True, 'Updating of a non-updatable buffer.'
 		assert data.nbytes == self.__data_size, 'Please put the same amount of data into the buffer as during creation.'
-		glNamedBufferSubData(self.__id[0], offset, nbytes, data)
\ No newline at end of file
+		glNamedBufferSubData(self.__id[0], offset, nbytes, data)
+
+	def get(self, out):
+		glGetNamedBufferSubData(self.__id[0], 0, out.nbytes, out)
+		return out
@@ -14,8 +14,11 @@ class Renderer(object):
     MAX_FBO_WIDTH = 2000
     MAX_FBO_HEIGHT = 2000
 
-    def __init__(self, models_cad_files, samples=1, vertex_tmp_store_folder='.', vertex_scale=1.):
+    def __init__(self, models_cad_files, samples=1, vertex_tmp_store_folder='.', vertex_scale=1., async_buffers=4):
         self._samples = samples
+        # pixel pack buffers of render_async, created on first use
+        self._async_buffers = async_buffers
+        self._async_readback = None
         self._context = gu.OffscreenContext()
 
         # FBO
@@ -23,11 +26,7 @@ class Renderer(object):
         self._fbo = gu.Framebuffer( { GL_COLOR_ATTACHMENT0: gu.Texture(GL_TEXTURE_2D, 1, GL_RGB8, W, H),
                                       GL_COLOR_ATTACHMENT1: gu.Texture(GL_TEXTURE_2D, 1, GL_R32F, W, H),
                                       GL_DEPTH_ATTACHMENT: gu.Renderbuffer(GL_DEPTH_COMPONENT32F, W, H) } )
-        self._fbo_depth = gu.Framebuffer( { GL_COLOR_ATTACHMENT0: gu.Texture(GL_TEXTURE_2D, 1, GL_RGB8, W, H),
-                                      GL_COLOR_ATTACHMENT1: gu.Texture(GL_TEXTURE_2D, 1, GL_R32F, W, H),
-                                      GL_DEPTH_ATTACHMENT: gu.Renderbuffer(GL_DEPTH_COMPONENT32F, W, H) } )
         glNamedFramebufferDrawBuffers(self._fbo.id, 2, np.array( (GL_COLOR_ATTACHMENT0,GL_COLOR_ATTACHMENT1),dtype=np.uint32 ) )
-        glNamedFramebufferDrawBuffers(self._fbo_depth.id, 2, np.array( (GL_COLOR_ATTACHMENT0,GL_COLOR_ATTACHMENT1),dtype=np.uint32 ) )
 
         if self._samples > 1:
             self._render_fbo = gu.Framebuffer( { GL_COLOR_ATTACHMENT0: gu.TextureMultisample(self._samples, GL_RGB8, W, H, True),
@@ -67,6 +66,9 @@ class Renderer(object):
         glEnable(GL_DEPTH_TEST)
         glClearColor(0.0, 0.0, 0.0, 1.0)
 
+        # depth-only and bounding box passes without shading or color readback
+        self._depth_pass = gu.DepthPass(Renderer.MAX_FBO_WIDTH, Renderer.MAX_FBO_HEIGHT)
+
 
     def set_light_pose(self, direction):
         # glUniform3fv(<location>, <count>, <value>)
@@ -81,7 +83,7 @@ class Renderer(object):
     def set_specular_light(self, a):
         glUniform1f(4, a)
 
-    def render(self, obj_id, W, H, K, R, t, near, far, random_light=False, phong={'ambient':0.4,'diffuse':0.8, 'specular':0.3}):
+    def _draw(self, obj_id, W, H, K, R, t, near, far, random_light=False, phong={'ambient':0.4,'diffuse':0.8, 'specular':0.3}):
         assert W <= Renderer.MAX_FBO_WIDTH and H <= Renderer.MAX_FBO_HEIGHT
         W, H = int(W), int(H)
 
@@ -94,19 +96,7 @@ class Renderer(object):
         camera = gu.Camera()
         camera.realCamera(W, H, K, R, t, near, far)
 
-        if random_light:
-            self.set_light_pose( 1000.*np.random.random(3) )
-            self.set_ambient_light(phong['ambient'] + 0.1*(2*np.random.rand()-1))
-            self.set_diffuse_light(phong['diffuse'] + 0.1*(2*np.random.rand()-1))
-            self.set_specular_light(phong['specular'] + 0.1*(2*np.random.rand()-1))
-            # self.set_ambient_light(phong['ambient'])
-            # self.set_diffuse_light(0.7)
-            # self.set_specular_light(0.3)
-        else:
-            self.set_light_pose( np.array([400., 400., 400]) )
-            self.set_ambient_light(phong['ambient'])
-            self.set_diffuse_light(phong['diffuse'])
-            self.set_specular_light(phong['specular'])
+        self.set_light(random_light, phong)
 
         self._scene_buffer.update(camera.data)
 
@@ -124,7 +114,10 @@ class Renderer(object):
             glBlitNamedFramebuffer(self._render_fbo.id, self._fbo.id, 0, 0, W, H, 0, 0, W, H, GL_COLOR_BUFFER_BIT, GL_NEAREST)
 
             glNamedFramebufferDrawBuffers(self._fbo.id, 2, np.array( (GL_COLOR_ATTACHMENT0, GL_COLOR_ATTACHMENT1),dtype=np.uint32 ) )
+        return int(W), int(H)
 
+    def render(self, obj_id, W, H, K, R, t, near, far, random_light=False, phong={'ambient':0.4,'diffuse':0.8, 'specular':0.3}):
+        W, H = self._draw(obj_id, W, H, K, R, t, near, far, random_light, phong)
 
         glNamedFramebufferReadBuffer(self._fbo.id, GL_COLOR_ATTACHMENT0)
         bgr_flipped = np.frombuffer( glReadPixels(0, 0, W, H, GL_BGR, GL_UNSIGNED_BYTE), dtype=np.uint8 ).reshape(H,W,3)
@@ -136,27 +129,128 @@ class Renderer(object):
 
         return bgr, depth
 
+    def _geometry(self, obj_id, W, H, K, R, t, near, far):
+        # draw call of the object in this pose for the depth passes
+        camera = gu.Camera()
+        camera.realCamera(W, H, K, R, t, near, far)
+        def draw():
+            self._scene_buffer.update(camera.data)
+            glDrawArraysIndirect(GL_TRIANGLES, ctypes.c_void_p(obj_id*16))
+        return draw
 
-    def render_many(self, obj_ids, W, H, K, Rs, ts, near, far, random_light=False, phong={'ambient':0.4,'diffuse':0.8, 'specular':0.3}):
+    def render_depth(self, obj_id, W, H, K, R, t, near, far):
+        """Only the float depth (H,W) of render, no shading and no color readback."""
+        assert W <= Renderer.MAX_FBO_WIDTH and H <= Renderer.MAX_FBO_HEIGHT
+        W, H = int(W), int(H)
+        return self._depth_pass.render_depth(self._geometry(obj_id, W, H, K, R, t, near, far), W, H)
+
+    def render_bbox(self, obj_id, W, H, K, R, t, near, far):
+        """[x, y, w, h] of the pixels covered in render, reduced on the GPU, None if not visible."""
         assert W <= Renderer.MAX_FBO_WIDTH and H <= Renderer.MAX_FBO_HEIGHT
+        W, H = int(W), int(H)
+        return self._depth_pass.render_bbox(self._geometry(obj_id, W, H, K, R, t, near, far), W, H)
 
-        glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
-        glViewport(0, 0, W, H)
 
+    def set_light(self, random_light, phong):
         if random_light:
             self.set_light_pose( 1000.*np.random.random(3) )
             self.set_ambient_light(phong['ambient'] + 0.1*(2*np.random.rand()-1))
             self.set_diffuse_light(phong['diffuse'] + 0.1*(2*np.random.rand()-1))
             self.set_specular_light(phong['specular'] + 0.1*(2*np.random.rand()-1))
-            # self.set_ambient_light(phong['ambient'])
-            # self.set_diffuse_light(0.7)
-            # self.set_specular_light(0.3)
         else:
             self.set_light_pose( np.array([400., 400., 400]) )
             self.set_ambient_light(phong['ambient'])
             self.set_diffuse_light(phong['diffuse'])
             self.set_specular_light(phong['specular'])
 
+    def render_batch(self, obj_ids, W, H, K, Rs, ts, near, far, random_light=False, phong={'ambient':0.4,'diffuse':0.8, 'specular':0.3}):
+        """Renders one W x H view per pose as viewport tiles of the framebuffer atlas.
+
+        obj_ids, Rs, ts: one entry per view, K a single 3x3 or one per view
+        Every atlas of up to (MAX_FBO_WIDTH//W)*(MAX_FBO_HEIGHT//H) views is read back
+        with one glReadPixels per attachment. Returns lists of bgr (H,W,3) and depth (H,W)
+        arrays, views into the atlas readbacks. With random_light each view gets its own light.
+        """
+        assert W <= Renderer.MAX_FBO_WIDTH and H <= Renderer.MAX_FBO_HEIGHT
+        W, H = int(W), int(H)
+        N = len(obj_ids)
+        Ks = np.asarray(K, dtype=np.float64).reshape(-1,3,3)
+        if len(Ks) == 1:
+            Ks = np.repeat(Ks, N, axis=0)
+        cols, rows = Renderer.MAX_FBO_WIDTH // W, Renderer.MAX_FBO_HEIGHT // H
+
+        bgrs, depths = [], []
+        for a in range(0, N, cols*rows):
+            views = range(a, min(a + cols*rows, N))
+            used_cols = min(len(views), cols)
+            used_rows = -(-len(views) // cols)
+            atlas_W, atlas_H = used_cols*W, used_rows*H
+            # tile k sits at row k//cols from the top of the atlas, GL rows count from the bottom
+            origins = [((k % cols)*W, atlas_H - (k // cols + 1)*H) for k in range(len(views))]
+
+            cameras = []
+            for i in views:
+                camera = gu.Camera()
+                camera.realCamera(W, H, Ks[i], Rs[i], ts[i], near, far)
+                cameras.append(camera.data)
+
+            if self._samples > 1:
+                self._render_fbo.bind()
+            glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
+            for k, i in enumerate(views):
+                glViewport(origins[k][0], origins[k][1], W, H)
+                self.set_light(random_light, phong)
+                self._scene_buffer.update(cameras[k])
+                glDrawArraysIndirect(GL_TRIANGLES, ctypes.c_void_p(obj_ids[i]*16))
+
+            if self._samples > 1:
+                self._fbo.bind()
+                glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
+
+                glNamedFramebufferDrawBuffer(self._fbo.id, GL_COLOR_ATTACHMENT1)
+                for k, i in enumerate(views):
+                    glViewport(origins[k][0], origins[k][1], W, H)
+                    self._scene_buffer.update(cameras[k])
+                    glDrawArraysIndirect(GL_TRIANGLES, ctypes.c_void_p(obj_ids[i]*16))
+
+                glNamedFramebufferReadBuffer(self._render_fbo.id, GL_COLOR_ATTACHMENT0)
+                glNamedFramebufferDrawBuffer(self._fbo.id, GL_COLOR_ATTACHMENT0)
+                glBlitNamedFramebuffer(self._render_fbo.id, self._fbo.id, 0, 0, atlas_W, atlas_H, 0, 0, atlas_W, atlas_H, GL_COLOR_BUFFER_BIT, GL_NEAREST)
+
+                glNamedFramebufferDrawBuffers(self._fbo.id, 2, np.array( (GL_COLOR_ATTACHMENT0, GL_COLOR_ATTACHMENT1),dtype=np.uint32 ) )
+
+            glNamedFramebufferReadBuffer(self._fbo.id, GL_COLOR_ATTACHMENT0)
+            bgr = np.flipud(np.frombuffer( glReadPixels(0, 0, atlas_W, atlas_H, GL_BGR, GL_UNSIGNED_BYTE), dtype=np.uint8 ).reshape(atlas_H,atlas_W,3))
+            glNamedFramebufferReadBuffer(self._fbo.id, GL_COLOR_ATTACHMENT1)
+            depth = np.flipud(glReadPixels(0, 0, atlas_W, atlas_H, GL_RED, GL_FLOAT).reshape(atlas_H,atlas_W))
+
+            for k in range(len(views)):
+                y, x = (k // cols)*H, (k % cols)*W
+                bgrs.append(bgr[y:y+H, x:x+W])
+                depths.append(depth[y:y+H, x:x+W])
+        return bgrs, depths
+
+    def render_async(self, obj_id, W, H, K, R, t, near, far, random_light=False, phong={'ambient':0.4,'diffuse':0.8, 'specular':0.3}):
+        """Like render, but the readback goes through a ring of async_buffers pixel pack
+        buffers and a handle is returned at once, handle.result() is (bgr, depth).
+        CPU work on one frame overlaps with the GPU rendering the next ones.
+        """
+        W, H = self._draw(obj_id, W, H, K, R, t, near, far, random_light, phong)
+        if self._async_readback is None:
+            self._async_readback = gu.AsyncReadback(self._fbo,
+                    [(GL_COLOR_ATTACHMENT0, GL_BGR, GL_UNSIGNED_BYTE, 3, np.uint8),
+                     (GL_COLOR_ATTACHMENT1, GL_RED, GL_FLOAT, 1, np.float32)],
+                    Renderer.MAX_FBO_WIDTH, Renderer.MAX_FBO_HEIGHT, self._async_buffers)
+        return self._async_readback.read(W, H)
+
+    def render_many(self, obj_ids, W, H, K, Rs, ts, near, far, random_light=False, phong={'ambient':0.4,'diffuse':0.8, 'specular':0.3}):
+        assert W <= Renderer.MAX_FBO_WIDTH and H <= Renderer.MAX_FBO_HEIGHT
+
+        glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
+        glViewport(0, 0, W, H)
+
+        self.set_light(random_light, phong)
+
         bbs = []
         for i in range(len(obj_ids)):
             o = obj_ids[i]
@@ -169,17 +263,11 @@ class Renderer(object):
             self._fbo.bind()
             glDrawArraysIndirect(GL_TRIANGLES, ctypes.c_void_p(o*16))
 
-            self._fbo_depth.bind()
-            glViewport(0, 0, W, H)
-            glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
-            glDrawArraysIndirect(GL_TRIANGLES, ctypes.c_void_p(o*16))
-
-            glNamedFramebufferReadBuffer(self._fbo_depth.id, GL_COLOR_ATTACHMENT1)
-            depth_flipped = glReadPixels(0, 0, W, H, GL_RED, GL_FLOAT).reshape(H,W)
-            depth = np.flipud(depth_flipped).copy()
-
-            ys, xs = np.nonzero(depth > 0)
-            obj_bb = misc.calc_2d_bbox(xs, ys, (W,H))
+            # box of the unoccluded object, reduced on the GPU instead of reading its depth
+            obj_bb = self._depth_pass.render_bbox(lambda: glDrawArraysIndirect(GL_TRIANGLES, ctypes.c_void_p(o*16)), W, H)
+            if obj_bb is None:
+                # callers unpack every box, fail like calc_2d_bbox of an empty depth
+                raise ValueError('object %d covers no pixel of the %dx%d rendering' % (o, W, H))
             bbs.append(obj_bb)
 
         glBindFramebuffer(GL_FRAMEBUFFER, self._fbo.id)
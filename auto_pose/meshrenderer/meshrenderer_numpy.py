@@ -0,0 +1,309 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+from multiprocessing.pool import ThreadPool
+
+from .pysixd import misc
+
+# eye coordinates of the GL renderers: z_flip * [R t]
+Z_FLIP = np.array([1., 1., -1.])
+
+# material of cad_shader.frag
+CAD_MATERIAL = np.array([223., 214., 205.]) / 255.
+
+
+def load_mesh(path):
+    """(vertices (N,3), faces (F,3), normals (N,3) or None, colors (N,3) in [0,255] or None)."""
+    if path.endswith('.ply'):
+        from bop_toolkit_lib import inout
+        model = inout.load_ply(path)
+        return (np.asarray(model['pts'], dtype=np.float64), np.asarray(model['faces'], dtype=np.int64),
+                model.get('normals'), model.get('colors'))
+    import pyassimp
+    scene = pyassimp.load(path, pyassimp.postprocess.aiProcess_Triangulate)
+    mesh = scene.meshes[0]
+    vertices, faces = np.array(mesh.vertices, dtype=np.float64), np.array(mesh.faces, dtype=np.int64)
+    normals = np.array(mesh.normals, dtype=np.float64) if len(mesh.normals) else None
+    colors = np.array(mesh.colors[0][:,:3], dtype=np.float64)*255. if len(mesh.colors) else None
+    pyassimp.release(scene)
+    return vertices, faces, normals, colors
+
+
+def face_normals(vertices, faces):
+    # as gl_utils.geometry.calc_normals, zero for degenerate faces
+    v1, v2, v3 = vertices[faces[:,0]], vertices[faces[:,1]], vertices[faces[:,2]]
+    normals = np.cross(v2 - v1, v3 - v1)
+    norms = np.linalg.norm(normals, axis=1, keepdims=True)
+    return np.where(norms > 0, normals / np.maximum(norms, 1e-300), 0.)
+
+
+def vertex_normals(vertices, faces):
+    # area weighted face normals for meshes without stored normals
+    normals = np.zeros_like(vertices)
+    v1, v2, v3 = vertices[faces[:,0]], vertices[faces[:,1]], vertices[faces[:,2]]
+    cross = np.cross(v2 - v1, v3 - v1)
+    for i in range(3):
+        np.add.at(normals, faces[:,i], cross)
+    norms = np.linalg.norm(normals, axis=1, keepdims=True)
+    return np.where(norms > 0, normals / np.maximum(norms, 1e-300), 0.)
+
+
+def rasterize(X, faces, K, W, H, near, far, rows=None, chunk_size=2**18):
+    """Z-buffer visibility of the triangles faces (F,3) over the camera space vertices X (N,3).
+
+    Pixel (i,j) samples the image point (j+0.5, i+0.5) like GL. Returns for the pixel rows
+    rows=(y0,y1) the visible face per pixel (-1 on background), its perspective correct
+    barycentric coordinates and the depth Z_c (0 on background). Triangles reaching in front
+    of the near plane are dropped instead of clipped.
+    """
+    y0, y1 = rows if rows is not None else (0, H)
+    face = np.full((y1 - y0)*W, -1, dtype=np.int64)
+    zbuf = np.full((y1 - y0)*W, np.inf)
+    bary = np.zeros(((y1 - y0)*W, 3))
+
+    tri_z = X[faces, 2]
+    visible = (tri_z.min(axis=1) >= near) & (tri_z.min(axis=1) <= far)
+    face_ids = np.nonzero(visible)[0]
+    faces, tri_z = faces[visible], tri_z[visible]
+    uv = X.dot(np.asarray(K, dtype=np.float64).T)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        uv = uv[:,:2] / uv[:,2:]
+    tri_uv = uv[faces]
+    area = ((tri_uv[:,1,0] - tri_uv[:,0,0])*(tri_uv[:,2,1] - tri_uv[:,0,1])
+            - (tri_uv[:,2,0] - tri_uv[:,0,0])*(tri_uv[:,1,1] - tri_uv[:,0,1]))
+
+    # pixel index ranges whose centers the triangle bounding boxes contain
+    x_lo = np.clip(np.ceil(tri_uv[:,:,0].min(axis=1) - 0.5), 0, W).astype(np.int64)
+    x_hi = np.clip(np.floor(tri_uv[:,:,0].max(axis=1) - 0.5) + 1, 0, W).astype(np.int64)
+    y_lo = np.clip(np.ceil(tri_uv[:,:,1].min(axis=1) - 0.5), y0, y1).astype(np.int64)
+    y_hi = np.clip(np.floor(tri_uv[:,:,1].max(axis=1) - 0.5) + 1, y0, y1).astype(np.int64)
+    bw, bh = x_hi - x_lo, y_hi - y_lo
+    counts = np.where((bw > 0) & (bh > 0) & (area != 0), bw*bh, 0)
+    candidates = np.nonzero(counts)[0]
+
+    # triangles in groups of about chunk_size candidate fragments
+    group_ids = np.cumsum(counts[candidates]) // chunk_size
+    for tris in np.split(candidates, np.nonzero(np.diff(group_ids))[0] + 1):
+        n = counts[tris]
+        tri = np.repeat(tris, n)
+        local = np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n)
+        px = x_lo[tri] + local % bw[tri]
+        py = y_lo[tri] + local // bw[tri]
+
+        u, v = px + 0.5, py + 0.5
+        a, b, c = tri_uv[tri,0], tri_uv[tri,1], tri_uv[tri,2]
+        l0 = ((b[:,0] - u)*(c[:,1] - v) - (c[:,0] - u)*(b[:,1] - v)) / area[tri]
+        l1 = ((c[:,0] - u)*(a[:,1] - v) - (a[:,0] - u)*(c[:,1] - v)) / area[tri]
+        l2 = 1. - l0 - l1
+        inside = (l0 >= 0) & (l1 >= 0) & (l2 >= 0)
+        tri, px, py = tri[inside], px[inside], py[inside]
+        w = np.stack((l0[inside], l1[inside], l2[inside]), axis=1) / tri_z[tri]
+        z = 1. / w.sum(axis=1)
+        w *= z[:,np.newaxis]
+        inside = (z >= near) & (z <= far)
+        tri, z, w = tri[inside], z[inside], w[inside]
+        key = (py[inside] - y0)*W + px[inside]
+
+        # nearest fragment per pixel of this group against the buffer
+        order = np.lexsort((z, key))
+        key = key[order]
+        first = np.ones(len(key), dtype=bool)
+        first[1:] = key[1:] != key[:-1]
+        nearest = order[first]
+        key = key[first]
+        closer = z[nearest] < zbuf[key]
+        key, nearest = key[closer], nearest[closer]
+        zbuf[key] = z[nearest]
+        face[key] = face_ids[tri[nearest]]
+        bary[key] = w[nearest]
+
+    zbuf[face < 0] = 0.
+    return face.reshape(y1 - y0, W), bary.reshape(y1 - y0, W, 3), zbuf.reshape(y1 - y0, W)
+
+
+class Renderer(object):
+    """CPU z-buffer rasterizer with the interface of meshrenderer.Renderer, for nodes
+    without an OpenGL context.
+
+    shader='cad' shades like cad_shader with flat normals, shader='phong' like the
+    depth_shader_phong of meshrenderer_phong with the stored vertex colors and normals.
+    threads > 1 renders horizontal bands of the image in parallel. samples > 1 approximates
+    multisampling by supersampling the color, the depth is never antialiased.
+    """
+
+    MAX_FBO_WIDTH = 2000
+    MAX_FBO_HEIGHT = 2000
+
+    def __init__(self, models_cad_files, samples=1, vertex_tmp_store_folder='.', vertex_scale=1., shader='cad', threads=1):
+        assert shader in ('cad', 'phong')
+        self._samples = samples
+        self._shader = shader
+        self._threads = threads
+        self._pool = ThreadPool(threads) if threads > 1 else None
+
+        self._meshes = []
+        for model_path in models_cad_files:
+            vertices, faces, normals, colors = load_mesh(model_path)
+            vertices = vertices * vertex_scale
+            mesh = {'vertices': vertices, 'faces': faces}
+            if shader == 'cad':
+                mesh['face_normals'] = face_normals(vertices, faces)
+            else:
+                mesh['normals'] = np.asarray(normals, dtype=np.float64) if normals is not None else vertex_normals(vertices, faces)
+                mesh['colors'] = np.asarray(colors, dtype=np.float64)/255. if colors is not None else np.tile(CAD_MATERIAL, (len(vertices), 1))
+            self._meshes.append(mesh)
+
+        self._light = {}
+        self.set_light(False, {'ambient':0.4,'diffuse':0.8, 'specular':0.3})
+
+    def set_light_pose(self, direction):
+        self._light['pose'] = np.asarray(direction, dtype=np.float64)
+
+    def set_ambient_light(self, a):
+        self._light['ambient'] = a
+
+    def set_diffuse_light(self, a):
+        self._light['diffuse'] = a
+
+    def set_specular_light(self, a):
+        self._light['specular'] = a
+
+    def set_light(self, random_light, phong):
+        if random_light:
+            self.set_light_pose( 1000.*np.random.random(3) )
+            # meshrenderer_phong keeps the ambient term fixed
+            self.set_ambient_light(phong['ambient'] + (0.1*(2*np.random.rand()-1) if self._shader == 'cad' else 0.))
+            self.set_diffuse_light(phong['diffuse'] + 0.1*(2*np.random.rand()-1))
+            self.set_specular_light(phong['specular'] + 0.1*(2*np.random.rand()-1))
+        else:
+            self.set_light_pose( np.array([400., 400., 400]) )
+            self.set_ambient_light(phong['ambient'])
+            self.set_diffuse_light(phong['diffuse'])
+            self.set_specular_light(phong['specular'])
+
+    def _bands(self, fn, H):
+        # fn(y0, y1) over horizontal bands, one per thread
+        if self._pool is None:
+            return [fn(0, H)]
+        bounds = np.linspace(0, H, self._threads + 1).astype(int)
+        return self._pool.map(lambda b: fn(*b), [b for b in zip(bounds[:-1], bounds[1:]) if b[1] > b[0]])
+
+    def _rasterize(self, obj_id, W, H, K, R, t, near, far, samples=1):
+        mesh = self._meshes[obj_id]
+        X = mesh['vertices'].dot(np.asarray(R, dtype=np.float64).T) + np.asarray(t, dtype=np.float64).reshape(3)
+        if samples > 1:
+            # sample s x s points per pixel, centered like a regular supersampling grid
+            K = np.diag([samples, samples, 1.]).dot(K)
+            W, H = W*samples, H*samples
+        bands = self._bands(lambda y0, y1: rasterize(X, mesh['faces'], K, W, H, near, far, rows=(y0, y1)), H)
+        face, bary, depth = [np.concatenate(b) for b in zip(*bands)]
+        return X, face, bary, depth
+
+    def _shade(self, obj_id, R, t, X, face, bary):
+        """rgb in [0,1] of the covered pixels face >= 0, in the eye frame of the GL renderers."""
+        mesh = self._meshes[obj_id]
+        mask = face >= 0
+        f = face[mask]
+        tri = mesh['faces'][f]
+        w = bary[mask][:,:,np.newaxis]
+        P = (X[tri]*w).sum(axis=1) * Z_FLIP
+        R = np.asarray(R, dtype=np.float64)
+        light = self._light
+
+        if self._shader == 'cad':
+            N = mesh['face_normals'][f].dot(R.T) * Z_FLIP
+            L = light['pose'] - P
+            material = CAD_MATERIAL
+        else:
+            # per vertex normalize(u_nm * vec4(n, 1)).xyz and normalize(light - P), interpolated
+            n = mesh['normals'][tri]
+            n_w = 1. - n.dot(R.T.dot(np.asarray(t, dtype=np.float64).reshape(3)))
+            n_eye = n.dot(R.T) * Z_FLIP
+            N = (n_eye / np.sqrt((n_eye**2).sum(axis=2) + n_w**2)[:,:,np.newaxis] * w).sum(axis=1)
+            L_v = light['pose'] - X[tri]*Z_FLIP
+            L = (L_v / np.linalg.norm(L_v, axis=2, keepdims=True) * w).sum(axis=1)
+            material = (mesh['colors'][tri]*w).sum(axis=1)
+
+        N = N / np.maximum(np.linalg.norm(N, axis=1, keepdims=True), 1e-300)
+        L = L / np.maximum(np.linalg.norm(L, axis=1, keepdims=True), 1e-300)
+        V = -P / np.linalg.norm(P, axis=1, keepdims=True)
+        NL = (N*L).sum(axis=1, keepdims=True)
+        reflected = 2.*NL*N - L
+        diffuse = np.maximum(NL, 0.) * material
+        specular = np.maximum((reflected*V).sum(axis=1, keepdims=True), 0.) * material
+        rgb = light['ambient']*material + light['diffuse']*diffuse + light['specular']*specular
+
+        out = np.zeros(face.shape + (3,))
+        out[mask] = np.clip(rgb, 0., 1.)
+        return out
+
+    def _render(self, obj_id, W, H, K, R, t, near, far):
+        X, face, bary, depth = self._rasterize(obj_id, W, H, K, R, t, near, far)
+        if self._samples > 1:
+            s = int(np.ceil(np.sqrt(self._samples)))
+            X, face_s, bary_s, _ = self._rasterize(obj_id, W, H, K, R, t, near, far, samples=s)
+            rgb = self._shade(obj_id, R, t, X, face_s, bary_s).reshape(H, s, W, s, 3).mean(axis=(1, 3))
+        else:
+            rgb = self._shade(obj_id, R, t, X, face, bary)
+        return rgb, depth
+
+    def render(self, obj_id, W, H, K, R, t, near, far, random_light=False, phong={'ambient':0.4,'diffuse':0.8, 'specular':0.3}):
+        assert W <= Renderer.MAX_FBO_WIDTH and H <= Renderer.MAX_FBO_HEIGHT
+        self.set_light(random_light, phong)
+        rgb, depth = self._render(obj_id, W, H, K, R, t, near, far)
+        bgr = np.round(rgb[:,:,::-1]*255.).astype(np.uint8)
+        return bgr, depth.astype(np.float32)
+
+    def render_depth(self, obj_id, W, H, K, R, t, near, far):
+        """Only the float depth (H,W) of render, rasterized without shading."""
+        assert W <= Renderer.MAX_FBO_WIDTH and H <= Renderer.MAX_FBO_HEIGHT
+        return self._rasterize(obj_id, W, H, K, R, t, near, far)[3].astype(np.float32)
+
+    def render_bbox(self, obj_id, W, H, K, R, t, near, far):
+        """[x, y, w, h] of the pixel centers spanned by the projected model vertices, without
+        rasterizing, None if the object is not in the image. Contains the covered pixels of
+        render, sharp silhouette tips that pass between pixel centers make it larger."""
+        X = self._meshes[obj_id]['vertices'].dot(np.asarray(R, dtype=np.float64).T) + np.asarray(t, dtype=np.float64).reshape(3)
+        X = X[(X[:,2] >= near) & (X[:,2] <= far)]
+        if len(X) == 0:
+            return None
+        uv = X.dot(np.asarray(K, dtype=np.float64).T)
+        u, v = uv[:,0] / uv[:,2], uv[:,1] / uv[:,2]
+        x0, x1 = int(np.ceil(u.min() - 0.5)), int(np.floor(u.max() - 0.5))
+        y0, y1 = int(np.ceil(v.min() - 0.5)), int(np.floor(v.max() - 0.5))
+        if x1 < max(x0, 0) or x0 > W - 1 or y1 < max(y0, 0) or y0 > H - 1:
+            return None
+        x0, x1, y0, y1 = max(x0, 0), min(x1, W - 1), max(y0, 0), min(y1, H - 1)
+        return [x0, y0, x1 - x0, y1 - y0]
+
+    def _bbox(self, depth):
+        ys, xs = np.nonzero(depth > 0)
+        if len(xs) == 0:
+            return None
+        return [int(v) for v in misc.calc_2d_bbox(xs, ys, depth.shape[::-1])]
+
+    def render_many(self, obj_ids, W, H, K, Rs, ts, near, far, random_light=False, phong={'ambient':0.4,'diffuse':0.8, 'specular':0.3}):
+        assert W <= Renderer.MAX_FBO_WIDTH and H <= Renderer.MAX_FBO_HEIGHT
+        self.set_light(random_light, phong)
+
+        rgb = np.zeros((H, W, 3))
+        depth = np.zeros((H, W))
+        bbs = []
+        for o, R, t in zip(obj_ids, Rs, ts):
+            obj_rgb, obj_depth = self._render(o, W, H, K, R, t, near, far)
+            obj_bb = self._bbox(obj_depth)
+            if obj_bb is None:
+                # callers unpack every box, fail like calc_2d_bbox of an empty depth
+                raise ValueError('object %d covers no pixel of the %dx%d rendering' % (o, W, H))
+            bbs.append(obj_bb)
+            # z-test of the objects against each other
+            closer = (obj_depth > 0) & ((depth == 0) | (obj_depth < depth))
+            rgb[closer] = obj_rgb[closer]
+            depth[closer] = obj_depth[closer]
+
+        bgr = np.round(rgb[:,:,::-1]*255.).astype(np.uint8)
+        return bgr, depth.astype(np.float32), bbs
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool = None
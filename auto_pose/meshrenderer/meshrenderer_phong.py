@@ -13,8 +13,11 @@ class Renderer(object):
     MAX_FBO_WIDTH = 2000
     MAX_FBO_HEIGHT = 2000
 
-    def __init__(self, models_cad_files, samples=1, vertex_tmp_store_folder='.', clamp=False, vertex_scale=1.0):
+    def __init__(self, models_cad_files, samples=1, vertex_tmp_store_folder='.', clamp=False, vertex_scale=1.0, async_buffers=4):
         self._samples = samples
+        # pixel pack buffers of render_async, created on first use
+        self._async_buffers = async_buffers
+        self._async_readback = None
         self._context = gu.OffscreenContext()
 
         # FBO
@@ -23,11 +26,7 @@ class Renderer(object):
                                       GL_COLOR_ATTACHMENT1: gu.Texture(GL_TEXTURE_2D, 1, GL_R32F, W, H),
                                       GL_DEPTH_ATTACHMENT: gu.Renderbuffer(GL_DEPTH_COMPONENT32F, W, H) } )
 
-        self._fbo_depth = gu.Framebuffer( { GL_COLOR_ATTACHMENT0: gu.Texture(GL_TEXTURE_2D, 1, GL_RGB8, W, H),
-                                      GL_COLOR_ATTACHMENT1: gu.Texture(GL_TEXTURE_2D, 1, GL_R32F, W, H),
-                                      GL_DEPTH_ATTACHMENT: gu.Renderbuffer(GL_DEPTH_COMPONENT32F, W, H) } )
         glNamedFramebufferDrawBuffers(self._fbo.id, 2, np.array( (GL_COLOR_ATTACHMENT0,GL_COLOR_ATTACHMENT1),dtype=np.uint32 ) )
-        glNamedFramebufferDrawBuffers(self._fbo_depth.id, 2, np.array( (GL_COLOR_ATTACHMENT0,GL_COLOR_ATTACHMENT1),dtype=np.uint32 ) )
 
         if self._samples > 1:
             self._render_fbo = gu.Framebuffer( { GL_COLOR_ATTACHMENT0: gu.TextureMultisample(self._samples, GL_RGB8, W, H, True),
@@ -80,6 +79,9 @@ class Renderer(object):
         glEnable(GL_DEPTH_TEST)
         glClearColor(0.0, 0.0, 0.0, 1.0)
 
+        # depth-only and bounding box passes without shading or color readback
+        self._depth_pass = gu.DepthPass(Renderer.MAX_FBO_WIDTH, Renderer.MAX_FBO_HEIGHT)
+
     def set_light_pose(self, direction):
         glUniform3f(1, direction[0], direction[1], direction[2])
 
@@ -93,7 +95,7 @@ class Renderer(object):
         glUniform1f(3, a)
 
 
-    def render(self, obj_id, W, H, K, R, t, near, far, random_light=False, phong={'ambient':0.4,'diffuse':0.8, 'specular':0.3}):
+    def _draw(self, obj_id, W, H, K, R, t, near, far, random_light=False, phong={'ambient':0.4,'diffuse':0.8, 'specular':0.3}):
         assert W <= Renderer.MAX_FBO_WIDTH and H <= Renderer.MAX_FBO_HEIGHT
 
         if self._samples > 1:
@@ -149,6 +151,10 @@ class Renderer(object):
             glBlitNamedFramebuffer(self._render_fbo.id, self._fbo.id, 0, 0, W, H, 0, 0, W, H, GL_COLOR_BUFFER_BIT, GL_NEAREST)
 
             glNamedFramebufferDrawBuffers(self._fbo.id, 2, np.array( (GL_COLOR_ATTACHMENT0, GL_COLOR_ATTACHMENT1),dtype=np.uint32 ) )
+        return int(W), int(H)
+
+    def render(self, obj_id, W, H, K, R, t, near, far, random_light=False, phong={'ambient':0.4,'diffuse':0.8, 'specular':0.3}):
+        W, H = self._draw(obj_id, W, H, K, R, t, near, far, random_light, phong)
 
         glNamedFramebufferReadBuffer(self._fbo.id, GL_COLOR_ATTACHMENT0)
         bgr_flipped = np.frombuffer( glReadPixels(0, 0, W, H, GL_BGR, GL_UNSIGNED_BYTE), dtype=np.uint8 ).reshape(H,W,3)
@@ -160,6 +166,40 @@ class Renderer(object):
 
         return bgr, depth
 
+    def _geometry(self, obj_id, W, H, K, R, t, near, far):
+        # draw call of the object in this pose for the depth passes
+        camera = gu.Camera()
+        camera.realCamera(W, H, K, R, t, near, far)
+        def draw():
+            self._scene_buffer.update(camera.data)
+            glDrawElementsIndirect(GL_TRIANGLES, GL_UNSIGNED_INT, ctypes.c_void_p(obj_id*4*5))
+        return draw
+
+    def render_depth(self, obj_id, W, H, K, R, t, near, far):
+        """Only the float depth (H,W) of render, no shading and no color readback."""
+        assert W <= Renderer.MAX_FBO_WIDTH and H <= Renderer.MAX_FBO_HEIGHT
+        W, H = int(W), int(H)
+        return self._depth_pass.render_depth(self._geometry(obj_id, W, H, K, R, t, near, far), W, H)
+
+    def render_bbox(self, obj_id, W, H, K, R, t, near, far):
+        """[x, y, w, h] of the pixels covered in render, reduced on the GPU, None if not visible."""
+        assert W <= Renderer.MAX_FBO_WIDTH and H <= Renderer.MAX_FBO_HEIGHT
+        W, H = int(W), int(H)
+        return self._depth_pass.render_bbox(self._geometry(obj_id, W, H, K, R, t, near, far), W, H)
+
+    def render_async(self, obj_id, W, H, K, R, t, near, far, random_light=False, phong={'ambient':0.4,'diffuse':0.8, 'specular':0.3}):
+        """Like render, but the readback goes through a ring of async_buffers pixel pack
+        buffers and a handle is returned at once, handle.result() is (bgr, depth).
+        CPU work on one frame overlaps with the GPU rendering the next ones.
+        """
+        W, H = self._draw(obj_id, W, H, K, R, t, near, far, random_light, phong)
+        if self._async_readback is None:
+            self._async_readback = gu.AsyncReadback(self._fbo,
+                    [(GL_COLOR_ATTACHMENT0, GL_BGR, GL_UNSIGNED_BYTE, 3, np.uint8),
+                     (GL_COLOR_ATTACHMENT1, GL_RED, GL_FLOAT, 1, np.float32)],
+                    Renderer.MAX_FBO_WIDTH, Renderer.MAX_FBO_HEIGHT, self._async_buffers)
+        return self._async_readback.read(W, H)
+
     def render_many(self, obj_ids, W, H, K, Rs, ts, near, far, random_light=True, phong={'ambient':0.4,'diffuse':0.8, 'specular':0.3}):
         assert W <= Renderer.MAX_FBO_WIDTH and H <= Renderer.MAX_FBO_HEIGHT
 
@@ -192,17 +232,11 @@ class Renderer(object):
             self._fbo.bind()
             glDrawElementsIndirect(GL_TRIANGLES, GL_UNSIGNED_INT, ctypes.c_void_p(o*4*5))
 
-            self._fbo_depth.bind()
-            glViewport(0, 0, W, H)
-            glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
-            glDrawElementsIndirect(GL_TRIANGLES, GL_UNSIGNED_INT, ctypes.c_void_p(o*4*5))
-
-            glNamedFramebufferReadBuffer(self._fbo_depth.id, GL_COLOR_ATTACHMENT1)
-            depth_flipped = glReadPixels(0, 0, W, H, GL_RED, GL_FLOAT).reshape(H,W)
-            depth = np.flipud(depth_flipped).copy()
-
-            ys, xs = np.nonzero(depth > 0)
-            obj_bb = misc.calc_2d_bbox(xs, ys, (W,H))
+            # box of the unoccluded object, reduced on the GPU instead of reading its depth
+            obj_bb = self._depth_pass.render_bbox(lambda: glDrawElementsIndirect(GL_TRIANGLES, GL_UNSIGNED_INT, ctypes.c_void_p(o*4*5)), W, H)
+            if obj_bb is None:
+                # callers unpack every box, fail like calc_2d_bbox of an empty depth
+                raise ValueError('object %d covers no pixel of the %dx%d rendering' % (o, W, H))
             bbs.append(obj_bb)
 
         glBindFramebuffer(GL_FRAMEBUFFER, self._fbo.id)
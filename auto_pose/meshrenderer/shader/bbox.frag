@@ -0,0 +1,14 @@
+#version 450 core
+
+// min x, min y, max x, max y of the covered pixels, GL rows from the bottom
+layout (binding=1) buffer BBOX_BUFFER {
+	int bbox[4];
+};
+
+void main(void) {
+	ivec2 p = ivec2(gl_FragCoord.xy);
+	atomicMin(bbox[0], p.x);
+	atomicMin(bbox[1], p.y);
+	atomicMax(bbox[2], p.x);
+	atomicMax(bbox[3], p.y);
+}
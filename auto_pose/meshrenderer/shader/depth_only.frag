@@ -0,0 +1,9 @@
+#version 450 core
+
+in float v_depth;
+
+layout (location = 0) out float depth;
+
+void main(void) {
+	depth = v_depth;
+}
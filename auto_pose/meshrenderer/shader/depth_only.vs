@@ -0,0 +1,17 @@
+#version 450 core
+
+layout (location = 0) in vec3 position;
+
+layout (binding=0) readonly buffer SCENE_BUFFER {
+	mat4 view;
+	mat4 projection;
+	vec3 viewPos;
+};
+
+out float v_depth;
+
+void main(void) {
+	vec4 P = view * vec4(position, 1.0);
+	v_depth = -P.z;
+	gl_Position = projection * P;
+}
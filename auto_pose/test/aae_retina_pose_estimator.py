@@ -81,7 +81,10 @@ class AePoseEstimator:
             self.pad_factors.append(train_args.getfloat('Dataset','PAD_FACTOR'))
             self.patch_sizes.append((train_args.getint('Dataset','W'), train_args.getint('Dataset','H')))
 
-            self.all_codebooks.append(factory.build_codebook_from_name(experiment_name, experiment_group, return_dataset=False))
+            # the multi codebook fuses exported codebooks, only their encoders are built and restored
+            if not os.path.exists(os.path.join(utils.get_codebook_path(log_dir), 'meta.json')):
+                factory.export_codebook_from_name(experiment_name, experiment_group)
+            self.all_codebooks.append(factory.load_codebook_from_name(experiment_name, experiment_group))
             saver = tf.train.Saver(var_list=tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES, scope=experiment_name))
             factory.restore_checkpoint(self.sess, saver, ckpt_dir)
 
@@ -91,6 +94,10 @@ class AePoseEstimator:
             #     # currently works only for one object
             #     from auto_pose.icp import icp
             #     self.icp_handle = icp.ICP(train_args)
+        # all objects are matched in one session.run per frame
+        self.multi_codebook = factory.build_multi_codebook(self.all_codebooks)
+        self.multi_codebook.initialize(self.sess)
+
         if test_args.getboolean('ICP','icp'):
             from auto_pose.icp import icp
             self.icp_handle = icp.ICP(test_args, self.all_train_args)
@@ -172,31 +179,40 @@ class AePoseEstimator:
         all_pose_estimates = []
         all_class_idcs = []
 
-
+        det_imgs = []
+        det_boxes = []
+        det_class_idcs = []
         for j,(box_xywh,label) in enumerate(zip(filtered_boxes,filtered_labels)):
-            H_est = np.eye(4)
-
             try:
                 clas_idx = self.class_names.index(label)
             except:
                 print('%s not contained in config class_names %s', (label, self.class_names))
                 continue
 
-
-            det_img = self.extract_square_patch(color_img,
+            det_imgs.append(self.extract_square_patch(color_img,
                                                 box_xywh,
                                                 self.pad_factors[clas_idx],
                                                 resize=self.patch_sizes[clas_idx],
                                                 interpolation=cv2.INTER_LINEAR,
-                                                black_borders=True)
-
-            Rs_est, ts_est = self.all_codebooks[clas_idx].auto_pose6d(self.sess,
-                                                                        det_img,
-                                                                        box_xywh,
-                                                                        self._camK,
-                                                                        1,
-                                                                        self.all_train_args[clas_idx],
-                                                                        upright=self._upright)
+                                                black_borders=True))
+            det_boxes.append(box_xywh)
+            det_class_idcs.append(clas_idx)
+
+        if len(det_imgs) == 0:
+            return (all_pose_estimates, all_class_idcs)
+
+        all_Rs_est, all_ts_est = self.multi_codebook.auto_pose6d_batch(self.sess,
+                                                                       det_imgs,
+                                                                       det_class_idcs,
+                                                                       det_boxes,
+                                                                       self._camK,
+                                                                       1,
+                                                                       self.all_train_args,
+                                                                       upright=self._upright)
+
+        for j,(det_img,box_xywh,clas_idx) in enumerate(zip(det_imgs,det_boxes,det_class_idcs)):
+            H_est = np.eye(4)
+            Rs_est, ts_est = all_Rs_est[j], all_ts_est[j]
 
             R_est = Rs_est.squeeze()
             t_est = ts_est.squeeze()
@@ -18,8 +18,6 @@ full_name = arguments.experiment_name.split('/')
 experiment_name = full_name.pop()
 experiment_group = full_name.pop() if len(full_name) > 0 else ''
 
-codebook,dataset = factory.build_codebook_from_name(experiment_name,experiment_group,return_dataset=True)
-
 workspace_path = os.environ.get('AE_WORKSPACE_PATH')
 log_dir = u.get_log_dir(workspace_path,experiment_name,experiment_group)
 ckpt_dir = u.get_checkpoint_dir(log_dir)
@@ -28,6 +26,13 @@ train_cfg_file_path = u.get_train_config_exp_file_path(log_dir, experiment_name)
 train_args = configparser.ConfigParser()
 train_args.read(train_cfg_file_path)
 
+if os.path.exists(os.path.join(u.get_codebook_path(log_dir), 'meta.json')):
+    # codebook exported by ae_embed, only the encoder is built, the dataset just renders the matched views
+    codebook = factory.load_codebook_from_name(experiment_name,experiment_group)
+    dataset = factory.build_dataset(u.get_dataset_path(workspace_path), train_args)
+else:
+    codebook,dataset = factory.build_codebook_from_name(experiment_name,experiment_group,return_dataset=True)
+
 width = 960
 height = 720
 videoStream = WebcamVideoStream(0,width,height).start()
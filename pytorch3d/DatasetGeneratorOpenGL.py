@@ -130,40 +130,39 @@ class DatasetGenerator():
         model.eval()
         return model
 
-    def load_bg_images(self, output_path, background_path, num_bg_images, h, w, c=3):
+    def load_bg_images(self, output_path, background_path, num_bg_images, h, w, c=3, workers=None):
         if(background_path == ""):
             return []
 
         bg_img_paths = glob.glob(background_path + "*.jpg")
         noof_bg_imgs = min(num_bg_images, len(bg_img_paths))
         shape = (h, w, c)
-        bg_imgs = np.empty( (noof_bg_imgs,) + shape, dtype=np.uint8 )
+        workers = os.cpu_count() if workers is None else workers
 
         current_config_hash = hashlib.md5((str(shape) + str(noof_bg_imgs) + str(background_path)).encode('utf-8')).hexdigest()
         current_file_name = os.path.join(output_path + '-' + current_config_hash +'.npy')
-        if os.path.exists(current_file_name):
-            bg_imgs = np.load(current_file_name)
-        else:
+        if not os.path.exists(current_file_name):
+            # the first noof_bg_imgs files, the others replace unreadable ones
             file_list = bg_img_paths[:noof_bg_imgs]
-            print(len(file_list))
-            from random import shuffle
-            shuffle(file_list)
-
-            for j,fname in enumerate(file_list):
-                print('loading bg img %s/%s' % (j,noof_bg_imgs))
-                bgr = cv2.imread(fname)
-                H,W = bgr.shape[:2]
-                y_anchor = int(np.random.rand() * (H-shape[0]))
-                x_anchor = int(np.random.rand() * (W-shape[1]))
-                # bgr = cv2.resize(bgr, shape[:2])
-                bgr = bgr[y_anchor:y_anchor+shape[0],x_anchor:x_anchor+shape[1],:]
-                if bgr.shape[0]!=shape[0] or bgr.shape[1]!=shape[1]:
-                    continue
-                if shape[2] == 1:
-                    bgr = cv2.cvtColor(np.uint8(bgr), cv2.COLOR_BGR2GRAY)[:,:,np.newaxis]
-                bg_imgs[j] = bgr
-            np.save(current_file_name,bg_imgs)
-            print('loaded %s bg images' % noof_bg_imgs)
+            spare_files = bg_img_paths[noof_bg_imgs:]
+            random.shuffle(file_list)
+            random.shuffle(spare_files)
+
+            bg_imgs = np.lib.format.open_memmap(current_file_name + '.part', mode='w+',
+                                                dtype=np.uint8, shape=(noof_bg_imgs,) + shape)
+            n = 0
+            for bgr in decode_bg_crops(file_list + spare_files, noof_bg_imgs, shape, workers=workers):
+                bg_imgs[n] = bgr
+                n += 1
+            bg_imgs.flush()
+            if n < noof_bg_imgs:
+                bg_imgs = np.array(bg_imgs[:n])
+                with open(current_file_name + '.part', 'wb') as f:
+                    np.save(f, bg_imgs)
+            del bg_imgs
+            os.rename(current_file_name + '.part', current_file_name)
+        bg_imgs = np.load(current_file_name, mmap_mode='r')
+        print('loaded %s bg images' % len(bg_imgs))
         return bg_imgs
 
     def setup_augmentation(self):
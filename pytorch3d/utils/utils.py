@@ -281,3 +281,47 @@ def extract_square_patch(scene_img, bb_xywh, pad_factor=1.2,resize=(128,128),
 
         scene_crop = cv2.resize(scene_crop, resize) #, interpolation = interpolation)
         return scene_crop
+
+def _decode_bg_shard(args):
+    file_list, shape, seed = args
+    random_state = np.random.RandomState(seed)
+    images = []
+    for fname in file_list:
+        bgr = cv2.imread(fname)
+        if bgr is None or bgr.shape[0] < shape[0] or bgr.shape[1] < shape[1]:
+            images.append(None)
+            continue
+        H,W = bgr.shape[:2]
+        y_anchor = random_state.randint(0, H-shape[0]+1)
+        x_anchor = random_state.randint(0, W-shape[1]+1)
+        bgr = bgr[y_anchor:y_anchor+shape[0],x_anchor:x_anchor+shape[1],:]
+        if shape[2] == 1:
+            bgr = cv2.cvtColor(np.uint8(bgr), cv2.COLOR_BGR2GRAY)[:,:,np.newaxis]
+        images.append(bgr)
+    return images
+
+def decode_bg_crops(file_list, noof_imgs, shape, workers=0, shard_size=64):
+    # yields up to noof_imgs random crops, decoded by a process pool,
+    # unreadable or too small files are replaced by the next files of the list
+    pool = None
+    if workers > 1:
+        import multiprocessing
+        pool = multiprocessing.get_context('fork').Pool(workers)
+    noof_decoded = 0
+    pos = 0
+    try:
+        while noof_decoded < noof_imgs and pos < len(file_list):
+            todo = file_list[pos:pos + noof_imgs - noof_decoded]
+            pos += len(todo)
+            shards = [(todo[a:a+shard_size], shape, np.random.randint(0, 2**31 - 1))
+                      for a in range(0, len(todo), shard_size)]
+            results = pool.imap(_decode_bg_shard, shards) if pool is not None else map(_decode_bg_shard, shards)
+            for images in results:
+                for bgr in images:
+                    if bgr is not None:
+                        noof_decoded += 1
+                        yield bgr
+                print('loaded %s/%s bg images' % (noof_decoded, noof_imgs))
+    finally:
+        if pool is not None:
+            pool.terminate()
@@ -0,0 +1,51 @@
+import os.path as osp
+import sys
+cur_dir = osp.dirname(osp.abspath(__file__))
+sys.path.insert(0, osp.join(cur_dir, '..'))
+import argparse
+import configparser
+import time
+import numpy as np
+from auto_pose.ae import augmentation
+
+
+def batches_per_second(aug, batches):
+    aug.augment_images(batches[0])
+    start = time.time()
+    for batch in batches:
+        aug.augment_images(batch)
+    return len(batches) / (time.time() - start)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cfg', default=osp.join(cur_dir, '..', 'auto_pose', 'ae', 'cfg', 'train_template.cfg'))
+    parser.add_argument('--batch', type=int, default=64)
+    parser.add_argument('--size', type=int, default=128)
+    parser.add_argument('--batches', type=int, default=50)
+    arguments = parser.parse_args()
+
+    args = configparser.ConfigParser()
+    args.read(arguments.cfg)
+    code = args.get('Augmentation', 'CODE')
+
+    rng = np.random.RandomState(0)
+    batches = [rng.randint(0, 256, (arguments.batch, arguments.size, arguments.size, 3)).astype(np.uint8)
+               for _ in range(arguments.batches)]
+
+    native = augmentation.from_code(code)
+    native.reseed(0)
+    a = native.augment_images(batches[0])
+    native.reseed(0)
+    assert np.array_equal(a, native.augment_images(batches[0])), 'native engine not reproducible'
+    print('native %.1f batches/s' % batches_per_second(native, batches))
+
+    try:
+        from imgaug.augmenters import Sequential, Sometimes, Affine, CoarseDropout, GaussianBlur, Add, Invert, Multiply, ContrastNormalization
+    except ImportError:
+        print('imgaug not installed, skipping the reference')
+        return
+    print('imgaug %.1f batches/s' % batches_per_second(eval(code), batches))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+import os.path as osp
+import sys
+cur_dir = osp.dirname(osp.abspath(__file__))
+sys.path.insert(0, osp.join(cur_dir, '..'))
+import argparse
+import numpy as np
+from auto_pose.ae import codebook_index
+from auto_pose.ae.pysixd_stuff import transform, view_sampler
+
+
+def synthetic_codebook(n, J, seed=0):
+    # smooth latent trajectories like neighbouring views, not iid noise
+    rng = np.random.RandomState(seed)
+    anchors = rng.randn(n//64 + 1, J).astype(np.float32)
+    embedding = np.repeat(anchors, 64, axis=0)[:n] + 0.3*rng.randn(n, J).astype(np.float32)
+    return embedding / np.linalg.norm(embedding, axis=1, keepdims=True)
+
+def rotation_features(Rs, J, seed=0):
+    # smooth, non-linear function of the rotation standing in for encoder codes
+    rng = np.random.RandomState(seed)
+    W = 2.*rng.randn(9, J).astype(np.float32)
+    z = np.tanh(np.asarray(Rs, dtype=np.float32).reshape(-1, 9).dot(W))
+    return z / np.linalg.norm(z, axis=1, keepdims=True)
+
+def synthetic_viewsphere(min_n_views, num_cyclo):
+    views, pts_level = view_sampler.sample_views(min_n_views)
+    Rs = np.empty((len(views)*num_cyclo, 3, 3))
+    i = 0
+    for view in views:
+        for cyclo in np.linspace(0, 2.*np.pi, num_cyclo):
+            rot_z = np.array([[np.cos(-cyclo), -np.sin(-cyclo), 0], [np.sin(-cyclo), np.cos(-cyclo), 0], [0, 0, 1]])
+            Rs[i] = rot_z.dot(view['R'])
+            i += 1
+    return Rs, np.array(pts_level)
+
+def noisy_queries(embedding, n, noise=0.2, seed=1):
+    rng = np.random.RandomState(seed)
+    queries = embedding[rng.choice(len(embedding), n, replace=False)] + noise*rng.randn(n, embedding.shape[1]).astype(np.float32)/np.sqrt(embedding.shape[1])
+    return queries / np.linalg.norm(queries, axis=1, keepdims=True)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--codebook', default=None, help='exported codebook directory, synthetic data if omitted')
+    parser.add_argument('--n', type=int, default=200000)
+    parser.add_argument('--J', type=int, default=128)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--index', default='ivf', choices=['ivf', 'hierarchical', 'precision'])
+    parser.add_argument('--num_cyclo', type=int, default=36)
+    arguments = parser.parse_args()
+
+    if arguments.index == 'hierarchical':
+        bench_hierarchical(arguments)
+        return
+    if arguments.index == 'precision':
+        bench_precision(arguments)
+        return
+
+    if arguments.codebook is not None:
+        embedding = np.load(osp.join(arguments.codebook, 'embedding_normalized.npy'), mmap_mode='r')
+    else:
+        embedding = synthetic_codebook(arguments.n, arguments.J)
+    queries = noisy_queries(np.asarray(embedding), arguments.queries)
+    print('codebook %s x %s, %s queries' % (embedding.shape + (len(queries),)))
+
+    for pq_m in [0, 8]:
+        index = codebook_index.IVFIndex(embedding, pq_m=pq_m, n_probe=1)
+        for n_probe in [1, 4, 16, 64]:
+            for rerank in ([0] if pq_m == 0 else [0, 100, 1000]):
+                index.n_probe = n_probe
+                index.rerank = rerank
+                res = codebook_index.benchmark(index, embedding, queries, k=arguments.k)
+                print('pq_m=%2d n_probe=%3d rerank=%4d  recall@1 %.3f  recall@%d %.3f  %.3f ms/query (brute %.3f ms)' % (
+                    pq_m, n_probe, rerank, res['recall@1'], arguments.k, res['recall@%s' % arguments.k], res['index_ms'], res['brute_ms']))
+
+def bench_hierarchical(arguments):
+    num_cyclo = arguments.num_cyclo
+    if arguments.codebook is not None:
+        embedding = np.load(osp.join(arguments.codebook, 'embedding_normalized.npy'), mmap_mode='r')
+        Rs = np.load(osp.join(arguments.codebook, 'rotations.npy'), mmap_mode='r')
+        view_levels = np.load(osp.join(arguments.codebook, 'view_levels.npy'))
+        queries = noisy_queries(np.asarray(embedding), arguments.queries)
+    else:
+        Rs, view_levels = synthetic_viewsphere(arguments.n // num_cyclo, num_cyclo)
+        embedding = rotation_features(Rs, arguments.J)
+        queries = rotation_features([transform.random_rotation_matrix()[:3,:3] for _ in range(arguments.queries)], arguments.J)
+    print('codebook %s x %s, %s views, levels %s, %s queries' % (embedding.shape + (len(view_levels), view_levels.max(), len(queries))))
+
+    for coarse_level in range(1, view_levels.max()):
+        for beam in [4, 8, 16]:
+            index = codebook_index.HierarchicalIndex(embedding, Rs, view_levels, num_cyclo, coarse_level=coarse_level, beam=beam)
+            res = codebook_index.benchmark(index, embedding, queries, k=1)
+            print('coarse_level=%d beam=%2d  top-1 agreement %.3f  %.1fx fewer entries scored  %.3f ms/query (brute %.3f ms)' % (
+                coarse_level, beam, res['recall@1'], len(embedding) / index.entries_scanned(), res['index_ms'], res['brute_ms']))
+
+def bench_precision(arguments):
+    if arguments.codebook is not None:
+        embedding = np.load(osp.join(arguments.codebook, 'embedding_normalized.npy'))
+    else:
+        embedding = synthetic_codebook(arguments.n, arguments.J)
+    queries = noisy_queries(embedding, arguments.queries)
+    print('codebook %s x %s, %s queries' % (embedding.shape + (len(queries),)))
+
+    for precision in ['float16', 'int8']:
+        res = codebook_index.precision_report(embedding, queries, precision, top_n=arguments.k)
+        print('%-7s  top-1 agreement %.3f  top-%d overlap %.3f  %.1f MB (float32 %.1f MB)' % (
+            precision, res['top1'], arguments.k, res['top%s' % arguments.k], res['%s_mb' % precision], res['float32_mb']))
+
+
+if __name__ == '__main__':
+    main()
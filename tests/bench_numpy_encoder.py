@@ -0,0 +1,54 @@
+import os
+import os.path as osp
+import sys
+cur_dir = osp.dirname(osp.abspath(__file__))
+sys.path.insert(0, osp.join(cur_dir, '..'))
+# CPU throughput of both paths
+os.environ['CUDA_VISIBLE_DEVICES'] = ''
+import argparse
+import tempfile
+import time
+import numpy as np
+import tensorflow as tf
+from auto_pose.ae.encoder import Encoder
+from auto_pose.ae.numpy_encoder import NumpyEncoder, export_encoder
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--crops', type=int, default=256)
+    parser.add_argument('--batch', type=int, default=32)
+    parser.add_argument('--size', type=int, default=128)
+    parser.add_argument('--batch_norm', action='store_true')
+    arguments = parser.parse_args()
+
+    x = tf.placeholder(tf.float32, [None, arguments.size, arguments.size, 3])
+    encoder = Encoder(x, 128, [128, 256, 512, 512], 5, [2, 2, 2, 2], arguments.batch_norm)
+    crops = np.random.RandomState(0).randint(0, 256, (arguments.crops, arguments.size, arguments.size, 3)).astype(np.uint8)
+
+    with tf.Session(config=tf.ConfigProto(device_count={'GPU': 0})) as sess:
+        sess.run(tf.global_variables_initializer())
+        path = tempfile.mkdtemp()
+        export_encoder(sess, encoder, path)
+
+        z_tf = np.concatenate([sess.run(encoder.z, {x: crops[a:a+arguments.batch]/255.})
+                               for a in range(0, len(crops), arguments.batch)])
+        start = time.time()
+        for a in range(0, len(crops), arguments.batch):
+            sess.run(encoder.z, {x: crops[a:a+arguments.batch]/255.})
+        tf_rate = len(crops) / (time.time() - start)
+
+    numpy_encoder = NumpyEncoder.load(path)
+    z_np = numpy_encoder.z(crops[:arguments.batch])
+    start = time.time()
+    for a in range(0, len(crops), arguments.batch):
+        numpy_encoder.z(crops[a:a+arguments.batch])
+    np_rate = len(crops) / (time.time() - start)
+
+    print('max |z_tf - z_numpy| %.2e' % np.abs(z_tf[:arguments.batch] - z_np).max())
+    print('TF    %.1f crops/s' % tf_rate)
+    print('NumPy %.1f crops/s' % np_rate)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+import os
+os.environ['PYOPENGL_PLATFORM'] = 'egl'
+import os.path as osp
+import sys
+cur_dir = osp.dirname(osp.abspath(__file__))
+sys.path.insert(0, osp.join(cur_dir, '..'))
+sys.path.insert(0, osp.join(cur_dir, '../bop_toolkit'))
+import argparse
+import glob
+import time
+import numpy as np
+from auto_pose.meshrenderer import meshrenderer_numpy
+from auto_pose.ae.pysixd_stuff import transform
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--views', type=int, default=50)
+    parser.add_argument('--size', type=int, default=128)
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--gl', action='store_true', help='also render with meshrenderer and compare')
+    arguments = parser.parse_args()
+
+    # NOTE: in $ROOT, mkdir -p data; ln -sf /path/to/SIXD_DATASETS data/SIXD_DATASETS
+    cad_path = osp.join(cur_dir, '../data/SIXD_DATASETS/hinterstoisser/models')
+    assert osp.exists(cad_path), "cad_path {} does not exist. Check your dataset path!".format(cad_path)
+    models_cad_files = sorted(glob.glob(os.path.join(cad_path, '*.ply')))[:1]
+
+    W = H = arguments.size
+    K = np.array([[572.4114, 0.0, W/2.], [0.0, 573.57043, H/2.], [0.0, 0.0, 1.0]])
+    t = np.array([0, 0, 1500.])
+    Rs = [transform.random_rotation_matrix()[:3,:3] for _ in range(arguments.views)]
+
+    for threads in sorted(set([1, arguments.threads])):
+        renderer = meshrenderer_numpy.Renderer(models_cad_files, 1, threads=threads)
+        start = time.time()
+        renders = [renderer.render(0, W, H, K, R, t, 10, 10000) for R in Rs]
+        print('numpy, %d threads %.1f views/s' % (threads, len(Rs) / (time.time() - start)))
+        renderer.close()
+
+    if arguments.gl:
+        from auto_pose.meshrenderer import meshrenderer
+        renderer = meshrenderer.Renderer(models_cad_files, 1)
+        start = time.time()
+        gl_renders = [renderer.render(0, W, H, K, R, t, 10, 10000) for R in Rs]
+        print('gl               %.1f views/s' % (len(Rs) / (time.time() - start)))
+        coverage = np.mean([np.mean((d > 0) == (d_gl > 0)) for (_, d), (_, d_gl) in zip(renders, gl_renders)])
+        color = np.mean([np.mean(np.abs(b.astype(int) - b_gl).max(axis=2)[(d > 0) & (d_gl > 0)] <= 1)
+                         for (b, d), (b_gl, d_gl) in zip(renders, gl_renders)])
+        print('mask agreement %.4f, color agreement (+-1) %.4f' % (coverage, color))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+import os
+os.environ['PYOPENGL_PLATFORM'] = 'egl'
+import os.path as osp
+import sys
+cur_dir = osp.dirname(osp.abspath(__file__))
+sys.path.insert(0, osp.join(cur_dir, '..'))
+import argparse
+import glob
+import time
+import numpy as np
+from auto_pose.meshrenderer import meshrenderer
+from auto_pose.ae.pysixd_stuff import transform
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--views', type=int, default=500)
+    parser.add_argument('--size', type=int, default=128)
+    arguments = parser.parse_args()
+
+    # NOTE: in $ROOT, mkdir -p data; ln -sf /path/to/SIXD_DATASETS data/SIXD_DATASETS
+    cad_path = osp.join(cur_dir, '../data/SIXD_DATASETS/hinterstoisser/models')
+    assert osp.exists(cad_path), "cad_path {} does not exist. Check your dataset path!".format(cad_path)
+    models_cad_files = sorted(glob.glob(os.path.join(cad_path, '*.ply')))[:1]
+    renderer = meshrenderer.Renderer(models_cad_files, 1)
+
+    W = H = arguments.size
+    K = np.array([[572.4114, 0.0, W/2.], [0.0, 573.57043, H/2.], [0.0, 0.0, 1.0]])
+    t = np.array([0, 0, 1500.])
+    Rs = [transform.random_rotation_matrix()[:3,:3] for _ in range(arguments.views)]
+
+    start = time.time()
+    singles = [renderer.render(0, W, H, K, R, t, 10, 10000) for R in Rs]
+    single_rate = len(Rs) / (time.time() - start)
+
+    start = time.time()
+    bgrs, depths = renderer.render_batch([0]*len(Rs), W, H, K, Rs, [t]*len(Rs), 10, 10000)
+    batch_rate = len(Rs) / (time.time() - start)
+
+    # pipelined readback, each result is fetched one frame later
+    start = time.time()
+    handles = []
+    for R in Rs:
+        handles.append(renderer.render_async(0, W, H, K, R, t, 10, 10000))
+        if len(handles) > 1:
+            handles[-2].result()
+    handles[-1].result()
+    async_rate = len(Rs) / (time.time() - start)
+
+    # depth and box only, without shading and color readback
+    start = time.time()
+    depths_only = [renderer.render_depth(0, W, H, K, R, t, 10, 10000) for R in Rs]
+    depth_rate = len(Rs) / (time.time() - start)
+    start = time.time()
+    bbs = [renderer.render_bbox(0, W, H, K, R, t, 10, 10000) for R in Rs]
+    bbox_rate = len(Rs) / (time.time() - start)
+
+    print('max |render_depth diff| %.2e' % max(np.abs(s[1] - d).max() for s, d in zip(singles, depths_only)))
+    print('render_bbox == bbox of depth: %s' % all(
+        bb == [xs.min(), ys.min(), xs.max() - xs.min(), ys.max() - ys.min()]
+        for bb, (ys, xs) in zip(bbs, [np.nonzero(s[1] > 0) for s in singles])))
+    print('max |bgr diff| %s, max |depth diff| %.2e' % (
+        max(np.abs(s[0].astype(int) - b).max() for s, b in zip(singles, bgrs)),
+        max(np.abs(s[1] - d).max() for s, d in zip(singles, depths))))
+    print('render       %.1f views/s' % single_rate)
+    print('render_async %.1f views/s' % async_rate)
+    print('render_batch %.1f views/s' % batch_rate)
+    print('render_depth %.1f views/s' % depth_rate)
+    print('render_bbox  %.1f views/s' % bbox_rate)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+import os.path as osp
+import sys
+cur_dir = osp.dirname(osp.abspath(__file__))
+sys.path.insert(0, osp.join(cur_dir, '..'))
+import numpy as np
+import pytest
+pytest.importorskip('cv2')
+iaa = pytest.importorskip('imgaug.augmenters')
+from auto_pose.ae import augmentation
+
+N, S = 400, 64
+
+
+def constant_images(value, n=N, size=S):
+    return np.full((n, size, size, 3), value, dtype=np.uint8)
+
+
+def augment_both(name, images, *args, **kw):
+    native = getattr(augmentation, name)(*args, **kw)
+    native.reseed(1)
+    reference = getattr(iaa, name)(*args, **kw)
+    reference.reseed(1)
+    a, b = native.augment_images(images), np.asarray(reference.augment_images(images))
+    assert a.shape == b.shape == images.shape
+    assert a.dtype == b.dtype == np.uint8
+    return a, b
+
+
+def channel_values(images):
+    # one value per image and channel, the images are constant
+    return images[:,0,0,:].astype(np.float64)
+
+
+def assert_same_distribution(a, b, tolerance):
+    a, b = channel_values(a), channel_values(b)
+    assert abs(a.min() - b.min()) <= tolerance
+    assert abs(a.max() - b.max()) <= tolerance
+    assert abs(a.mean() - b.mean()) <= tolerance
+    # fraction of images with channel dependent values
+    assert abs(np.mean(a.std(axis=1) > 0) - np.mean(b.std(axis=1) > 0)) < 0.1
+
+
+def test_add():
+    a, b = augment_both('Add', constant_images(128), (-25, 25), per_channel=0.3)
+    assert channel_values(a).min() == 128 - 25 and channel_values(a).max() == 128 + 25
+    assert_same_distribution(a, b, 1)
+
+
+def test_multiply():
+    a, b = augment_both('Multiply', constant_images(100), (0.6, 1.4), per_channel=0.5)
+    assert channel_values(a).min() >= 60 and channel_values(a).max() <= 140
+    assert_same_distribution(a, b, 2)
+
+
+def test_contrast_normalization():
+    a, b = augment_both('ContrastNormalization', constant_images(160), (0.5, 2.2), per_channel=0.3)
+    assert channel_values(a).min() >= 128 + 0.5*32 - 1 and channel_values(a).max() <= 128 + 2.2*32 + 1
+    assert_same_distribution(a, b, 2)
+
+
+def test_coarse_dropout():
+    images = constant_images(255, n=200, size=128)
+    a, b = augment_both('CoarseDropout', images, p=0.2, size_percent=0.05)
+    assert set(np.unique(a)) <= set([0, 255])
+    dropped_a, dropped_b = (a == 0).all(axis=3), (b == 0).all(axis=3)
+    assert abs(dropped_a.mean() - dropped_b.mean()) < 0.02
+    # same coarse cells: mean length of the dropped runs along the rows
+    def run_length(dropped):
+        starts = dropped[...,1:] & ~dropped[...,:-1]
+        return dropped.sum() / float(starts.sum() + dropped[...,0].sum())
+    assert abs(run_length(dropped_a) - run_length(dropped_b)) < 0.1*run_length(dropped_b)
+
+
+def test_affine_scale():
+    # Affine has no native counterpart, from_code runs imgaug's
+    images = np.zeros((50, S, S, 3), dtype=np.uint8)
+    images[:, 24:40, 24:40] = 255
+    native = augmentation.from_code('Affine(scale=(1.0, 1.2))')
+    assert isinstance(native, augmentation.ImgaugAugmenter)
+    native.reseed(1)
+    reference = iaa.Affine(scale=(1.0, 1.2))
+    reference.reseed(1)
+    a = native.augment_images(images)
+    assert a.shape == images.shape and a.dtype == np.uint8
+    assert np.array_equal(a, reference.augment_images(images))
+    sides = (a[...,0] > 127).any(axis=1).sum(axis=1)
+    assert sides.min() >= 16 and sides.max() <= 16*1.2 + 1
@@ -0,0 +1,112 @@
+import os.path as osp
+import sys
+cur_dir = osp.dirname(osp.abspath(__file__))
+sys.path.insert(0, osp.join(cur_dir, '..'))
+import configparser
+import tempfile
+import numpy as np
+import pytest
+from auto_pose.ae import codebook_index
+from auto_pose.ae.pysixd_stuff import transform, view_sampler
+
+
+def random_codebook(n=4096, J=32, seed=0):
+    # clusters of 64 neighbouring entries like the views of a codebook
+    rng = np.random.RandomState(seed)
+    embedding = np.repeat(rng.randn(n//64, J), 64, axis=0) + 0.3*rng.randn(n, J)
+    return (embedding / np.linalg.norm(embedding, axis=1, keepdims=True)).astype(np.float32)
+
+
+def noisy_queries(embedding, n=200, noise=0.2, seed=1):
+    rng = np.random.RandomState(seed)
+    queries = embedding[rng.choice(len(embedding), n, replace=False)] + noise*rng.randn(n, embedding.shape[1])/np.sqrt(embedding.shape[1])
+    return (queries / np.linalg.norm(queries, axis=1, keepdims=True)).astype(np.float32)
+
+
+def index_args(**options):
+    args = configparser.ConfigParser()
+    args.read_dict({'Embedding': options})
+    return args
+
+
+@pytest.mark.parametrize('kind', ['ivf', 'ivfpq'])
+def test_ivf_recall(kind):
+    embedding = random_codebook()
+    queries = noisy_queries(embedding)
+    index = codebook_index.IVFIndex(embedding, n_probe=8, pq_m=8 if kind == 'ivfpq' else 0, rerank=100)
+    _, gt = codebook_index.BruteForceIndex(embedding).search(queries, 1)
+    _, idcs = index.search(queries, 1)
+    assert np.mean(idcs[:,0] == gt[:,0]) >= 0.95
+
+
+@pytest.mark.parametrize('kind', ['brute', 'ivf', 'ivfpq'])
+def test_build_load_round_trip(kind):
+    embedding = random_codebook()
+    queries = noisy_queries(embedding)
+    index = codebook_index.build_index(embedding, index_args(INDEX=kind, INDEX_N_PROBE='4', INDEX_RERANK='50'))
+    path = osp.join(tempfile.mkdtemp(), 'index.npz')
+    index.save(path)
+    loaded = codebook_index.load_index(path, embedding)
+    assert type(loaded) is type(index)
+    for a, b in zip(index.search(queries, 10), loaded.search(queries, 10)):
+        assert np.array_equal(a, b)
+
+
+def icosphere_codebook(min_n_views=642, num_cyclo=36, J=32):
+    # rotations and view levels as Dataset.viewsphere_for_embedding, codes a smooth function of the rotation
+    views, view_levels = view_sampler.sample_views(min_n_views)
+    cyclos = np.linspace(0, 2.*np.pi, num_cyclo)
+    Rs = np.array([np.array([[np.cos(-c), -np.sin(-c), 0], [np.sin(-c), np.cos(-c), 0], [0, 0, 1]]).dot(view['R'])
+                   for view in views for c in cyclos])
+    W = 2.*np.random.RandomState(0).randn(9, J)
+    def encode(Rs):
+        z = np.tanh(np.asarray(Rs).reshape(-1, 9).dot(W))
+        return (z / np.linalg.norm(z, axis=1, keepdims=True)).astype(np.float32)
+    return encode, Rs, np.array(view_levels)
+
+
+def test_hierarchical_top1():
+    encode, Rs, view_levels = icosphere_codebook()
+    embedding = encode(Rs)
+    rng = np.random.RandomState(2)
+    queries = encode([transform.random_rotation_matrix(rng.rand(3))[:3,:3] for _ in range(200)])
+    index = codebook_index.HierarchicalIndex(embedding, Rs, view_levels, 36, coarse_level=1, beam=8)
+    gt_scores, gt = codebook_index.BruteForceIndex(embedding).search(queries, 1)
+    scores, idcs = index.search(queries, 1)
+    # the 0 and 2 pi in-plane rotations are the same entry, ties may resolve either way
+    np.testing.assert_allclose(scores, gt_scores, atol=1e-5)
+    assert np.mean(idcs[:,0] == gt[:,0]) >= 0.95
+    assert index.entries_scanned() < len(embedding) / 5.
+
+
+class ExportSession(object):
+    # session.run of the codebook variables Codebook.save reads
+    def __init__(self, values):
+        self.values = values
+
+    def run(self, fetch):
+        return self.values[fetch]
+
+
+@pytest.mark.parametrize('precision, min_top1', [('float16', 0.99), ('int8', 0.95)])
+def test_quantized_save_load(precision, min_top1):
+    from auto_pose.ae.codebook import Codebook
+    embedding = random_codebook()
+    queries = noisy_queries(embedding)
+    codebook = Codebook.__new__(Codebook)
+    codebook._dataset, codebook._symmetry_map, codebook.embed_bb = None, None, False
+    codebook._rotations = np.tile(np.eye(3, dtype=np.float32), (len(embedding), 1, 1))
+    codebook._num_cyclo, codebook.K_train, codebook.render_radius = 36, np.eye(3), 700.
+    codebook.embedding_normalized = 'embedding_normalized'
+    path = tempfile.mkdtemp()
+    codebook.save(ExportSession({'embedding_normalized': embedding}), path, precision=precision)
+
+    loaded = Codebook.load(path).embedding_values
+    assert isinstance(loaded, codebook_index.QuantizedEmbedding)
+    assert loaded.precision == precision and loaded.shape == embedding.shape
+    # float16 rounding, int8 steps of max|row|/127
+    tolerance = 1e-3 if precision == 'float16' else np.abs(embedding).max(axis=1, keepdims=True) / 254. + 1e-6
+    assert np.all(np.abs(loaded[:] - embedding) <= tolerance)
+    _, gt = codebook_index.BruteForceIndex(embedding).search(queries, 1)
+    _, idcs = codebook_index.BruteForceIndex(loaded).search(queries, 1)
+    assert np.mean(idcs[:,0] == gt[:,0]) >= min_top1
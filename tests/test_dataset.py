@@ -0,0 +1,95 @@
+import os.path as osp
+import sys
+cur_dir = osp.dirname(osp.abspath(__file__))
+sys.path.insert(0, osp.join(cur_dir, '..'))
+sys.path.insert(0, osp.join(cur_dir, '../bop_toolkit'))
+import tempfile
+import numpy as np
+import pytest
+pytest.importorskip('cv2')
+pytest.importorskip('progressbar')
+from auto_pose.ae.dataset import Dataset
+from test_numpy_renderer import BOX_FACES, box_vertices, write_ply
+
+
+def numpy_crop_dataset(vertex_scale=1.):
+    path = osp.join(tempfile.mkdtemp(), 'box.ply')
+    write_ply(path, box_vertices(), BOX_FACES)
+    kw = {
+        'h': '32', 'w': '32', 'c': '3',
+        'noof_training_imgs': '4',
+        'background_images_glob': '/nonexistent/*.jpg', 'noof_bg_imgs': '0',
+        'realistic_occlusion': 'False',
+        'renderer': 'numpy', 'model': 'cad', 'model_path': path,
+        'antialiasing': '1', 'vertex_scale': str(vertex_scale),
+        'render_dims': '(128, 96)', 'k': '[500., 0, 64.3, 0, 505., 47.6, 0, 0, 1]',
+        'clip_near': '10', 'clip_far': '10000', 'radius': '600',
+        'pad_factor': '1.2', 'max_rel_offset': '0.2',
+        'crop_rendering': 'True', 'crop_supersampling': '2'
+    }
+    return Dataset(tempfile.mkdtemp(), **kw)
+
+
+@pytest.fixture
+def no_opengl(monkeypatch):
+    # CPU-only nodes: every import of OpenGL fails
+    for name in list(sys.modules):
+        if name == 'OpenGL' or name.startswith('OpenGL.') or name.startswith('auto_pose.meshrenderer.gl_utils'):
+            monkeypatch.delitem(sys.modules, name)
+    monkeypatch.setitem(sys.modules, 'OpenGL', None)
+
+
+def test_numpy_crop_rendering_without_opengl(no_opengl):
+    dataset = numpy_crop_dataset()
+    assert dataset.render_training_images(progress=False) == 4
+    masks = dataset.unpack_masks(dataset.mask_x)
+    for x, y, mask in zip(dataset.train_x, dataset.train_y, masks):
+        assert (~mask).any() and mask.any()
+        assert x[~mask].any() and y.any()
+
+
+def test_crop_rendering_stops_on_invisible_object(no_opengl):
+    # vertices in m instead of mm, the object covers no pixel
+    dataset = numpy_crop_dataset(vertex_scale=1e-4)
+    assert dataset.render_training_images(progress=False) == 0
+
+
+class AsyncRenderer(object):
+    # render_async as the GL renderers offer it, records the handles that were never resolved
+    class Handle(object):
+        def __init__(self, renderer, args):
+            self.renderer, self.args, self.resolved = renderer, args, False
+
+        def result(self):
+            self.resolved = True
+            return self.renderer.render(**self.args)
+
+    def __init__(self, renderer):
+        self.renderer, self.handles = renderer, []
+
+    def render(self, **args):
+        return self.renderer.render(**args)
+
+    def render_async(self, **args):
+        self.handles.append(self.Handle(self.renderer, args))
+        return self.handles[-1]
+
+
+@pytest.mark.parametrize('vertex_scale, rendered', [(1., 4), (1e-4, 0)])
+def test_render_async_handles_are_resolved(no_opengl, vertex_scale, rendered):
+    dataset = numpy_crop_dataset(vertex_scale)
+    dataset._cache_renderer = AsyncRenderer(dataset.renderer)
+    assert dataset.render_training_images(progress=False) == rendered
+    assert all(handle.resolved for handle in dataset.renderer.handles)
+
+
+def test_training_cache_hash_ignores_throughput_knobs():
+    import configparser
+    def cache_hash(**dataset):
+        args = configparser.ConfigParser()
+        args.read_dict({'Paths': {'MODEL_PATH': '/models/obj_01.ply'}, 'Dataset': dict({'H': '128', 'RADIUS': '700'}, **dataset)})
+        return Dataset.training_cache_hash(args)
+    baseline = cache_hash()
+    assert cache_hash(RENDER_THREADS='8') == baseline
+    assert cache_hash(STREAMING='True', STREAM_RESERVOIR_SIZE='5000', STREAM_WORKERS='4', STREAM_RENDER_RATIO='0.5') == baseline
+    assert cache_hash(H='64') != baseline
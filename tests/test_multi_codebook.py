@@ -0,0 +1,63 @@
+import os.path as osp
+import sys
+cur_dir = osp.dirname(osp.abspath(__file__))
+sys.path.insert(0, osp.join(cur_dir, '..'))
+import tempfile
+import numpy as np
+import pytest
+tf = pytest.importorskip('tensorflow')
+from auto_pose.ae import codebook_index
+from auto_pose.ae.codebook import Codebook
+from auto_pose.ae.encoder import Encoder
+from auto_pose.ae.multi_codebook import MultiCodebook
+from test_codebook_index import ExportSession, random_codebook
+
+
+def exported_codebook(name, n, precision, seed):
+    codebook = Codebook.__new__(Codebook)
+    codebook._dataset, codebook._symmetry_map, codebook.embed_bb = None, None, False
+    codebook._rotations = np.tile(np.eye(3, dtype=np.float32), (n, 1, 1))
+    codebook._num_cyclo, codebook.K_train, codebook.render_radius = 8, np.eye(3), 700.
+    codebook.embedding_normalized = 'embedding_normalized'
+    path = tempfile.mkdtemp()
+    codebook.save(ExportSession({'embedding_normalized': random_codebook(n, 16, seed)}), path, precision=precision)
+    with tf.variable_scope(name):
+        x = tf.placeholder(tf.float32, [None, 16, 16, 3])
+        return Codebook.load(path, Encoder(x, 16, [8, 8], 3, [2, 2], False))
+
+
+@pytest.mark.parametrize('precisions, indexed', [
+    (['int8', 'int8'], [False, False]),
+    (['float16', 'float32', 'int8'], [False, False, False]),
+    (['float16', 'int8', 'float16'], [False, True, False])
+])
+def test_fused_search(precisions, indexed):
+    rng = np.random.RandomState(0)
+    class_idcs = rng.randint(0, len(precisions), 12)
+    crops = rng.randint(0, 256, (12, 16, 16, 3)).astype(np.uint8)
+    with tf.Graph().as_default():
+        codebooks = [exported_codebook('obj_%d' % i, 512 + 64*i, precision, i) for i, precision in enumerate(precisions)]
+        for codebook, with_index in zip(codebooks, indexed):
+            if with_index:
+                codebook.index = codebook_index.BruteForceIndex(codebook.embedding_values)
+        multi = MultiCodebook(codebooks)
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            multi.initialize(sess)
+            if len(set(precisions)) == 1:
+                assert multi.embedding_values.dtype.base_dtype == tf.as_dtype(precisions[0])
+            for upright in [False, True]:
+                idcs = multi.nearest_idcs(sess, list(crops), class_idcs, 3, upright=upright)
+                for i, codebook in enumerate(codebooks):
+                    rows = class_idcs == i
+                    query = sess.run(codebook.normalized_embedding_query, {codebook._encoder.x: crops[rows]/255.})
+                    sims = codebook_index.similarity(codebook.embedding_values, query)
+                    expected = codebook._top_n_idcs(sims, 3, upright=upright)
+                    assert np.array_equal(idcs[rows], expected)
+
+
+def test_checkpoint_codebooks_are_not_fused():
+    codebook = Codebook.__new__(Codebook)
+    codebook.embedding_values = None
+    with pytest.raises(AssertionError):
+        MultiCodebook([codebook])
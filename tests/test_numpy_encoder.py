@@ -0,0 +1,62 @@
+import os.path as osp
+import sys
+cur_dir = osp.dirname(osp.abspath(__file__))
+sys.path.insert(0, osp.join(cur_dir, '..'))
+import tempfile
+import numpy as np
+import pytest
+from auto_pose.ae.numpy_encoder import NumpyEncoder, conv2d_same, export_encoder
+
+
+def loop_conv2d_same(x, kernel, bias, stride):
+    # one output pixel at a time, zero padding placed as TensorFlow's 'same' does
+    N, H, W, C = x.shape
+    kh, kw, _, c_out = kernel.shape
+    out_h, out_w = -(-H // stride), -(-W // stride)
+    top = max((out_h - 1)*stride + kh - H, 0) // 2
+    left = max((out_w - 1)*stride + kw - W, 0) // 2
+    out = np.tile(bias.astype(np.float64), (N, out_h, out_w, 1))
+    for i in range(out_h):
+        for j in range(out_w):
+            for a in range(kh):
+                for b in range(kw):
+                    y, x_ = i*stride + a - top, j*stride + b - left
+                    if 0 <= y < H and 0 <= x_ < W:
+                        out[:,i,j] += x[:,y,x_].dot(kernel[a,b])
+    return out
+
+
+@pytest.mark.parametrize('stride', [1, 2])
+@pytest.mark.parametrize('size', [(7, 7), (8, 8), (7, 10)])
+@pytest.mark.parametrize('kernel_size', [3, 4, 5])
+def test_conv2d_same(stride, size, kernel_size):
+    rng = np.random.RandomState(0)
+    x = rng.rand(2, size[0], size[1], 3).astype(np.float32)
+    kernel = rng.randn(kernel_size, kernel_size, 3, 4).astype(np.float32)
+    bias = rng.randn(4).astype(np.float32)
+    out = conv2d_same(x, kernel, bias, stride)
+    assert out.shape == (2, -(-size[0] // stride), -(-size[1] // stride), 4)
+    np.testing.assert_allclose(out, loop_conv2d_same(x, kernel, bias, stride), rtol=1e-5, atol=1e-5)
+
+
+@pytest.mark.parametrize('batch_norm', [False, True])
+def test_export_against_tf(batch_norm):
+    tf = pytest.importorskip('tensorflow')
+    from auto_pose.ae.encoder import Encoder
+    rng = np.random.RandomState(0)
+    crops = rng.randint(0, 256, (4, 32, 32, 3)).astype(np.uint8)
+    with tf.Graph().as_default():
+        x = tf.placeholder(tf.float32, [None, 32, 32, 3])
+        encoder = Encoder(x, 16, [8, 16, 16], 5, [2, 2, 1], batch_norm)
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            # batch norm statistics away from their identity initialization
+            for variable in encoder.variables:
+                if 'batch_normalization' in variable.name:
+                    shape = variable.get_shape().as_list()
+                    sess.run(variable.assign(rng.uniform(0.5, 1.5, shape).astype(np.float32)))
+            path = tempfile.mkdtemp()
+            export_encoder(sess, encoder, path)
+            z_tf = sess.run(encoder.z, {x: crops/255.})
+    z_np = NumpyEncoder.load(path, max_batch=3).z(crops)
+    np.testing.assert_allclose(z_np, z_tf, rtol=1e-4, atol=1e-4)
@@ -0,0 +1,173 @@
+import os
+import os.path as osp
+import sys
+cur_dir = osp.dirname(osp.abspath(__file__))
+sys.path.insert(0, osp.join(cur_dir, '..'))
+sys.path.insert(0, osp.join(cur_dir, '../bop_toolkit'))
+import argparse
+import tempfile
+import numpy as np
+import pytest
+from auto_pose.meshrenderer import meshrenderer_numpy
+from auto_pose.meshrenderer.pysixd import transform
+
+# GL renders of the box below, written by: python tests/test_numpy_renderer.py --store
+REFERENCE_FILE = osp.join(cur_dir, 'data', 'numpy_renderer_reference.npz')
+
+W, H = 128, 96
+K = np.array([[500., 0, 64.3], [0, 505., 47.6], [0, 0, 1]])
+BOX_FACES = np.array([[0,1,3],[0,3,2],[4,6,7],[4,7,5],[0,4,5],[0,5,1],
+                      [2,3,7],[2,7,6],[0,2,6],[0,6,4],[1,5,7],[1,7,3]])
+
+
+def box_vertices(size=(100., 60., 40.)):
+    return np.array([[x, y, z] for x in (-1, 1) for y in (-1, 1) for z in (-1, 1)]) * np.array(size) / 2.
+
+
+def write_ply(path, vertices, faces):
+    with open(path, 'w') as f:
+        f.write('ply\nformat ascii 1.0\nelement vertex {}\nproperty float x\nproperty float y\nproperty float z\n'
+                'element face {}\nproperty list uchar int vertex_indices\nend_header\n'.format(len(vertices), len(faces)))
+        for v in vertices:
+            f.write('{} {} {}\n'.format(*v))
+        for face in faces:
+            f.write('3 {} {} {}\n'.format(*face))
+
+
+def poses(n=8, seed=0):
+    state = np.random.get_state()
+    np.random.seed(seed)
+    Rs = [transform.random_rotation_matrix()[:3,:3] for _ in range(n)]
+    ts = [np.array([0., 0., 600.]) + np.random.uniform(-40, 40, 3) for _ in range(n)]
+    np.random.set_state(state)
+    return Rs, ts
+
+
+def raycast(vertices, faces, R, t):
+    """Nearest hit depth and face per pixel center, by intersecting every pixel ray with every face."""
+    X = vertices.dot(R.T) + t
+    js, is_ = np.meshgrid(np.arange(W) + 0.5, np.arange(H) + 0.5)
+    rays = np.stack((js, is_, np.ones_like(js)), axis=-1).reshape(-1, 3).dot(np.linalg.inv(K).T)
+    depth = np.full(len(rays), np.inf)
+    hit = np.full(len(rays), -1)
+    for i, (a, b, c) in enumerate(X[faces]):
+        n = np.cross(b - a, c - a)
+        z = a.dot(n) / rays.dot(n)
+        P = z[:,np.newaxis] * rays
+        inside = (z > 0) & (z < depth)
+        for p, q in ((a, b), (b, c), (c, a)):
+            inside &= np.cross(q - p, P - p).dot(n) >= 0
+        depth[inside] = z[inside]
+        hit[inside] = i
+    depth[hit < 0] = 0.
+    return depth.reshape(H, W), hit.reshape(H, W), rays.reshape(H, W, 3)
+
+
+def cad_shading(vertices, faces, R, depth, hit, rays):
+    # cad_shader.frag with the default light, evaluated at the ray hits in eye coordinates
+    mask = hit >= 0
+    P = depth[mask][:,np.newaxis] * rays[mask] * [1, 1, -1]
+    a, b, c = [vertices[faces[hit[mask], i]] for i in range(3)]
+    N = np.cross(b - a, c - a).dot(R.T) * [1, 1, -1]
+    N /= np.linalg.norm(N, axis=1, keepdims=True)
+    L = np.array([400., 400., 400.]) - P
+    L /= np.linalg.norm(L, axis=1, keepdims=True)
+    V = -P / np.linalg.norm(P, axis=1, keepdims=True)
+    NL = (N*L).sum(axis=1, keepdims=True)
+    material = np.array([223., 214., 205.]) / 255.
+    specular = np.maximum(((2*NL*N - L)*V).sum(axis=1, keepdims=True), 0.)
+    rgb = np.clip(0.4*material + 0.8*np.maximum(NL, 0.)*material + 0.3*specular*material, 0., 1.)
+    bgr = np.zeros((H, W, 3), dtype=np.uint8)
+    bgr[mask] = np.round(rgb[:,::-1]*255.)
+    return bgr
+
+
+@pytest.fixture(scope='module')
+def box_file():
+    path = osp.join(tempfile.mkdtemp(), 'box.ply')
+    write_ply(path, box_vertices(), BOX_FACES)
+    return path
+
+
+def test_raycast_agreement(box_file):
+    renderer = meshrenderer_numpy.Renderer([box_file])
+    for R, t in zip(*poses()):
+        bgr, depth = renderer.render(0, W, H, K, R, t, 10, 10000)
+        depth_ref, hit, rays = raycast(box_vertices(), BOX_FACES, R, t)
+        assert np.array_equal(depth > 0, depth_ref > 0)
+        np.testing.assert_allclose(depth, depth_ref, rtol=1e-5)
+        # pixel centers on a silhouette crease may pick either face
+        bgr_ref = cad_shading(box_vertices(), BOX_FACES, R, depth_ref, hit, rays)
+        assert np.mean(np.abs(bgr.astype(int) - bgr_ref).max(axis=2) <= 1) > 0.995
+
+
+def test_threads_and_render_many(box_file):
+    single = meshrenderer_numpy.Renderer([box_file])
+    banded = meshrenderer_numpy.Renderer([box_file], threads=3)
+    Rs, ts = poses(2)
+    for R, t in zip(Rs, ts):
+        for a, b in zip(single.render(0, W, H, K, R, t, 10, 10000), banded.render(0, W, H, K, R, t, 10, 10000)):
+            assert np.array_equal(a, b)
+
+    ts[1] = ts[0] + [30., 10., 80.]
+    bgr, depth, bbs = single.render_many([0, 0], W, H, K, Rs, ts, 10, 10000)
+    views = [single.render(0, W, H, K, R, t, 10, 10000) for R, t in zip(Rs, ts)]
+    depths = np.stack([np.where(d > 0, d, np.inf) for _, d in views])
+    assert np.array_equal(depth, np.where(np.isinf(depths.min(axis=0)), 0, depths.min(axis=0)))
+    for (_, d), bb in zip(views, bbs):
+        ys, xs = np.nonzero(d > 0)
+        assert list(bb) == [xs.min(), ys.min(), xs.max() - xs.min(), ys.max() - ys.min()]
+    front = depths.argmin(axis=0) == 0
+    assert np.array_equal(bgr[front & (depth > 0)], views[0][0][front & (depth > 0)])
+    # an object outside the image has no box, render_many raises as calc_2d_bbox does
+    with pytest.raises(ValueError):
+        single.render_many([0, 0], W, H, K, Rs, [ts[0], np.array([5000., 0, 600.])], 10, 10000)
+
+
+def test_depth_and_bbox_queries(box_file):
+    renderer = meshrenderer_numpy.Renderer([box_file])
+    margins = []
+    for R, t in zip(*poses(32)):
+        _, depth = renderer.render(0, W, H, K, R, t, 10, 10000)
+        assert np.array_equal(renderer.render_depth(0, W, H, K, R, t, 10, 10000), depth)
+        ys, xs = np.nonzero(depth > 0)
+        x, y, w, h = renderer.render_bbox(0, W, H, K, R, t, 10, 10000)
+        margins.append([xs.min() - x, ys.min() - y, x + w - xs.max(), y + h - ys.max()])
+    # the projected box contains the covered pixels, larger only at box corners between pixel centers
+    margins = np.array(margins)
+    assert margins.min() >= 0
+    assert np.mean(margins.max(axis=1) <= 1) > 0.8
+    assert renderer.render_bbox(0, W, H, K, np.eye(3), np.array([5000., 0, 600.]), 10, 10000) is None
+
+
+@pytest.mark.skipif(not osp.exists(REFERENCE_FILE), reason='no stored GL reference renders')
+def test_gl_reference_agreement(box_file):
+    reference = np.load(REFERENCE_FILE)
+    renderer = meshrenderer_numpy.Renderer([box_file])
+    for R, t, bgr_ref, depth_ref in zip(reference['Rs'], reference['ts'], reference['bgrs'], reference['depths']):
+        bgr, depth = renderer.render(0, W, H, K, R, t, 10, 10000)
+        both = (depth > 0) & (depth_ref > 0)
+        assert np.mean((depth > 0) == (depth_ref > 0)) > 0.995
+        np.testing.assert_allclose(depth[both], depth_ref[both], rtol=1e-4)
+        assert np.mean(np.abs(bgr.astype(int) - bgr_ref)[both].max(axis=1) <= 1) > 0.99
+
+
+def store_reference():
+    os.environ.setdefault('PYOPENGL_PLATFORM', 'egl')
+    from auto_pose.meshrenderer import meshrenderer
+    path = osp.join(tempfile.mkdtemp(), 'box.ply')
+    write_ply(path, box_vertices(), BOX_FACES)
+    renderer = meshrenderer.Renderer([path], 1, tempfile.mkdtemp())
+    Rs, ts = poses()
+    renders = [renderer.render(0, W, H, K, R, t, 10, 10000) for R, t in zip(Rs, ts)]
+    if not osp.exists(osp.dirname(REFERENCE_FILE)):
+        os.makedirs(osp.dirname(REFERENCE_FILE))
+    np.savez_compressed(REFERENCE_FILE, Rs=np.array(Rs), ts=np.array(ts),
+                        bgrs=np.array([bgr for bgr, _ in renders]), depths=np.array([depth for _, depth in renders]))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--store', action='store_true', help='render the GL reference images')
+    if parser.parse_args().store:
+        store_reference()